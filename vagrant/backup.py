@@ -0,0 +1,190 @@
+import argparse
+import ctypes
+import ctypes.util
+import os
+import sqlite3
+import sys
+import time
+
+from sqlalchemy.engine.url import make_url
+
+from database_setup import DATABASE_URL
+
+# Python 2's sqlite3 module has no backup API (Connection.backup arrived in
+# Python 3.7), so call SQLite's own through ctypes
+SQLITE_OK = 0
+SQLITE_BUSY = 5
+SQLITE_LOCKED = 6
+SQLITE_DONE = 101
+SQLITE_OPEN_READWRITE = 0x02
+SQLITE_OPEN_CREATE = 0x04
+
+# Pages copied per step, and the pause between steps that leaves the disk
+# (and, outside WAL mode, the database lock) to writers
+STEP_PAGES = 256
+STEP_SLEEP = 0.005
+
+
+def loadSqlite():
+    lib = ctypes.CDLL(ctypes.util.find_library('sqlite3'))
+    lib.sqlite3_open_v2.argtypes = [
+        ctypes.c_char_p, ctypes.POINTER(ctypes.c_void_p), ctypes.c_int,
+        ctypes.c_char_p]
+    lib.sqlite3_close.argtypes = [ctypes.c_void_p]
+    lib.sqlite3_errmsg.argtypes = [ctypes.c_void_p]
+    lib.sqlite3_errmsg.restype = ctypes.c_char_p
+    lib.sqlite3_exec.argtypes = [
+        ctypes.c_void_p, ctypes.c_char_p, ctypes.c_void_p, ctypes.c_void_p,
+        ctypes.c_void_p]
+    lib.sqlite3_backup_init.argtypes = [
+        ctypes.c_void_p, ctypes.c_char_p, ctypes.c_void_p, ctypes.c_char_p]
+    lib.sqlite3_backup_init.restype = ctypes.c_void_p
+    for name in ('sqlite3_backup_step', 'sqlite3_backup_remaining',
+                 'sqlite3_backup_pagecount', 'sqlite3_backup_finish'):
+        getattr(lib, name).argtypes = [ctypes.c_void_p] + (
+            [ctypes.c_int] if name == 'sqlite3_backup_step' else [])
+    return lib
+
+
+class SqliteError(Exception):
+    pass
+
+
+def openDatabase(lib, path, flags):
+    handle = ctypes.c_void_p()
+    if lib.sqlite3_open_v2(path, ctypes.byref(handle), flags, None) != \
+            SQLITE_OK:
+        message = lib.sqlite3_errmsg(handle)
+        lib.sqlite3_close(handle)
+        raise SqliteError("cannot open %s: %s" % (path, message))
+    return handle
+
+
+def execute(lib, handle, sql):
+    if lib.sqlite3_exec(handle, sql, None, None, None) != SQLITE_OK:
+        raise SqliteError(lib.sqlite3_errmsg(handle))
+
+
+def journalMode(path):
+    """The database file's journal mode, e.g. 'wal' or 'delete'"""
+    connection = sqlite3.connect(path)
+    try:
+        return connection.execute("PRAGMA journal_mode").fetchone()[0].lower()
+    finally:
+        connection.close()
+
+
+def integrityCheck(path):
+    """PRAGMA integrity_check on a database file: [] if it is sound, else
+    the problems found"""
+    connection = sqlite3.connect(path)
+    try:
+        problems = [row[0] for row in
+                    connection.execute("PRAGMA integrity_check")]
+        return [] if problems == ['ok'] else problems
+    finally:
+        connection.close()
+
+
+def backupDatabase(source, target, step_pages=STEP_PAGES,
+                   step_sleep=STEP_SLEEP, progress=None):
+    """Copy the live SQLite database at source to target with SQLite's
+    online backup API, step_pages pages at a time, sleeping step_sleep
+    seconds between steps. Writers keep going meanwhile.
+
+    In WAL mode the source connection holds one read transaction for the
+    whole copy, so the backup copies a consistent snapshot instead of
+    restarting whenever a check-in commits. In other journal modes that
+    read would block every writer until the end, so the read is released
+    between steps instead; writers then get in during the pauses, and each
+    commit restarts the copy. The copy is written next to
+    target, checked with PRAGMA integrity_check, and only then renamed
+    into place. progress(copied, total) is called after each step.
+    Returns {'pages', 'steps', 'elapsed', 'pages_per_second'}."""
+    lib = loadSqlite()
+    partial = target + '.partial'
+    if os.path.exists(partial):
+        os.remove(partial)
+
+    start = time.time()
+    steps = 0
+    src = openDatabase(lib, source, SQLITE_OPEN_READWRITE)
+    dest = openDatabase(lib, partial, SQLITE_OPEN_READWRITE |
+                        SQLITE_OPEN_CREATE)
+    try:
+        snapshot = journalMode(source) == 'wal'
+        if snapshot:
+            execute(lib, src, "BEGIN; SELECT count(*) FROM sqlite_master")
+
+        backup = lib.sqlite3_backup_init(dest, "main", src, "main")
+        if not backup:
+            raise SqliteError(lib.sqlite3_errmsg(dest))
+
+        try:
+            while True:
+                rc = lib.sqlite3_backup_step(backup, step_pages)
+                steps += 1
+                total = lib.sqlite3_backup_pagecount(backup)
+                if progress:
+                    progress(total - lib.sqlite3_backup_remaining(backup),
+                             total)
+
+                if rc == SQLITE_DONE:
+                    break
+                if rc not in (SQLITE_OK, SQLITE_BUSY, SQLITE_LOCKED):
+                    raise SqliteError(lib.sqlite3_errmsg(dest))
+                time.sleep(step_sleep)
+        finally:
+            if lib.sqlite3_backup_finish(backup) != SQLITE_OK:
+                raise SqliteError(lib.sqlite3_errmsg(dest))
+
+        if snapshot:
+            execute(lib, src, "COMMIT")
+    finally:
+        lib.sqlite3_close(dest)
+        lib.sqlite3_close(src)
+
+    problems = integrityCheck(partial)
+    if problems:
+        raise SqliteError("backup failed integrity check: %s" %
+                          "; ".join(problems[:10]))
+    os.rename(partial, target)
+
+    elapsed = time.time() - start
+    return {'pages': total, 'steps': steps, 'elapsed': elapsed,
+            'pages_per_second': total / elapsed if elapsed else 0.0}
+
+
+if __name__ == '__main__':
+    parser = argparse.ArgumentParser(
+        description="Online backup of the SQLite shelter database")
+    parser.add_argument("target", help="file to write the backup to")
+    parser.add_argument(
+        "--pages", type=int, default=STEP_PAGES,
+        help="pages copied per step (default: %d)" % STEP_PAGES)
+    parser.add_argument(
+        "--sleep", type=float, default=STEP_SLEEP, metavar="SECONDS",
+        help="pause between steps (default: %g)" % STEP_SLEEP)
+    args = parser.parse_args()
+
+    url = make_url(DATABASE_URL)
+    if url.get_backend_name() != 'sqlite' or not url.database:
+        sys.exit("Online backup is for SQLite files; back up PostgreSQL "
+                 "with pg_dump or pg_basebackup")
+
+    mode = journalMode(url.database)
+    if mode != 'wal':
+        print "Warning: %s is in %s journal mode, not WAL. Writers wait " \
+            "for each step, and every commit restarts the backup." % (
+                url.database, mode)
+
+    def report(copied, total):
+        sys.stdout.write("\r%d/%d pages" % (copied, total))
+        sys.stdout.flush()
+
+    stats = backupDatabase(url.database, args.target, args.pages, args.sleep,
+                           report)
+    print "\nBacked up %s to %s: %d pages in %d steps, %.2fs, " \
+        "%d pages/s, integrity ok" % (
+            url.database, args.target, stats['pages'], stats['steps'],
+            stats['elapsed'], stats['pages_per_second'])
@@ -0,0 +1,581 @@
+import argparse
+import datetime
+import multiprocessing
+import os
+import random
+import shutil
+import tempfile
+import threading
+import time
+import warnings
+
+from sqlalchemy import (
+    Column, create_engine, Date, desc, exc, func, Integer, Numeric, select,
+    String)
+from sqlalchemy.ext.declarative import declarative_base
+from sqlalchemy.orm import joinedload, selectinload, sessionmaker
+
+from database_queries import (
+    createWriterEngine, deletePuppies, placePuppies, placePuppy)
+from database_setup import (
+    Adopter, Base, poundsToGrams, Puppy, Shelter, Tag, WaitlistEntry,
+    occupancy_events_table, puppy_tags_table, waitlist_matches_table)
+from occupancy import (
+    forecastCapacity, FORECAST_WINDOW, occupancyHistory, rollUpOccupancy)
+from profiling import parseRepeat, printTimings, timeRuns
+from sharding import addShelter, checkInPuppy, ShardSet
+from tag_index import puppyIdsWithTags, rebuildTagIndex
+from templates import cloneTemplate
+from waitlist import locationKey, WaitlistIndex
+from write_queue import WriterService
+
+# The puppy table as it was before weight and birth date moved to integer
+# columns, kept here to compare against
+LegacyBase = declarative_base()
+
+
+class LegacyPuppy(LegacyBase):
+    __tablename__ = 'puppy'
+    id = Column(Integer, primary_key=True)
+    name = Column(String(80), nullable=False)
+    gender = Column(String(6), nullable=False)
+    dateOfBirth = Column(Date, index=True)
+    weight = Column(Numeric(10))
+    shelter_id = Column(Integer)
+
+
+def memorySession(base):
+    """Session on a fresh in-memory SQLite database with base's tables"""
+    engine = create_engine('sqlite://')
+    base.metadata.create_all(engine)
+    return sessionmaker(bind=engine)()
+
+
+def randomPuppies(count, seed=0):
+    """count puppy attribute dicts with a fixed seed, so runs compare alike"""
+    rng = random.Random(seed)
+    today = datetime.date.today()
+    return [{
+        'name': 'Puppy%d' % i,
+        'gender': rng.choice(['male', 'female']),
+        'dateOfBirth': today - datetime.timedelta(days=rng.randint(0, 540)),
+        'weight': rng.uniform(1.0, 40.0),
+        'shelter_id': rng.randint(1, 5)} for i in range(count)]
+
+
+def benchmarkNativeTypes(puppies=100000, repeat=5):
+    """Time full-table hydration and the under-six-months range query with
+    the legacy Numeric/Date columns and the integer weight_grams/birth_day
+    columns"""
+    rows = randomPuppies(puppies)
+    six_months_ago = datetime.date.today() - datetime.timedelta(180)
+
+    legacy = memorySession(LegacyBase)
+    legacy.bulk_insert_mappings(LegacyPuppy, rows)
+    legacy.commit()
+
+    # The shelters randomPuppies() refers to, now that foreign keys are
+    # enforced
+    native = memorySession(Base)
+    native.bulk_insert_mappings(Shelter, [
+        {'id': shelter_id, 'name': "Shelter %d" % shelter_id,
+         'current_occupancy': 0, 'maximum_capacity': puppies}
+        for shelter_id in range(1, 6)])
+    native.bulk_save_objects([Puppy(**row) for row in rows])
+    native.commit()
+
+    for label, session, model in [
+            ("legacy", legacy, LegacyPuppy), ("native", native, Puppy)]:
+        def hydrate():
+            session.query(model).all()
+            session.expunge_all()
+
+        def rangeQuery():
+            session.query(model).\
+                filter(model.dateOfBirth > six_months_ago).\
+                order_by(desc(model.dateOfBirth)).all()
+            session.expunge_all()
+
+        with warnings.catch_warnings():
+            # Numeric on SQLite warns about Decimal conversion on every load
+            warnings.simplefilter("ignore", exc.SAWarning)
+            printTimings(
+                "%s hydrate %d puppies" % (label, puppies),
+                timeRuns(hydrate, repeat))
+            printTimings(
+                "%s under six months" % label, timeRuns(rangeQuery, repeat))
+
+
+# Names repeat across real intakes, which the name index relies on
+INTAKE_NAMES = ["Bailey", "Max", "Charlie", "Buddy", "Rocky", "Bella", "Lucy",
+                "Molly", "Daisy", "Maggie", "Sophie", "Sadie", "Chloe"]
+
+
+def timeCheckIns(check_in, puppies, threads):
+    """Run puppies check-ins spread over threads, each calling
+    check_in(name, thread_index). Returns successful check-ins per second
+    and the number that failed with 'database is locked'."""
+    per_thread = puppies // threads
+    locked = [0] * threads
+
+    def intake(index):
+        for i in range(per_thread):
+            try:
+                check_in(INTAKE_NAMES[(index + i) % len(INTAKE_NAMES)], index)
+            except exc.OperationalError as e:
+                if "database is locked" not in str(e):
+                    raise
+                locked[index] += 1
+
+    workers = [threading.Thread(target=intake, args=(i,))
+               for i in range(threads)]
+    start = time.time()
+    for worker in workers:
+        worker.start()
+    for worker in workers:
+        worker.join()
+
+    failed = sum(locked)
+    return (per_thread * threads - failed) / (time.time() - start), failed
+
+
+def benchmarkGroupCommit(puppies=2000, repeat=1, threads=64):
+    """Check-in throughput from concurrent intake threads, each committing
+    its own transactions, versus the same threads submitting to a
+    WriterService that group-commits. Uses a temporary database file so
+    commits pay for fsync as they would in production."""
+    directory = tempfile.mkdtemp()
+    try:
+        writer = createWriterEngine(
+            'sqlite:///' + os.path.join(directory, 'intake.db'))
+        Base.metadata.create_all(writer)
+        session = sessionmaker(bind=writer)()
+        session.add(Shelter(
+            name="Intake Shelter", current_occupancy=0,
+            maximum_capacity=puppies * repeat * 2))
+        session.commit()
+        shelter_id = session.query(Shelter.id).scalar()
+        session.close()
+
+        today = datetime.date.today()
+        sessions = [sessionmaker(bind=writer)() for i in range(threads)]
+
+        def directCheckIn(name, index):
+            try:
+                placePuppy(
+                    sessions[index], name, "male", today, 10.0, shelter_id)
+                sessions[index].commit()
+            except exc.OperationalError:
+                sessions[index].rollback()
+                raise
+
+        service = WriterService(writer).start()
+
+        def queuedCheckIn(name, index):
+            service.checkIn(name, "male", today, 10.0, shelter_id).result()
+
+        for run in range(repeat):
+            print "direct commits: %d check-ins/s, %d locked out" % (
+                timeCheckIns(directCheckIn, puppies, threads))
+            print "group commit:   %d check-ins/s, %d locked out" % (
+                timeCheckIns(queuedCheckIn, puppies, threads))
+            print "                %.1f check-ins per commit" % (
+                float(service.committed) / max(service.batches, 1))
+
+        service.stop()
+        writer.dispose()
+    finally:
+        shutil.rmtree(directory)
+
+
+def intakeWorker(job):
+    """Process-pool worker for benchmarkShards: count check-ins into
+    shelter_id in county (None for the single file at url), each committed
+    alone. Returns how many failed with 'database is locked'."""
+    url, shard_dir, county, shelter_id, count = job
+    today = datetime.date.today()
+    locked = 0
+
+    if county is None:
+        writer = createWriterEngine(url)
+        session = sessionmaker(bind=writer)()
+
+        def checkIn(name):
+            try:
+                placePuppy(session, name, "male", today, 10.0, shelter_id)
+                session.commit()
+            except exc.OperationalError:
+                session.rollback()
+                raise
+    else:
+        shards = ShardSet(shard_dir)
+
+        def checkIn(name):
+            checkInPuppy(shards, name, "male", today, 10.0, "California",
+                         county, shelter_id)
+
+    for i in range(count):
+        try:
+            checkIn(INTAKE_NAMES[i % len(INTAKE_NAMES)])
+        except exc.OperationalError as e:
+            if "database is locked" not in str(e):
+                raise
+            locked += 1
+
+    return locked
+
+
+def benchmarkShards(puppies=4000, repeat=1, workers=4):
+    """Check-in throughput from workers intake processes, one per county,
+    each committing its own transactions, into one database file versus one
+    shard file per county. Processes rather than threads, since a single
+    Python process is CPU-bound well before SQLite's write lock is."""
+    directory = tempfile.mkdtemp()
+    try:
+        url = 'sqlite:///' + os.path.join(directory, 'single.db')
+        writer = createWriterEngine(url)
+        Base.metadata.create_all(writer)
+        session = sessionmaker(bind=writer)()
+        session.add_all([Shelter(
+            name="County %d Shelter" % i, county="County %d" % i,
+            state="California", current_occupancy=0,
+            maximum_capacity=puppies * repeat) for i in range(workers)])
+        session.commit()
+        shelter_ids = [s_id for (s_id,) in
+                       session.query(Shelter.id).order_by(Shelter.id)]
+        session.close()
+        writer.dispose()
+
+        shard_dir = os.path.join(directory, 'shards')
+        shards = ShardSet(shard_dir)
+        shard_shelters = [addShelter(
+            shards, name="County %d Shelter" % i, county="County %d" % i,
+            state="California", maximum_capacity=puppies * repeat)
+            for i in range(workers)]
+        shards.close()
+
+        per_worker = puppies // workers
+        single_jobs = [(url, None, None, s_id, per_worker)
+                       for s_id in shelter_ids]
+        shard_jobs = [(None, shard_dir, "County %d" % i, s_id, per_worker)
+                      for i, (key, s_id) in enumerate(shard_shelters)]
+
+        pool = multiprocessing.Pool(workers)
+        for run in range(repeat):
+            for label, jobs in [("one file", single_jobs),
+                                ("%d county shards" % workers, shard_jobs)]:
+                start = time.time()
+                locked = sum(pool.map(intakeWorker, jobs))
+                print "%-16s %d check-ins/s, %d locked out" % (
+                    label + ":", (per_worker * workers - locked) /
+                    (time.time() - start), locked)
+        pool.close()
+        pool.join()
+    finally:
+        shutil.rmtree(directory)
+
+
+def benchmarkBulkDelete(puppies=20000, repeat=1):
+    """Delete the puppies of two shelters, with their profiles, adoptions
+    and tags, by loading and deleting them through the ORM versus
+    deletePuppies()' single DELETE and ON DELETE CASCADE"""
+    def ormDelete(session, criterion):
+        for puppy in session.query(Puppy).filter(criterion).options(
+                joinedload(Puppy.profile), selectinload(Puppy.adopters)):
+            session.delete(puppy)
+
+    for run in range(repeat):
+        for label, delete in [("ORM", ormDelete),
+                              ("deletePuppies", deletePuppies)]:
+            directory = tempfile.mkdtemp()
+            try:
+                writer = createWriterEngine(cloneTemplate(
+                    os.path.join(directory, 'delete.db'), puppies))
+                session = sessionmaker(bind=writer)()
+
+                start = time.time()
+                delete(session, Puppy.shelter_id.in_([1, 2]))
+                session.commit()
+                elapsed = time.time() - start
+
+                print "%-14s %d puppies left, %d profiles, in %.3fs" % (
+                    label + ":", session.query(Puppy).count(),
+                    writer.execute(
+                        "SELECT count(*) FROM puppy_profile").scalar(),
+                    elapsed)
+                session.close()
+                writer.dispose()
+            finally:
+                shutil.rmtree(directory)
+
+
+def joinQuery(session, all_of=(), any_of=(), none_of=()):
+    """puppyIdsWithTags done with joins through puppy_tags instead of the
+    tag postings"""
+    table = puppy_tags_table
+    ids = dict(session.query(Tag.name, Tag.id).filter(
+        Tag.name.in_(list(all_of) + list(any_of) + list(none_of))))
+
+    query = session.query(Puppy.id)
+    if all_of:
+        query = query.filter(Puppy.id.in_(
+            select([table.c.puppy_id]).
+            where(table.c.tag_id.in_([ids[name] for name in all_of])).
+            group_by(table.c.puppy_id).
+            having(func.count() == len(all_of))))
+    if any_of:
+        query = query.filter(Puppy.id.in_(
+            select([table.c.puppy_id]).
+            where(table.c.tag_id.in_([ids[name] for name in any_of]))))
+    if none_of:
+        query = query.filter(~Puppy.id.in_(
+            select([table.c.puppy_id]).
+            where(table.c.tag_id.in_([ids[name] for name in none_of]))))
+
+    return [puppy_id for (puppy_id,) in query.order_by(Puppy.id)]
+
+
+def benchmarkTags(puppies=100000, repeat=5, tags=300):
+    """Multi-tag filters answered from the tag postings versus joins
+    through puppy_tags, over puppies puppies with about four of tags tags
+    each, popularity falling off like real tag use"""
+    directory = tempfile.mkdtemp()
+    try:
+        engine = create_engine(
+            'sqlite:///' + os.path.join(directory, 'tags.db'))
+        Base.metadata.create_all(engine)
+        session = sessionmaker(bind=engine)()
+        rng = random.Random(0)
+
+        engine.execute(Tag.__table__.insert(), [
+            {'id': i, 'name': 'tag%d' % i} for i in range(1, tags + 1)])
+        for start in range(1, puppies + 1, 10000):
+            ids = range(start, min(start + 10000, puppies + 1))
+            engine.execute(Puppy.__table__.insert(), [
+                {'id': i, 'name': 'Puppy%d' % i, 'gender': 'male'}
+                for i in ids])
+            engine.execute(puppy_tags_table.insert(), [
+                {'puppy_id': i, 'tag_id': tag_id} for i in ids
+                for tag_id in set(
+                    min(int(rng.paretovariate(0.6)), tags)
+                    for t in range(4))])
+        rebuildTagIndex(session)
+
+        filters = [
+            ("2 common tags AND", dict(all_of=['tag1', 'tag2'])),
+            ("common AND NOT common",
+             dict(all_of=['tag1'], none_of=['tag3'])),
+            ("5 rare tags OR", dict(any_of=['tag%d' % i for i in
+                                            range(tags - 5, tags)])),
+            ("common AND any of 3, NOT 1",
+             dict(all_of=['tag2'], any_of=['tag4', 'tag5', 'tag6'],
+                  none_of=['tag1']))]
+
+        for label, tag_filter in filters:
+            matches = puppyIdsWithTags(session, **tag_filter)
+            if matches != joinQuery(session, **tag_filter):
+                raise AssertionError("%s: postings and joins disagree" % label)
+
+            print "%s: %d puppies" % (label, len(matches))
+            printTimings("  postings", timeRuns(
+                lambda: puppyIdsWithTags(session, **tag_filter), repeat))
+            printTimings("  joins", timeRuns(
+                lambda: joinQuery(session, **tag_filter), repeat))
+
+        session.close()
+        engine.dispose()
+    finally:
+        shutil.rmtree(directory)
+
+
+def scanWaitlist(entries, gender, age_days, weight_grams, shelter_id, city):
+    """WaitlistIndex.match done by testing every entry"""
+    def within(value, low, high):
+        if value is None:
+            return low is None and high is None
+        return (low is None or low <= value) and \
+            (high is None or value <= high)
+
+    return [e.id for e in entries
+            if e.gender in (None, gender) and
+            within(age_days, e.min_age_days, e.max_age_days) and
+            within(weight_grams, e.min_weight_grams, e.max_weight_grams) and
+            (e.shelter_id is None or e.shelter_id == shelter_id) and
+            (not e.city or locationKey(None, e.city) ==
+             locationKey(None, city))]
+
+
+def benchmarkWaitlist(puppies=100000, repeat=5, entries=20000,
+                      arrivals=200):
+    """Match arrivals against entries standing waitlist entries with the
+    bucketed interval index versus testing every entry, then time a bulk
+    intake through placePuppies() with matching included"""
+    directory = tempfile.mkdtemp()
+    try:
+        url = cloneTemplate(os.path.join(directory, 'waitlist.db'), puppies)
+        writer = createWriterEngine(url)
+        rng = random.Random(0)
+        shelters = writer.execute(
+            select([Shelter.id, Shelter.city])).fetchall()
+        adopters = writer.execute(select([func.max(Adopter.id)])).scalar()
+
+        # Most entries narrow every criterion; some leave one open
+        def maybe(value):
+            return value if rng.random() < 0.8 else None
+
+        rows = []
+        for i in range(entries):
+            min_age = rng.randint(0, 360)
+            min_weight = rng.randint(450, 12000)
+            shelter_id, city = rng.choice(shelters)
+            location = rng.random()
+            rows.append({
+                'adopter_id': rng.randint(1, adopters),
+                'gender': maybe(rng.choice(["male", "female"])),
+                'min_age_days': maybe(min_age),
+                'max_age_days': maybe(min_age + rng.randint(30, 120)),
+                'min_weight_grams': maybe(min_weight),
+                'max_weight_grams': maybe(min_weight + rng.randint(
+                    450, 3000)),
+                'shelter_id': shelter_id if location < 0.5 else None,
+                'city': city if 0.5 <= location < 0.9 else None})
+        writer.execute(WaitlistEntry.__table__.insert(), rows)
+
+        today = datetime.date.today()
+        arriving = [
+            ("Arrival%d" % arrival, rng.choice(["male", "female"]),
+             today - datetime.timedelta(rng.randint(0, 540)),
+             rng.uniform(1.0, 40.0), rng.choice(shelters)[0])
+            for arrival in range(arrivals)]
+        shelter_city = dict(shelters)
+        probes = [(gender, (today - dob).days, poundsToGrams(weight),
+                   arrival_shelter, shelter_city[arrival_shelter])
+                  for name, gender, dob, weight, arrival_shelter in arriving]
+
+        entry_rows = writer.execute(
+            select([WaitlistEntry.__table__])).fetchall()
+        start = time.time()
+        index = WaitlistIndex(entry_rows)
+        print "%d entries indexed in %.3fs" % (
+            entries, time.time() - start)
+
+        indexed = [sorted(index.match(*probe)) for probe in probes]
+        if indexed != [sorted(scanWaitlist(entry_rows, *probe))
+                       for probe in probes]:
+            raise AssertionError("index and scan disagree")
+
+        print "%d arrivals, %d matches" % (
+            arrivals, sum(len(ids) for ids in indexed))
+        printTimings("  index", timeRuns(
+            lambda: [index.match(*probe) for probe in probes], repeat))
+        printTimings("  scan", timeRuns(
+            lambda: [scanWaitlist(entry_rows, *probe) for probe in probes],
+            repeat))
+
+        session = sessionmaker(bind=writer)()
+        start = time.time()
+        placePuppies(session, arriving)
+        session.commit()
+        print "placePuppies with matching: %d puppies in %.3fs, %d " \
+            "notifications queued" % (
+                arrivals, time.time() - start, writer.execute(
+                    select([func.count()]).
+                    select_from(waitlist_matches_table)).scalar())
+        session.close()
+        writer.dispose()
+    finally:
+        shutil.rmtree(directory)
+
+
+def benchmarkOccupancy(puppies=100000, repeat=5, years=3, events=300000):
+    """Roll up years of synthetic occupancy events, then time a roll up of
+    a day's new events, the days-until-full forecast for every shelter and
+    a shelter's daily history over all the years, against the same
+    forecast aggregated from raw events"""
+    directory = tempfile.mkdtemp()
+    try:
+        url = cloneTemplate(os.path.join(directory, 'occupancy.db'), puppies)
+        writer = createWriterEngine(url)
+        session = sessionmaker(bind=writer)()
+        rng = random.Random(0)
+        shelter_ids = [shelter_id for (shelter_id,) in writer.execute(
+            select([Shelter.id]))]
+        now = int(time.time())
+        span = years * 365 * 86400
+
+        def randomEvents(count, since):
+            return [{'shelter_id': rng.choice(shelter_ids),
+                     'at': rng.randint(now - since, now),
+                     'delta': 1 if rng.random() < 0.52 else -1}
+                    for i in range(count)]
+
+        writer.execute(occupancy_events_table.insert(),
+                       randomEvents(events, span))
+
+        table = occupancy_events_table
+        day = table.c.at / 86400
+        first_at = (now // 86400 - FORECAST_WINDOW) * 86400
+        printTimings("raw events, %d-day net change" % FORECAST_WINDOW,
+                     timeRuns(lambda: writer.execute(
+                         select([table.c.shelter_id, day,
+                                 func.sum(table.c.delta)]).
+                         where(table.c.at >= first_at).
+                         group_by(table.c.shelter_id, day)).fetchall(),
+                         repeat))
+        printTimings("raw events, %d-year daily net change" % years,
+                     timeRuns(lambda: writer.execute(
+                         select([day, func.sum(table.c.delta)]).
+                         where(table.c.shelter_id == shelter_ids[0]).
+                         group_by(day)).fetchall(), repeat))
+
+        start = time.time()
+        rollUpOccupancy(session)
+        session.commit()
+        print "%d events over %d years rolled up in %.3fs" % (
+            events, years, time.time() - start)
+
+        daily = events // (years * 365)
+        writer.execute(occupancy_events_table.insert(),
+                       randomEvents(daily, 86400))
+        start = time.time()
+        rollUpOccupancy(session)
+        session.commit()
+        print "a day's %d new events rolled up in %.3fs" % (
+            daily, time.time() - start)
+
+        today = datetime.datetime.utcnow().date()
+        printTimings("forecast, %d shelters" % len(shelter_ids), timeRuns(
+            lambda: forecastCapacity(session), repeat))
+        printTimings("%d-year daily history" % years, timeRuns(
+            lambda: occupancyHistory(
+                session, shelter_ids[0],
+                today - datetime.timedelta(years * 365), today), repeat))
+        session.close()
+        writer.dispose()
+    finally:
+        shutil.rmtree(directory)
+
+
+BENCHMARKS = {
+    'bulk-delete': benchmarkBulkDelete,
+    'native-types': benchmarkNativeTypes,
+    'occupancy': benchmarkOccupancy,
+    'shards': benchmarkShards,
+    'group-commit': benchmarkGroupCommit,
+    'tags': benchmarkTags,
+    'waitlist': benchmarkWaitlist,
+}
+
+
+if __name__ == '__main__':
+    parser = argparse.ArgumentParser(description="Puppy shelter benchmarks")
+    parser.add_argument("benchmark", choices=sorted(BENCHMARKS))
+    parser.add_argument(
+        "--puppies", type=int, default=100000,
+        help="dataset size (default: 100000)")
+    parser.add_argument(
+        "--repeat", type=parseRepeat, default=5, metavar="N",
+        help="timed runs per measurement (default: 5)")
+    args = parser.parse_args()
+
+    BENCHMARKS[args.benchmark](args.puppies, args.repeat)
@@ -0,0 +1,58 @@
+from sqlalchemy import func
+
+from database_setup import change_log_table
+
+# Versions of the change log pruneChanges() callers keep by default, for
+# consumers catching up from an older cursor
+CHANGE_RETENTION = 100000
+
+
+def currentVersion(session):
+    """Latest change version, 0 for a database that has never changed"""
+    return session.query(func.max(change_log_table.c.version)).scalar() or 0
+
+
+def changesSince(session, cursor=0, limit=1000):
+    """Changes to shelters, puppies, profiles, adoptions and tags after
+    version cursor, read from the trigger-maintained change_log.
+
+    Returns (changes, next_cursor). At most limit log entries are read, and
+    repeated changes to the same row within them collapse into one record
+    {'version', 'table', 'key', 'operation'} carrying the latest version and
+    operation. Keys are row ids, or "puppy_id:adopter_id" for adoptions
+    and "puppy_id:tag_id" for taggings.
+    Pass next_cursor back in to continue; it equals cursor once caught up.
+
+    On PostgreSQL versions come from a sequence and can commit out of order,
+    so a consumer that needs every change should re-read from a little
+    before its last cursor."""
+    log = change_log_table
+    rows = session.query(
+        log.c.version, log.c.table_name, log.c.row_key, log.c.operation).\
+        filter(log.c.version > cursor).\
+        order_by(log.c.version).limit(limit).all()
+
+    latest = {}
+    for row in rows:
+        latest[(row.table_name, row.row_key)] = row
+
+    changes = [
+        {'version': row.version, 'table': row.table_name,
+         'key': row.row_key, 'operation': row.operation}
+        for row in sorted(latest.values(), key=lambda r: r.version)]
+
+    next_cursor = rows[-1].version if rows else cursor
+    return changes, next_cursor
+
+
+def pruneChanges(session, before_version):
+    """Delete log entries before before_version, which every consumer has
+    already read past, and commit. The latest entry always stays, since
+    currentVersion() (and so the report cache) keys on it. Returns the
+    number deleted."""
+    before_version = min(before_version, currentVersion(session))
+    deleted = session.query(change_log_table).\
+        filter(change_log_table.c.version < before_version).\
+        delete(synchronize_session=False)
+    session.commit()
+    return deleted
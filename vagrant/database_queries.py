@@ -1,65 +1,209 @@
+import argparse
+import collections
 import datetime
+import functools
+import multiprocessing
+import os
 import random
-from random import randint
+import sqlite3
+import sys
+import time
 
-from sqlalchemy import create_engine, desc
-from sqlalchemy.orm import sessionmaker
+from sqlalchemy import create_engine, desc, event
+from sqlalchemy.orm import scoped_session, sessionmaker
+from sqlalchemy.pool import QueuePool
 from sqlalchemy.sql import exists
 
-from database_setup import Base, Shelter, Puppy, PuppyProfile, Adopter
-
-engine = create_engine('sqlite:///puppyshelter.db', echo=True)
+from change_feed import (
+    CHANGE_RETENTION, changesSince, currentVersion, pruneChanges)
+from name_lookup import findPuppiesByName, indexNames, puppiesNamed
+from profiling import parseRepeat, printTimings, profileRuns, timeRuns
+from result_cache import cachedResult, ResultCache
+from tag_index import clearPuppies, IN_BATCH, puppyIdsWithTags, tagPuppies
+from waitlist import (
+    addToWaitlist, matchArrivals, removeFromWaitlist, takeNotifications,
+    withdrawMatches)
+from database_setup import (
+    Base, Shelter, Puppy, PuppyProfile, Adopter, puppies_adopters_table,
+    DATABASE_URL, DATABASE_READ_URL, dateToDays, daysToDate, gramsToPounds,
+    poundsToGrams)
+
+
+def setWriterPragmas(dbapi_connection, connection_record):
+    """Switch SQLite to WAL so readers never block the writer, or vice
+    versa"""
+    if isinstance(dbapi_connection, sqlite3.Connection):
+        dbapi_connection.execute("PRAGMA journal_mode=WAL")
+        # Let beginImmediate() issue BEGIN instead of the sqlite3 module
+        dbapi_connection.isolation_level = None
+
+
+def beginImmediate(connection):
+    """Take SQLite's write lock when a write transaction starts, not at its
+    first write. Otherwise two check-ins or adoptions can both read the same
+    occupancy and one update is lost (found by load_test.py)."""
+    if connection.dialect.name == 'sqlite':
+        connection.execute("BEGIN IMMEDIATE")
+
+
+def setReaderPragmas(dbapi_connection, connection_record):
+    """Make report connections read-only so they can never take the write
+    lock"""
+    if isinstance(dbapi_connection, sqlite3.Connection):
+        dbapi_connection.execute("PRAGMA query_only=ON")
+    else:
+        cursor = dbapi_connection.cursor()
+        cursor.execute(
+            "SET SESSION CHARACTERISTICS AS TRANSACTION READ ONLY")
+        cursor.close()
+        dbapi_connection.commit()
+
+
+def createWriterEngine(url, **kwargs):
+    """Engine for check-ins, adoptions and other mutations"""
+    writer = create_engine(url, **kwargs)
+    event.listen(writer, "connect", setWriterPragmas)
+    event.listen(writer, "begin", beginImmediate)
+    return writer
+
+
+def createReadEngine(url, pool_size=4, **kwargs):
+    """Pooled read-only engine for listings and reports"""
+    if url.startswith('sqlite'):
+        kwargs['connect_args'] = {'check_same_thread': False}
+    reader = create_engine(
+        url, poolclass=QueuePool, pool_size=pool_size, **kwargs)
+    event.listen(reader, "connect", setReaderPragmas)
+    return reader
+
+
+# Writer: check-ins, adoptions and other mutations go through this engine
+engine = createWriterEngine(DATABASE_URL, echo=True)
 Base.metadata.bind = engine
 
-DBSession = sessionmaker(bind=engine)
+# Readers: a pool of read-only connections used by listings and reports
+read_engine = createReadEngine(DATABASE_READ_URL, echo=True)
+
+
+# Writer transactions hold SQLite's write lock until they end, so keep objects
+# loaded after commit rather than starting a new transaction to reload them
+DBSession = sessionmaker(bind=engine, expire_on_commit=False)
 session = DBSession()
 
+# One read session per thread, so reports can run concurrently
+read_session = scoped_session(sessionmaker(bind=read_engine))
+
+
+def readOnly(report):
+    """Release the report's read connection back to the pool when it returns"""
+    @functools.wraps(report)
+    def wrapper(*args, **kwargs):
+        try:
+            return report(*args, **kwargs)
+        finally:
+            read_session.remove()
+    return wrapper
+
+
+# Report results, reused until the next write to the tracked tables bumps
+# the change_log version. SQLite only: PostgreSQL takes versions from a
+# sequence and commits them out of order, so a write can commit without
+# moving the latest version past one a cached result was read at.
+report_cache = ResultCache(max_entries=64)
+if read_engine.dialect.name == 'sqlite':
+    reportCache = cachedResult(
+        report_cache, lambda: currentVersion(read_session))
+else:
+    def reportCache(query):
+        return query
+
 
+@reportCache
+def puppiesByName():
+    """(id, name) of all puppies in ascending alphabetical order"""
+    return tuple(
+        read_session.query(Puppy.id, Puppy.name).order_by(Puppy.name))
+
+
+@readOnly
 def sortAscendingName():
-    """Query all puppies and return the results in ascending alphabetical order"""
-    puppies = session.query(Puppy).order_by(Puppy.name).all()
+    """Query all puppies and return the results in ascending alphabetical
+    order"""
+    puppies = puppiesByName()
 
     print "Sort Puppies by name alphabetically: \n"
 
-    for puppy in puppies:
-        print(puppy.id, puppy.name)
+    for puppy_id, name in puppies:
+        print(puppy_id, name)
 
     print "\n"
 
 
+@reportCache
+def puppiesBornAfter(date):
+    """(id, name, dateOfBirth) of puppies born after date, youngest first"""
+    # Columns rather than Puppy entities: no identity map or instance state
+    # per row (see memory_profile.py)
+    return tuple(
+        (puppy_id, name, daysToDate(birth_day))
+        for puppy_id, name, birth_day in read_session.query(
+            Puppy.id, Puppy.name, Puppy.birth_day).
+        filter(Puppy.dateOfBirth > date).order_by(desc(Puppy.dateOfBirth)))
+
+
+@readOnly
 def sortLessthanSixMonthsOld():
-    """Query all puppies that are less than six months old, sorted youngest to oldest"""
+    """Query all puppies that are less than six months old, sorted youngest
+    to oldest"""
     today = datetime.date.today()
     six_months_ago = today - datetime.timedelta(180)
 
-    puppies = session.query(Puppy).filter(Puppy.dateOfBirth > six_months_ago).\
-        order_by(desc(Puppy.dateOfBirth)).all()
+    puppies = puppiesBornAfter(six_months_ago)
 
     print "Sort Puppies less than 6 months old, youngest to oldest: \n"
 
-    for puppy in puppies:
-        print(puppy.id, puppy.name, puppy.dateOfBirth)
+    for puppy_id, name, date_of_birth in puppies:
+        print(puppy_id, name, date_of_birth)
 
     print "\n"
 
 
+@reportCache
+def puppiesByWeight():
+    """(id, name, weight) of all puppies, lightest first"""
+    return tuple(
+        (puppy_id, name, gramsToPounds(weight_grams))
+        for puppy_id, name, weight_grams in read_session.query(
+            Puppy.id, Puppy.name, Puppy.weight_grams).
+        order_by(Puppy.weight))
+
+
+@readOnly
 def sortAscendingWeight():
     """Query all puppies and return by ascending weight"""
-    puppies = session.query(Puppy).order_by(Puppy.weight).all()
+    puppies = puppiesByWeight()
 
     print "Sort Puppies by weight ascending \n"
 
-    for puppy in puppies:
-        print(puppy.id, puppy.name, puppy.weight)
+    for puppy_id, name, weight in puppies:
+        print(puppy_id, name, weight)
 
     print "\n"
 
 
+@reportCache
+def puppiesByShelter():
+    """(puppy_name, shelter_name) rows ordered by shelter, then puppy name"""
+    return tuple(read_session.query(
+        Puppy.name.label('puppy_name'), Shelter.name.label('shelter_name')).
+        filter(Puppy.shelter_id == Shelter.id).
+        order_by(Shelter.name, Puppy.name))
+
+
+@readOnly
 def groupByShelter():
     """Query all puppies and group by shelter name"""
-    puppies = session.query(
-        Puppy.name.label('puppy_name'), Shelter.name.label('shelter_name')).\
-        filter(Puppy.shelter_id == Shelter.id).order_by(Shelter.name, Puppy.name)
+    puppies = puppiesByShelter()
 
     print "Sort Puppies by shelter name ascending \n"
 
@@ -69,13 +213,21 @@ def groupByShelter():
     print "\n"
 
 
+@reportCache
+def puppiesWithProfiles():
+    """Puppy name and gender with their profile's picture, description and
+    special needs"""
+    return tuple(read_session.query(
+        Puppy.name, Puppy.gender, PuppyProfile.picture,
+        PuppyProfile.description, PuppyProfile.special_needs).
+        filter(Puppy.id == PuppyProfile.puppy_id))
+
+
+@readOnly
 def getPuppyAndProfile():
     """Using the one-to-one relationship, get puppy name, gender, picture,
     description, special needs from the puppy and puppy_profile tables"""
-    puppies = session.query(
-        Puppy.name, Puppy.gender, PuppyProfile.picture,
-        PuppyProfile.description, PuppyProfile.special_needs).\
-        filter(Puppy.id == PuppyProfile.puppy_id).all()
+    puppies = puppiesWithProfiles()
 
     print "Get Puppies and correlating Puppy Profiles (One-to-One)"
 
@@ -87,16 +239,81 @@ def getPuppyAndProfile():
     print "\n"
 
 
+@readOnly
+def findPuppy(name):
+    """Look up puppies by (possibly misspelled) name, ranked best first"""
+    candidates = findPuppiesByName(read_session, name)
+
+    print "Puppies matching %s: \n" % name
+
+    for score, puppy_id, puppy_name, gender, shelter_name in candidates:
+        print(puppy_id, puppy_name, gender, shelter_name, round(score, 2))
+
+    print "\n"
+
+
+@reportCache
+def puppiesWithTags(all_of, any_of, none_of):
+    """(id, name, gender, shelter_name) of puppies matching the tag filter
+    (see tag_index.puppyIdsWithTags), by id"""
+    puppy_ids = puppyIdsWithTags(read_session, all_of, any_of, none_of)
+
+    puppies = []
+    for start in range(0, len(puppy_ids), IN_BATCH):
+        puppies.extend(read_session.query(
+            Puppy.id, Puppy.name, Puppy.gender,
+            Shelter.name.label('shelter_name')).
+            outerjoin(Shelter, Puppy.shelter_id == Shelter.id).
+            filter(Puppy.id.in_(puppy_ids[start:start + IN_BATCH])).
+            order_by(Puppy.id))
+    return tuple(puppies)
+
+
+@readOnly
+def findTagged(all_of=(), any_of=(), none_of=()):
+    """Print puppies with all of, any of and none of the given tags"""
+    puppies = puppiesWithTags(tuple(all_of), tuple(any_of), tuple(none_of))
+
+    print "Puppies tagged all of %s, any of %s, none of %s: \n" % (
+        list(all_of), list(any_of), list(none_of))
+
+    for puppy in puppies:
+        print(puppy.id, puppy.name, puppy.gender, puppy.shelter_name)
+
+    print "\n"
+
+
+@readOnly
+def printChanges(cursor, limit):
+    """Print the change feed after version cursor"""
+    changes, next_cursor = changesSince(read_session, cursor, limit)
+
+    print "Changes since version %d: \n" % cursor
+
+    for change in changes:
+        print(change['version'], change['table'], change['key'],
+              change['operation'])
+
+    print "\nNext cursor: %d\n" % next_cursor
+
+
+def pruneChangeLog(keep):
+    """Delete change log entries older than the latest keep versions"""
+    deleted = pruneChanges(session, currentVersion(session) - keep + 1)
+
+    print "Pruned %d change log entries\n" % deleted
+
+
 def setupManyToMany():
     """Setup many-to-many relationship between Adopter(s) and Pupp(ies)"""
     # Puppies: "Bailey", "Max", "Charlie", "Buddy", "Rocky", "Jake", "Jack"
-    puppy_bailey = session.query(Puppy).filter_by(name='Bailey').first()
-    puppy_max = session.query(Puppy).filter_by(name='Max').one()
-    puppy_charlie = session.query(Puppy).filter_by(name='Charlie').one()
-    puppy_buddy = session.query(Puppy).filter_by(name='Buddy').one()
-    puppy_rocky = session.query(Puppy).filter_by(name='Rocky').one()
-    puppy_jake = session.query(Puppy).filter_by(name='Jake').one()
-    puppy_jack = session.query(Puppy).filter_by(name='Jack').one()
+    puppy_bailey = puppiesNamed(session, 'Bailey').first()
+    puppy_max = puppiesNamed(session, 'Max').one()
+    puppy_charlie = puppiesNamed(session, 'Charlie').one()
+    puppy_buddy = puppiesNamed(session, 'Buddy').one()
+    puppy_rocky = puppiesNamed(session, 'Rocky').one()
+    puppy_jake = puppiesNamed(session, 'Jake').one()
+    puppy_jack = puppiesNamed(session, 'Jack').one()
 
     adopter_james_smith = session.query(Adopter).\
         filter_by(first_name='James').one()
@@ -142,40 +359,53 @@ def setupManyToMany():
     print "\n"
 
 
-def createRandomAge():
+def createRandomAge(rng=random):
     """ Make a random age for each puppy between 0-18 months(approx.)
-        old from the day the algorithm was run."""
+        old from the day the algorithm was run. Pass a random.Random as
+        rng for a reproducible sequence."""
     today = datetime.date.today()
-    days_old = randint(0, 540)
+    days_old = rng.randint(0, 540)
     birthday = today - datetime.timedelta(days=days_old)
     return birthday
 
 
-def createRandomWeight():
+def createRandomWeight(rng=random):
     """Create a random weight between 1.0-40.0 pounds"""
-    return random.uniform(1.0, 40.0)
+    return rng.uniform(1.0, 40.0)
 
 
-def checkInPuppy(puppy_name, puppy_gender, puppy_dob, puppy_weight, shelter_id):
-    """Check in puppy only if a shelter has vacancy """
-    shelter = session.query(Shelter).get(shelter_id)
+def placePuppy(db_session, puppy_name, puppy_gender, puppy_dob, puppy_weight,
+               shelter_id):
+    """Add a puppy and its profile to shelter_id, or to the emptiest shelter
+    with vacancy if that one is full, without committing. Returns the new
+    Puppy, or None if every shelter is full.
+
+    The chosen shelter row is locked (SELECT ... FOR UPDATE) so concurrent
+    check-ins on PostgreSQL cannot both take its last spot. The fallback search
+    skips shelters locked by other check-ins instead of waiting on them.
+    SQLite ignores both clauses; its single writer already serializes us."""
+    shelter = db_session.query(Shelter).filter(Shelter.id == shelter_id).\
+        with_for_update().one()
 
     if(shelter.current_occupancy >= shelter.maximum_capacity):
         print shelter.name + " is full. Trying another shelter..."
 
-        shelter = session.query(Shelter).\
+        shelter = db_session.query(Shelter).\
             filter(Shelter.current_occupancy < Shelter.maximum_capacity).\
-            order_by(Shelter.current_occupancy).first()
+            order_by(Shelter.current_occupancy).\
+            with_for_update(skip_locked=True).first()
 
         if(shelter is None):
             print "All shelters are full. Please open more shelters."
-            return False
+            return None
 
     new_puppy = Puppy(
         name=puppy_name, gender=puppy_gender, dateOfBirth=puppy_dob,
-        shelter_id=shelter.id, weight=puppy_weight)
-    session.add(new_puppy)
-    session.commit()
+        shelter=shelter, weight=puppy_weight)
+    db_session.add(new_puppy)
+    # Flush to get the new id (INSERT ... RETURNING id on PostgreSQL) so the
+    # puppy, profile and occupancy land in one transaction
+    db_session.flush()
 
     new_profile = PuppyProfile(
         picture="No image",
@@ -185,10 +415,86 @@ def checkInPuppy(puppy_name, puppy_gender, puppy_dob, puppy_weight, shelter_id):
 
     shelter.current_occupancy = shelter.current_occupancy + 1
 
-    session.add(new_profile)
+    db_session.add(new_profile)
+    db_session.flush()
+
+    return new_puppy
+
+
+def placePuppies(db_session, puppies):
+    """Batch form of placePuppy for a list of (puppy_name, puppy_gender,
+    puppy_dob, puppy_weight, shelter_id) tuples, without committing.
+    Shelters are read and locked once, puppies and profiles go in as Core
+    inserts rather than ORM flushes, and each shelter gets one occupancy
+    update. Returns the new puppy's id, or False if every shelter was full,
+    for each entry in order."""
+    shelters = db_session.query(
+        Shelter.id, Shelter.current_occupancy, Shelter.maximum_capacity).\
+        with_for_update().all()
+    occupancy = dict((s.id, s.current_occupancy) for s in shelters)
+    capacity = dict((s.id, s.maximum_capacity) for s in shelters)
+    added = collections.Counter()
+
+    connection = db_session.connection()
+    results = []
+    profiles = []
+
+    for name, gender, dob, weight, shelter_id in puppies:
+        if shelter_id not in capacity:
+            raise ValueError("No shelter with id %s" % shelter_id)
+
+        if occupancy[shelter_id] >= capacity[shelter_id]:
+            vacant = [s_id for s_id in occupancy
+                      if occupancy[s_id] < capacity[s_id]]
+            if not vacant:
+                results.append(False)
+                continue
+            # The emptiest shelter, as placePuppy's fallback picks
+            shelter_id = min(vacant, key=lambda s_id: (occupancy[s_id], s_id))
+
+        puppy_id = connection.execute(
+            Puppy.__table__.insert(), name=name, gender=gender,
+            birth_day=dateToDays(dob), weight_grams=poundsToGrams(weight),
+            shelter_id=shelter_id).inserted_primary_key[0]
+        profiles.append({
+            'picture': "No image", 'description': "No description",
+            'special_needs': "No needs", 'puppy_id': puppy_id})
+
+        occupancy[shelter_id] += 1
+        added[shelter_id] += 1
+        results.append(puppy_id)
+
+    if profiles:
+        connection.execute(PuppyProfile.__table__.insert(), profiles)
+
+    for shelter_id, count in added.items():
+        db_session.query(Shelter).filter(Shelter.id == shelter_id).update(
+            {Shelter.current_occupancy: Shelter.current_occupancy + count},
+            synchronize_session=False)
+
+    # Core inserts skip the ORM events that maintain the name index and
+    # match the waitlist
+    indexNames(connection, [puppy[0] for puppy, p_id in zip(puppies, results)
+                            if p_id])
+    matchArrivals(connection, [p_id for p_id in results if p_id])
+
+    return results
+
+
+def checkInPuppy(puppy_name, puppy_gender, puppy_dob, puppy_weight,
+                 shelter_id):
+    """Check in puppy only if a shelter has vacancy """
+    new_puppy = placePuppy(
+        session, puppy_name, puppy_gender, puppy_dob, puppy_weight,
+        shelter_id)
+
+    if(new_puppy is None):
+        session.rollback()
+        return False
+
     session.commit()
 
-    print(new_puppy.name + " has been placed in " + shelter.name)
+    print(new_puppy.name + " has been placed in " + new_puppy.shelter.name)
 
 
 def checkInPuppies():
@@ -200,31 +506,203 @@ def checkInPuppies():
 
     print "Check in a dog in an already full facility"
     checkInPuppy("Test1", "male", createRandomAge(), createRandomWeight(), 2)
-    print session.query(exists().where(Puppy.name == "Test1")).scalar()  # False
+    # Should print False
+    print session.query(exists().where(Puppy.name == "Test1")).scalar()
     print "\n"
 
 
-def adoptPuppy(puppy_id, adopters_list):
-    """Adopt a puppy based on id. Remove it from shelter occupancy"""
-    puppy = session.query(Puppy).get(puppy_id)
+def tagPuppy(puppy_id, tags, remove=False):
+    """Add tags to a puppy (or remove them) and commit"""
+    changed = tagPuppies(session, [(puppy_id, tags)], present=not remove)
+    session.commit()
+
+    print "%d tags %s puppy %d" % (
+        changed, "removed from" if remove else "added to", puppy_id)
+
+
+def recordAdoption(db_session, puppy_id, adopters_list):
+    """Give a puppy its adopters, free its shelter spot and withdraw its
+    pending waitlist matches, without committing. Raises ValueError, with
+    nothing changed, if the puppy or an adopter doesn't exist or there are
+    no adopters. Returns the Puppy, and False if it was already adopted"""
+    if not adopters_list:
+        raise ValueError("No adopters for puppy %s" % puppy_id)
+
+    puppy = db_session.query(Puppy).get(puppy_id)
+    if puppy is None:
+        raise ValueError("No puppy with id %s" % puppy_id)
 
     if(len(puppy.adopters) > 0):
         print "%s is already adopted!" % puppy.name
-        return puppy
+        return puppy, False
+
+    adopters = dict(
+        (adopter.id, adopter) for adopter in db_session.query(Adopter).
+        filter(Adopter.id.in_(adopters_list)))
+    unknown = sorted(set(adopters_list) - set(adopters))
+    if unknown:
+        raise ValueError("No adopters with ids %s" % unknown)
 
     for a_id in adopters_list:
-        adopter = session.query(Adopter).get(a_id)
-        puppy.adopters.append(adopter)
+        puppy.adopters.append(adopters[a_id])
 
-    shelter = session.query(Shelter).get(puppy.shelter_id)
+    shelter = db_session.query(Shelter).\
+        filter(Shelter.id == puppy.shelter_id).with_for_update().one()
     shelter.current_occupancy = shelter.current_occupancy - 1
 
+    db_session.flush()
+    withdrawMatches(db_session.connection(), [puppy.id])
+
+    return puppy, True
+
+
+def adoptPuppy(puppy_id, adopters_list):
+    """Adopt a puppy based on id. Remove it from shelter occupancy"""
+    try:
+        puppy, adopted = recordAdoption(session, puppy_id, adopters_list)
+    except ValueError:
+        session.rollback()
+        raise
+
+    # Commit even when nothing changed, to release the write lock
     session.commit()
 
     return puppy
 
 
+def adoptPuppies(adoptions):
+    """Adopt many puppies at once from a list of (puppy_id, adopters_list)
+    pairs. Adoption status is checked in one query, the adopter rows go in as
+    one executemany, each shelter gets a single occupancy decrement, the
+    puppies' pending waitlist matches are withdrawn, and it all commits
+    once. A puppy listed twice keeps its last adopters list.
+    The puppies and their shelters are locked (on PostgreSQL) as in
+    recordAdoption. Raises ValueError, adopting none of them, if a puppy
+    doesn't exist or has no adopters. Returns the ids of the puppies
+    adopted."""
+    adoptions = collections.OrderedDict(adoptions)
+
+    empty = [p_id for p_id, adopters_list in adoptions.items()
+             if not adopters_list]
+    if empty:
+        raise ValueError("No adopters for puppies %s" % empty)
+
+    puppies = session.query(
+        Puppy.id, Puppy.name, Puppy.shelter_id,
+        Puppy.adopters.any().label('is_adopted')).\
+        filter(Puppy.id.in_(adoptions.keys())).\
+        order_by(Puppy.id).with_for_update().all()
+
+    unknown = sorted(set(adoptions) - set(puppy.id for puppy in puppies))
+    if unknown:
+        session.rollback()
+        raise ValueError("No puppies with ids %s" % unknown)
+
+    adopter_rows = []
+    released = collections.Counter()
+
+    for puppy in puppies:
+        if puppy.is_adopted:
+            print "%s is already adopted!" % puppy.name
+            continue
+
+        for a_id in adoptions[puppy.id]:
+            adopter_rows.append({'puppy_id': puppy.id, 'adopter_id': a_id})
+        released[puppy.shelter_id] += 1
+
+    if adopter_rows:
+        session.execute(puppies_adopters_table.insert(), adopter_rows)
+        withdrawMatches(session.connection(),
+                        sorted(set(row['puppy_id'] for row in adopter_rows)))
+
+    # Lock the shelters in id order so concurrent batches can't deadlock
+    if released:
+        session.query(Shelter.id).filter(Shelter.id.in_(released.keys())).\
+            order_by(Shelter.id).with_for_update().all()
+    for shelter_id, count in released.items():
+        session.query(Shelter).filter(Shelter.id == shelter_id).update(
+            {Shelter.current_occupancy: Shelter.current_occupancy - count},
+            synchronize_session=False)
+
+    session.commit()
+
+    return sorted(set(row['puppy_id'] for row in adopter_rows))
+
+
+def deletePuppies(db_session, criterion):
+    """Delete every puppy matching criterion (e.g. Puppy.id.in_(ids) or
+    Puppy.shelter_id == 3) in one DELETE, without committing and without
+    loading puppies or anything related to them. Profiles, adoptions and
+    tags go with them through ON DELETE CASCADE. Shelters get back the spots
+    their unadopted puppies held. Returns the ids deleted.
+
+    Puppy objects already loaded in db_session are not expunged."""
+    puppies = db_session.query(
+        Puppy.id, Puppy.shelter_id,
+        Puppy.adopters.any().label('is_adopted')).\
+        filter(criterion).with_for_update().all()
+    if not puppies:
+        return []
+
+    db_session.query(Puppy).filter(criterion).delete(
+        synchronize_session=False)
+
+    released = collections.Counter(
+        puppy.shelter_id for puppy in puppies
+        if puppy.shelter_id is not None and not puppy.is_adopted)
+    for shelter_id, count in released.items():
+        db_session.query(Shelter).filter(Shelter.id == shelter_id).update(
+            {Shelter.current_occupancy: Shelter.current_occupancy - count},
+            synchronize_session=False)
+
+    puppy_ids = [puppy.id for puppy in puppies]
+    # The tag bitmaps are not foreign keys, so they aren't cascaded
+    clearPuppies(db_session.connection(), puppy_ids)
+
+    return puppy_ids
+
+
+def removePuppies(puppy_ids):
+    """Delete puppies by id and commit"""
+    deleted = deletePuppies(session, Puppy.id.in_(puppy_ids))
+    session.commit()
+
+    print "Removed %d puppies" % len(deleted)
+
+
+def joinWaitlist(adopter_id, **criteria):
+    """Put an adopter on the waitlist (see addToWaitlist) and commit"""
+    entry = addToWaitlist(session, adopter_id, **criteria)
+    session.commit()
+
+    print "Adopter %d is waiting as entry %d" % (adopter_id, entry.id)
+
+
+def leaveWaitlist(entry_id):
+    """Remove a waitlist entry and commit"""
+    removed = removeFromWaitlist(session, entry_id)
+    session.commit()
+
+    print "Removed entry %d" % entry_id if removed else \
+        "No waitlist entry %d" % entry_id
+
+
+def notifyAdopters(limit):
+    """Print one batch of pending waitlist matches per adopter, then mark
+    them notified"""
+    notifications = takeNotifications(session, limit)
+
+    for adopter_id, matches in notifications.items():
+        print "Adopter %d: puppies %s" % (adopter_id, ", ".join(
+            "%d (entry %d)" % (puppy_id, entry_id)
+            for entry_id, puppy_id in matches))
+
+    session.commit()
+    print "%d adopters notified" % len(notifications)
+
+
 def checkAdoptPuppies():
+    """Have the Smiths adopt puppy 8 and show the shelter occupancy change"""
     id_1 = 8
 
     # Check shelter occupancies before:
@@ -252,7 +730,99 @@ def checkAdoptPuppies():
         puppy_1.name, shelter_1.name, shelter_1.current_occupancy))
 
 
+# Report processes in checkWriteLatencyUnderReports run at this niceness,
+# as a reporting worker would be deployed: on a machine with fewer cores
+# than processes, the CPU is shared and intake should win it
+REPORT_NICENESS = 10
+
+# Bound on the median check-in while reports run: this many times the idle
+# median, plus LATENCY_SLACK seconds for timer and scheduler noise
+LATENCY_FACTOR = 2
+LATENCY_SLACK = 0.005
+
+
+def checkWriteLatencyUnderReports(report_processes=4, check_ins=20):
+    """Time check-ins idle and while report processes keep running
+    groupByShelter and getPuppyAndProfile through the read pool. Raises
+    AssertionError if the loaded median exceeds LATENCY_FACTOR times the
+    idle median plus LATENCY_SLACK, i.e. if reports hold up writes."""
+    test_shelter = Shelter(
+        name="Latency Test Shelter", current_occupancy=0,
+        maximum_capacity=check_ins * 2)
+    session.add(test_shelter)
+    session.commit()
+
+    def timeCheckIns():
+        timings = []
+        for i in range(check_ins):
+            start = time.time()
+            checkInPuppy(
+                "Latency%d" % i, "male", createRandomAge(),
+                createRandomWeight(), test_shelter.id)
+            timings.append(time.time() - start)
+        timings.sort()
+        return timings[len(timings) // 2], timings[-1]
+
+    idle = timeCheckIns()
+
+    stop = multiprocessing.Event()
+    running = multiprocessing.Queue()
+
+    def runReports():
+        os.nice(REPORT_NICENESS)
+        sys.stdout = open(os.devnull, "w")
+        # Connections must not be shared with the parent process
+        read_engine.dispose()
+        first = True
+        while not stop.is_set():
+            report_cache.clear()
+            groupByShelter()
+            getPuppyAndProfile()
+            if first:
+                running.put(True)
+                first = False
+
+    readers = [multiprocessing.Process(target=runReports)
+               for i in range(report_processes)]
+    for reader in readers:
+        reader.start()
+
+    try:
+        # Time check-ins only once every report process is under way
+        for reader in readers:
+            running.get()
+        loaded = timeCheckIns()
+    finally:
+        stop.set()
+        for reader in readers:
+            reader.join()
+
+    # Remove the test puppies so the scenario can be rerun
+    test_ids = session.query(Puppy.id).\
+        filter(Puppy.shelter_id == test_shelter.id).subquery()
+    session.query(PuppyProfile).\
+        filter(PuppyProfile.puppy_id.in_(test_ids)).\
+        delete(synchronize_session=False)
+    session.query(Puppy).filter(Puppy.shelter_id == test_shelter.id).\
+        delete(synchronize_session=False)
+    session.delete(test_shelter)
+    session.commit()
+
+    print "Check-in latency, idle: median %.4fs, max %.4fs" % idle
+    print "Check-in latency, %d report processes: median %.4fs, max %.4fs" % (
+        (report_processes,) + loaded)
+    print "\n"
+
+    bound = idle[0] * LATENCY_FACTOR + LATENCY_SLACK
+    if loaded[0] > bound:
+        raise AssertionError(
+            "Median check-in took %.4fs under reports, over the %.4fs bound "
+            "(%d x idle + %.3fs)" % (
+                loaded[0], bound, LATENCY_FACTOR, LATENCY_SLACK))
+
+
 def executeQueries():
+    """Run the demo scenarios enabled below"""
     # sortAscendingName()
     # sortLessthanSixMonthsOld()
     # sortAscendingWeight()
@@ -261,5 +831,174 @@ def executeQueries():
     # setupManyToMany()
     checkInPuppies()
     # checkAdoptPuppies()
-
-executeQueries()
+    # checkWriteLatencyUnderReports()
+
+
+def parseDate(value):
+    """argparse type for YYYY-MM-DD dates"""
+    return datetime.datetime.strptime(value, "%Y-%m-%d").date()
+
+
+def parseAdoption(value):
+    """argparse type for PUPPY_ID:ADOPTER_ID[,ADOPTER_ID...]"""
+    puppy_id, adopter_ids = value.split(":")
+    return int(puppy_id), [int(a_id) for a_id in adopter_ids.split(",")]
+
+
+def main(argv=None):
+    """Command-line entry point: run one report or mutation, optionally
+    repeated and profiled"""
+    parser = argparse.ArgumentParser(
+        description="Uda County puppy shelter queries")
+    parser.add_argument(
+        "--repeat", type=parseRepeat, default=1, metavar="N",
+        help="run the command N times and report timings")
+    parser.add_argument(
+        "--profile", action="store_true",
+        help="write cProfile stats and collapsed stacks for the run")
+    parser.add_argument(
+        "--profile-dir", default="profiles",
+        help="directory for profile output (default: profiles)")
+    parser.add_argument(
+        "--echo", action="store_true", help="log emitted SQL")
+    parser.add_argument(
+        "--cache-stats", action="store_true",
+        help="print report cache hits and misses after the runs")
+    commands = parser.add_subparsers(dest="command")
+
+    reports = [
+        ("sort-name", sortAscendingName, "puppies by name"),
+        ("sort-young", sortLessthanSixMonthsOld,
+         "puppies under six months, youngest first"),
+        ("sort-weight", sortAscendingWeight, "puppies by weight"),
+        ("group-by-shelter", groupByShelter, "puppies grouped by shelter"),
+        ("profiles", getPuppyAndProfile, "puppies with their profiles"),
+        ("many-to-many", setupManyToMany, "adopter/puppy many-to-many demo"),
+        ("scenarios", executeQueries, "demo scenarios in executeQueries()"),
+        ("write-latency", checkWriteLatencyUnderReports,
+         "check-in latency while reports run")]
+    for name, func, help_text in reports:
+        commands.add_parser(name, help=help_text).set_defaults(func=func)
+
+    check_in = commands.add_parser("check-in", help="check in a puppy")
+    check_in.add_argument("name")
+    check_in.add_argument("gender", choices=["male", "female"])
+    check_in.add_argument("shelter_id", type=int)
+    check_in.add_argument(
+        "--dob", type=parseDate, help="date of birth, YYYY-MM-DD "
+        "(default: random)")
+    check_in.add_argument(
+        "--weight", type=float, help="weight in pounds (default: random)")
+    check_in.set_defaults(func=lambda: checkInPuppy(
+        args.name, args.gender, args.dob or createRandomAge(),
+        createRandomWeight() if args.weight is None else args.weight,
+        args.shelter_id))
+
+    adopt = commands.add_parser("adopt", help="adopt a puppy")
+    adopt.add_argument("puppy_id", type=int)
+    adopt.add_argument("adopter_ids", type=int, nargs="+")
+    adopt.set_defaults(
+        func=lambda: adoptPuppy(args.puppy_id, args.adopter_ids))
+
+    find = commands.add_parser(
+        "find", help="look up puppies by name, tolerating typos")
+    find.add_argument("name")
+    find.set_defaults(func=lambda: findPuppy(args.name))
+
+    changes = commands.add_parser(
+        "changes", help="change feed for puppies, profiles and shelters")
+    changes.add_argument(
+        "--since", type=int, default=0, metavar="VERSION",
+        help="cursor returned by the previous call (default: 0)")
+    changes.add_argument("--limit", type=int, default=1000)
+    changes.set_defaults(func=lambda: printChanges(args.since, args.limit))
+
+    prune = commands.add_parser(
+        "prune-changes", help="delete change log entries consumers no "
+        "longer need")
+    prune.add_argument(
+        "--keep", type=int, default=CHANGE_RETENTION, metavar="VERSIONS",
+        help="latest versions to keep (default: %d)" % CHANGE_RETENTION)
+    prune.set_defaults(func=lambda: pruneChangeLog(args.keep))
+
+    adopt_many = commands.add_parser(
+        "adopt-many", help="adopt several puppies in one transaction")
+    adopt_many.add_argument(
+        "adoptions", type=parseAdoption, nargs="+",
+        metavar="PUPPY_ID:ADOPTER_ID[,ADOPTER_ID...]")
+    adopt_many.set_defaults(func=lambda: adoptPuppies(args.adoptions))
+
+    remove = commands.add_parser(
+        "remove", help="delete puppies with their profiles and adoptions")
+    remove.add_argument("puppy_ids", type=int, nargs="+")
+    remove.set_defaults(func=lambda: removePuppies(args.puppy_ids))
+
+    tagged = commands.add_parser(
+        "tagged", help="puppies matching a tag filter")
+    tagged.add_argument(
+        "--all", action="append", default=[], metavar="TAG",
+        help="puppies must have this tag (repeatable)")
+    tagged.add_argument(
+        "--any", action="append", default=[], metavar="TAG",
+        help="puppies must have at least one of these tags (repeatable)")
+    tagged.add_argument(
+        "--not", action="append", default=[], metavar="TAG",
+        dest="none", help="puppies must not have this tag (repeatable)")
+    tagged.set_defaults(
+        func=lambda: findTagged(args.all, args.any, args.none))
+
+    tag = commands.add_parser("tag", help="tag a puppy")
+    tag.add_argument("puppy_id", type=int)
+    tag.add_argument("tags", nargs="+", metavar="TAG")
+    tag.add_argument(
+        "--remove", action="store_true", help="remove the tags instead")
+    tag.set_defaults(
+        func=lambda: tagPuppy(args.puppy_id, args.tags, args.remove))
+
+    wait = commands.add_parser(
+        "waitlist", help="wait for a kind of puppy to be checked in")
+    wait.add_argument("adopter_id", type=int)
+    wait.add_argument("--gender", choices=["male", "female"])
+    wait.add_argument("--min-age", type=int, metavar="DAYS")
+    wait.add_argument("--max-age", type=int, metavar="DAYS")
+    wait.add_argument("--min-weight", type=float, metavar="POUNDS")
+    wait.add_argument("--max-weight", type=float, metavar="POUNDS")
+    location = wait.add_mutually_exclusive_group()
+    location.add_argument("--shelter", type=int, metavar="SHELTER_ID")
+    location.add_argument("--city")
+    wait.set_defaults(func=lambda: joinWaitlist(
+        args.adopter_id, gender=args.gender, min_age_days=args.min_age,
+        max_age_days=args.max_age, min_weight=args.min_weight,
+        max_weight=args.max_weight, shelter_id=args.shelter, city=args.city))
+
+    unwait = commands.add_parser(
+        "unwaitlist", help="remove a waitlist entry")
+    unwait.add_argument("entry_id", type=int)
+    unwait.set_defaults(func=lambda: leaveWaitlist(args.entry_id))
+
+    notify = commands.add_parser(
+        "notify", help="send pending waitlist matches as one batch")
+    notify.add_argument("--limit", type=int, default=1000)
+    notify.set_defaults(func=lambda: notifyAdopters(args.limit))
+
+    args = parser.parse_args(argv)
+
+    engine.echo = args.echo
+    read_engine.echo = args.echo
+
+    if args.profile:
+        timings = profileRuns(
+            args.func, args.command, args.repeat, args.profile_dir)
+    else:
+        timings = timeRuns(args.func, args.repeat)
+
+    printTimings(args.command, timings)
+
+    if args.cache_stats:
+        print("Report cache: %(hits)d hits, %(misses)d misses, "
+              "%(evictions)d evictions, %(entries)d entries" %
+              report_cache.stats())
+
+
+if __name__ == '__main__':
+    main()
@@ -1,15 +1,152 @@
 # Configuration code
-from sqlalchemy import Column, create_engine, ForeignKey, Integer, String, Date, Numeric, Table
+import datetime
+import os
+import sqlite3
+
+from sqlalchemy import (
+    BigInteger, Boolean, Column, create_engine, event, ForeignKey, func,
+    Index, inspect, Integer, LargeBinary, String, Table, UniqueConstraint)
+from sqlalchemy.engine import Engine
 from sqlalchemy.ext.declarative import declarative_base
+from sqlalchemy.ext.hybrid import Comparator, hybrid_property
 from sqlalchemy.orm import relationship
 
 Base = declarative_base()
 
+# Puppy weights and birth dates are stored as plain integers (grams and days
+# since EPOCH), which SQLite reads and compares natively
+GRAMS_PER_POUND = 453.59237
+EPOCH = datetime.date(1970, 1, 1)
+
+
+def poundsToGrams(pounds):
+    return None if pounds is None else int(round(
+        float(pounds) * GRAMS_PER_POUND))
+
+
+def gramsToPounds(grams):
+    return None if grams is None else grams / GRAMS_PER_POUND
+
+
+def dateToDays(date):
+    return None if date is None else (date - EPOCH).days
+
+
+def daysToDate(days):
+    return None if days is None else EPOCH + datetime.timedelta(days=days)
+
+
+class ConvertingComparator(Comparator):
+    """Compare an integer storage column against Python-side values
+    (pounds, dates) by converting the values, not the column, so indexes on
+    the column still apply"""
+
+    def __init__(self, expression, convert):
+        super(ConvertingComparator, self).__init__(expression)
+        self.convert = convert
+
+    def _convert(self, value):
+        if isinstance(value, (list, tuple)):  # in_()
+            return [self.convert(v) for v in value]
+        return self.convert(value)
+
+    def operate(self, op, *other, **kwargs):
+        return op(
+            self.expression, *[self._convert(o) for o in other], **kwargs)
+
+    def reverse_operate(self, op, other, **kwargs):
+        return op(self._convert(other), self.expression, **kwargs)
+
+
 # Associative Table for many-to-many relationship (Puppy and Adopter)
 puppies_adopters_table = Table(
     'puppies_adopters', Base.metadata,
-    Column('puppy_id', ForeignKey('puppy.id'), primary_key=True),
-    Column('adopter_id', ForeignKey('adopter.id'), primary_key=True))
+    Column('puppy_id', ForeignKey('puppy.id', ondelete='CASCADE'),
+           primary_key=True),
+    Column('adopter_id', ForeignKey('adopter.id', ondelete='CASCADE'),
+           primary_key=True, index=True))
+
+# Associative Table for many-to-many relationship (Puppy and Tag)
+puppy_tags_table = Table(
+    'puppy_tags', Base.metadata,
+    Column('puppy_id', ForeignKey('puppy.id', ondelete='CASCADE'),
+           primary_key=True),
+    Column('tag_id', ForeignKey('tag.id', ondelete='CASCADE'),
+           primary_key=True, index=True))
+
+# Inverted index over puppy_tags (see tag_index.py): per tag, one
+# zlib-compressed bitmap of puppy ids for each block of CHUNK_BITS ids
+puppy_tag_postings_table = Table(
+    'puppy_tag_posting', Base.metadata,
+    Column('tag_id', ForeignKey('tag.id', ondelete='CASCADE'),
+           primary_key=True),
+    Column('chunk', Integer, primary_key=True),
+    Column('bitmap', LargeBinary, nullable=False))
+
+# Trigram index over distinct lower-cased puppy names, for fuzzy name lookup
+# (see name_lookup.py)
+puppy_name_trigrams_table = Table(
+    'puppy_name_trigram', Base.metadata,
+    Column('trigram', String(3), primary_key=True),
+    Column('name_key', String(80), primary_key=True, index=True))
+
+# Waitlist entries matched by newly checked-in puppies (see waitlist.py),
+# kept until the adopter has been notified
+waitlist_matches_table = Table(
+    'waitlist_match', Base.metadata,
+    Column('id', Integer, primary_key=True),
+    Column('entry_id', ForeignKey('waitlist_entry.id', ondelete='CASCADE'),
+           nullable=False),
+    Column('puppy_id', ForeignKey('puppy.id', ondelete='CASCADE'),
+           nullable=False, index=True),
+    Column('notified', Boolean, nullable=False, default=False, index=True),
+    UniqueConstraint('entry_id', 'puppy_id'))
+
+# Occupancy time series (see occupancy.py). A trigger on shelter records
+# every change to current_occupancy as an event; rollUpOccupancy() folds
+# the events into per-shelter hourly and daily counts and deletes them.
+occupancy_events_table = Table(
+    'occupancy_event', Base.metadata,
+    Column('id', Integer, primary_key=True),
+    Column('shelter_id', Integer, nullable=False),
+    Column('at', BigInteger, nullable=False),  # Unix time in seconds
+    Column('delta', Integer, nullable=False))
+
+occupancy_hourly_table = Table(
+    'occupancy_hourly', Base.metadata,
+    Column('shelter_id', ForeignKey('shelter.id', ondelete='CASCADE'),
+           primary_key=True),
+    Column('hour', Integer, primary_key=True),  # hours since EPOCH (UTC)
+    Column('arrivals', Integer, nullable=False),
+    Column('departures', Integer, nullable=False))
+
+occupancy_daily_table = Table(
+    'occupancy_daily', Base.metadata,
+    Column('shelter_id', ForeignKey('shelter.id', ondelete='CASCADE'),
+           primary_key=True),
+    Column('day', Integer, primary_key=True),  # days since EPOCH (UTC)
+    Column('arrivals', Integer, nullable=False),
+    Column('departures', Integer, nullable=False))
+
+# Change-data-capture log (see change_feed.py). Database triggers append one
+# row per insert, update or delete on the CHANGE_TRACKED tables, so every
+# write path is covered, including Core statements and COPY.
+change_log_table = Table(
+    'change_log', Base.metadata,
+    Column('version', Integer, primary_key=True),
+    Column('table_name', String(40), nullable=False),
+    Column('row_key', String(40), nullable=False),
+    Column('operation', String(6), nullable=False),
+    sqlite_autoincrement=True)
+
+# Tracked table -> SQL expression for a row's key (prefixed NEW./OLD. below)
+CHANGE_TRACKED = [
+    ('shelter', "{row}.id"),
+    ('puppy', "{row}.id"),
+    ('puppy_profile', "{row}.id"),
+    ('puppies_adopters', "{row}.puppy_id || ':' || {row}.adopter_id"),
+    ('puppy_tags', "{row}.puppy_id || ':' || {row}.tag_id"),
+    ('tag', "{row}.id")]
 
 
 # Class Code
@@ -19,6 +156,7 @@ class Shelter(Base):
     name = Column(String(80), nullable=False)
     address = Column(String(250))
     city = Column(String(80))
+    county = Column(String(80))
     state = Column(String(20))
     zipCode = Column(String(10))
     website = Column(String)
@@ -31,20 +169,60 @@ class Puppy(Base):
     id = Column(Integer, primary_key=True)
     name = Column(String(80), nullable=False)
     gender = Column(String(6), nullable=False)
-    dateOfBirth = Column(Date)
+    birth_day = Column(Integer, index=True)
     # picture = Column(String)
-    weight = Column(Numeric(10))
+    weight_grams = Column(Integer)
 
     shelter_id = Column(Integer, ForeignKey('shelter.id'))
     shelter = relationship(Shelter)
 
-    # One-to-One relationship with PuppyProfile(.puppy)
+    # One-to-One relationship with PuppyProfile(.puppy). Deleting a puppy
+    # leaves its profile, adoptions and tags to the database's ON DELETE
+    # CASCADE rather than loading them first (passive_deletes)
     profile = relationship(
-        "PuppyProfile", uselist=False, back_populates="puppy")
+        "PuppyProfile", uselist=False, back_populates="puppy",
+        cascade="all", passive_deletes=True)
 
     # Many-to-Many relationship with Adopter(.puppies)
     adopters = relationship(
-        "Adopter", secondary=puppies_adopters_table, back_populates='puppies')
+        "Adopter", secondary=puppies_adopters_table, back_populates='puppies',
+        passive_deletes=True)
+
+    # Many-to-Many relationship with Tag(.puppies)
+    tags = relationship(
+        "Tag", secondary=puppy_tags_table, back_populates='puppies',
+        passive_deletes=True)
+
+    # Case-insensitive exact name lookups, on the same key as
+    # name_lookup.nameKey()
+    __table_args__ = (
+        Index('ix_puppy_name_key', func.lower(func.trim(name))),)
+
+    @hybrid_property
+    def dateOfBirth(self):
+        """Date of birth, stored as days since EPOCH in birth_day"""
+        return daysToDate(self.birth_day)
+
+    @dateOfBirth.setter
+    def dateOfBirth(self, date):
+        self.birth_day = dateToDays(date)
+
+    @dateOfBirth.comparator
+    def dateOfBirth(cls):
+        return ConvertingComparator(cls.birth_day, dateToDays)
+
+    @hybrid_property
+    def weight(self):
+        """Weight in pounds, stored as whole grams in weight_grams"""
+        return gramsToPounds(self.weight_grams)
+
+    @weight.setter
+    def weight(self, pounds):
+        self.weight_grams = poundsToGrams(pounds)
+
+    @weight.comparator
+    def weight(cls):
+        return ConvertingComparator(cls.weight_grams, poundsToGrams)
 
 
 class PuppyProfile(Base):
@@ -54,7 +232,17 @@ class PuppyProfile(Base):
     description = Column(String)
     special_needs = Column(String)
 
-    puppy_id = Column(Integer, ForeignKey('puppy.id'))
+    # Derived picture sizes from image_pipeline.py: JSON {size name: path},
+    # where sizes wider than the picture point at the picture itself,
+    # plus the source hash and "size:mtime" stamp used for incremental runs
+    picture_variants = Column(String)
+    picture_hash = Column(String(64))
+    picture_stat = Column(String(40))
+
+    # Indexed so cascades (and SQLite's foreign key checks) on puppy deletes
+    # don't scan every profile
+    puppy_id = Column(
+        Integer, ForeignKey('puppy.id', ondelete='CASCADE'), index=True)
     puppy = relationship("Puppy", back_populates="profile")
 
 
@@ -66,15 +254,173 @@ class Adopter(Base):
 
     # Many-to-Many relationship with Puppy(.adopters)
     puppies = relationship(
-        'Puppy', secondary=puppies_adopters_table, back_populates='adopters')
+        'Puppy', secondary=puppies_adopters_table, back_populates='adopters',
+        passive_deletes=True)
 
     def __init__(self, first_name, last_name):
         self.first_name = first_name
         self.last_name = last_name
 
 
-# Determine which DB to communicate with...
-engine = create_engine('sqlite:///puppyshelter.db')
+class Tag(Base):
+    __tablename__ = 'tag'
+    id = Column(Integer, primary_key=True)
+    name = Column(String(50), nullable=False, unique=True)
+
+    # Many-to-Many relationship with Puppy(.tags)
+    puppies = relationship(
+        'Puppy', secondary=puppy_tags_table, back_populates='tags',
+        passive_deletes=True)
+
+    def __init__(self, name):
+        self.name = name
+
+
+class WaitlistEntry(Base):
+    """An adopter's standing request for a kind of puppy. Criteria left
+    unset match any puppy; ages are in days on the day of check-in"""
+    __tablename__ = 'waitlist_entry'
+    id = Column(Integer, primary_key=True)
+    adopter_id = Column(
+        Integer, ForeignKey('adopter.id', ondelete='CASCADE'),
+        nullable=False, index=True)
+    gender = Column(String(6))
+    min_age_days = Column(Integer)
+    max_age_days = Column(Integer)
+    min_weight_grams = Column(Integer)
+    max_weight_grams = Column(Integer)
+    # At most one of these: a particular shelter, or any shelter in a city
+    shelter_id = Column(Integer, ForeignKey('shelter.id'))
+    city = Column(String(80))
+
+    adopter = relationship(Adopter)
+
+    # Ids are never reused, so waitlist.py can tell from the count and the
+    # highest id whether entries were added or removed
+    __table_args__ = {'sqlite_autoincrement': True}
+
+
+# Determine which DB to communicate with. Defaults to the local SQLite file;
+# set DATABASE_URL (e.g. postgresql://vagrant@/puppyshelter) to use PostgreSQL
+DATABASE_URL = os.environ.get('DATABASE_URL', 'sqlite:///puppyshelter.db')
+
+# Reports and listings read through their own connections. Point
+# DATABASE_READ_URL at a replica to move them off the primary entirely.
+DATABASE_READ_URL = os.environ.get('DATABASE_READ_URL', DATABASE_URL)
+
+
+@event.listens_for(Engine, 'connect')
+def enableForeignKeys(dbapi_connection, connection_record):
+    """SQLite only enforces foreign keys, and so runs their ON DELETE
+    CASCADE actions, when asked to on each connection"""
+    if isinstance(dbapi_connection, sqlite3.Connection):
+        dbapi_connection.execute("PRAGMA foreign_keys=ON")
+
+
+engine = create_engine(DATABASE_URL)
+
+
+def createPostgresTrigger(connection, table_name, name, definition):
+    """CREATE TRIGGER name definition, unless table_name already has it.
+    Creating (or dropping) a trigger locks the table against writes, so
+    this runs only when it is missing, not every time a script starts.
+    A DO block isn't recognised as DDL, so ask for it to be committed."""
+    connection.execution_options(autocommit=True).execute(
+        "DO $$ BEGIN IF NOT EXISTS (SELECT 1 FROM pg_trigger "
+        "WHERE tgname = '{name}' AND tgrelid = '{table}'::regclass) THEN "
+        "CREATE TRIGGER {name} {definition}; END IF; END $$".format(
+            name=name, table=table_name, definition=definition))
+
+
+def createChangeTriggers(target, connection, **kw):
+    """Install the change_log triggers. Runs after every create_all() and
+    only creates what is missing."""
+    if connection.dialect.name == 'sqlite':
+        for table_name, key in CHANGE_TRACKED:
+            for operation in ('insert', 'update', 'delete'):
+                row = 'OLD' if operation == 'delete' else 'NEW'
+                connection.execute(
+                    "CREATE TRIGGER IF NOT EXISTS {table}_{op}_change "
+                    "AFTER {op} ON {table} BEGIN "
+                    "INSERT INTO change_log (table_name, row_key, operation) "
+                    "VALUES ('{table}', {key}, '{op}'); END".format(
+                        table=table_name, op=operation,
+                        key=key.format(row=row)))
+
+    elif connection.dialect.name == 'postgresql':
+        # One function per table: plpgsql fails on r.id for rows without it
+        for table_name, key in CHANGE_TRACKED:
+            connection.execute(
+                "CREATE OR REPLACE FUNCTION {table}_change() "
+                "RETURNS trigger AS $$ DECLARE r RECORD; BEGIN "
+                "IF TG_OP = 'DELETE' THEN r := OLD; ELSE r := NEW; END IF; "
+                "INSERT INTO change_log (table_name, row_key, operation) "
+                "VALUES ('{table}', {key}, lower(TG_OP)); "
+                "RETURN NULL; END; $$ LANGUAGE plpgsql".format(
+                    table=table_name, key=key.format(row='r')))
+            createPostgresTrigger(
+                connection, table_name, '{table}_change'.format(
+                    table=table_name),
+                "AFTER INSERT OR UPDATE OR DELETE ON {table} "
+                "FOR EACH ROW EXECUTE PROCEDURE {table}_change()".format(
+                    table=table_name))
+
+
+event.listen(Base.metadata, 'after_create', createChangeTriggers)
+
+
+def createOccupancyTriggers(target, connection, **kw):
+    """Record each change to a shelter's current_occupancy, whichever code
+    path makes it, in occupancy_event"""
+    if connection.dialect.name == 'sqlite':
+        connection.execute(
+            "CREATE TRIGGER IF NOT EXISTS shelter_occupancy_event "
+            "AFTER UPDATE OF current_occupancy ON shelter "
+            "WHEN NEW.current_occupancy != OLD.current_occupancy BEGIN "
+            "INSERT INTO occupancy_event (shelter_id, at, delta) "
+            "VALUES (NEW.id, CAST(strftime('%s', 'now') AS INTEGER), "
+            "NEW.current_occupancy - OLD.current_occupancy); END")
+
+    elif connection.dialect.name == 'postgresql':
+        connection.execute(
+            "CREATE OR REPLACE FUNCTION shelter_occupancy_event() "
+            "RETURNS trigger AS $$ BEGIN "
+            "INSERT INTO occupancy_event (shelter_id, at, delta) "
+            "VALUES (NEW.id, extract(epoch FROM now())::bigint, "
+            "NEW.current_occupancy - OLD.current_occupancy); "
+            "RETURN NULL; END; $$ LANGUAGE plpgsql")
+        createPostgresTrigger(
+            connection, 'shelter', 'shelter_occupancy_event',
+            "AFTER UPDATE OF current_occupancy ON shelter FOR EACH ROW "
+            "WHEN (NEW.current_occupancy IS DISTINCT FROM "
+            "OLD.current_occupancy) "
+            "EXECUTE PROCEDURE shelter_occupancy_event()")
+
+
+event.listen(Base.metadata, 'after_create', createOccupancyTriggers)
+
+
+def addMissingColumns(engine):
+    """Add columns defined above but missing from an existing database.
+    create_all() only creates whole tables, so without this older databases
+    never pick up new nullable columns"""
+    inspector = inspect(engine)
+    tables = set(inspector.get_table_names())
+
+    for table in Base.metadata.sorted_tables:
+        if table.name not in tables:
+            continue
+
+        existing = set(c['name'] for c in inspector.get_columns(table.name))
+
+        for column in table.columns:
+            if column.name not in existing and column.nullable:
+                engine.execute('ALTER TABLE %s ADD COLUMN %s %s' % (
+                    table.name, engine.dialect.identifier_preparer.quote(
+                        column.name),
+                    column.type.compile(dialect=engine.dialect)))
+
 
 # Bind engine to the Base class
 Base.metadata.create_all(engine)
+addMissingColumns(engine)
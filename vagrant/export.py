@@ -0,0 +1,154 @@
+import argparse
+import csv
+import json
+import resource
+import sys
+import time
+
+from sqlalchemy import select
+
+import database_queries
+from database_setup import (
+    daysToDate, gramsToPounds, Puppy, PuppyProfile, Shelter)
+
+# Field names, in output order, with the column each comes from
+LISTING_COLUMNS = [
+    ('puppy_id', Puppy.id),
+    ('name', Puppy.name),
+    ('gender', Puppy.gender),
+    ('date_of_birth', Puppy.birth_day),
+    ('weight_pounds', Puppy.weight_grams),
+    ('shelter_id', Shelter.id),
+    ('shelter_name', Shelter.name),
+    ('shelter_city', Shelter.city),
+    ('shelter_state', Shelter.state),
+    ('shelter_website', Shelter.website),
+    ('picture', PuppyProfile.picture),
+    ('description', PuppyProfile.description),
+    ('special_needs', PuppyProfile.special_needs),
+]
+FIELDS = [name for name, column in LISTING_COLUMNS]
+DATE_OF_BIRTH = FIELDS.index('date_of_birth')
+WEIGHT = FIELDS.index('weight_pounds')
+
+# Rows fetched from the cursor, and written, at a time
+CHUNK_SIZE = 5000
+
+# Bytes buffered before each write to the output file
+WRITE_BUFFER = 1 << 20
+
+
+def listingQuery():
+    """Every puppy with its shelter and profile, by puppy id"""
+    return select([column for name, column in LISTING_COLUMNS]).\
+        select_from(Puppy.__table__.
+                    outerjoin(Shelter.__table__,
+                              Puppy.shelter_id == Shelter.id).
+                    outerjoin(PuppyProfile.__table__,
+                              PuppyProfile.puppy_id == Puppy.id)).\
+        order_by(Puppy.id)
+
+
+def listingChunks(connection, chunk_size=CHUNK_SIZE):
+    """Yield listings chunk_size rows at a time as lists of value lists,
+    dates as YYYY-MM-DD and weights in pounds. Uses a server-side cursor
+    (stream_results) where the driver has one, so only a chunk is ever held
+    in memory; SQLite's cursor already steps through rows lazily."""
+    result = connection.execution_options(stream_results=True).execute(
+        listingQuery())
+    try:
+        while True:
+            rows = result.fetchmany(chunk_size)
+            if not rows:
+                break
+
+            chunk = []
+            for row in rows:
+                values = list(row)
+                born = daysToDate(values[DATE_OF_BIRTH])
+                values[DATE_OF_BIRTH] = born and born.isoformat()
+                pounds = gramsToPounds(values[WEIGHT])
+                values[WEIGHT] = None if pounds is None else round(pounds, 2)
+                chunk.append(values)
+            yield chunk
+    finally:
+        result.close()
+
+
+def writeJsonLines(out, chunks):
+    """One JSON object per listing per line"""
+    encode = json.JSONEncoder(separators=(',', ':')).encode
+    template = '{' + ','.join(
+        '%s:%%s' % encode(name) for name in FIELDS) + '}\n'
+
+    for chunk in chunks:
+        # Formatting pre-encoded fields into a fixed template skips building
+        # a dict per row
+        out.write(''.join(
+            template % tuple(encode(value) for value in values)
+            for values in chunk))
+        yield len(chunk)
+
+
+def writeCsv(out, chunks):
+    """A header row, then one row per listing, UTF-8 encoded"""
+    writer = csv.writer(out)
+    writer.writerow(FIELDS)
+
+    for chunk in chunks:
+        writer.writerows(
+            [value.encode('utf-8') if isinstance(value, unicode) else value
+             for value in values] for values in chunk)
+        yield len(chunk)
+
+
+FORMATS = {
+    'jsonl': writeJsonLines,
+    'csv': writeCsv,
+}
+
+
+def exportListings(output, output_format='jsonl', chunk_size=CHUNK_SIZE):
+    """Stream every listing to the file named output ('-' for stdout) in
+    output_format. Returns the number of rows written."""
+    if output == '-':
+        out = sys.stdout
+    else:
+        out = open(output, 'wb', WRITE_BUFFER)
+
+    connection = database_queries.read_engine.connect()
+    chunks = listingChunks(connection, chunk_size)
+    rows = 0
+    try:
+        for count in FORMATS[output_format](out, chunks):
+            rows += count
+    finally:
+        connection.close()
+        if out is not sys.stdout:
+            out.close()
+
+    return rows
+
+
+if __name__ == '__main__':
+    parser = argparse.ArgumentParser(
+        description="Stream puppy listings with shelter and profile data")
+    parser.add_argument("format", choices=sorted(FORMATS))
+    parser.add_argument(
+        "--output", default='-',
+        help="file to write (default: stdout)")
+    parser.add_argument(
+        "--chunk-size", type=int, default=CHUNK_SIZE,
+        help="rows fetched and written at a time (default: %d)" % CHUNK_SIZE)
+    args = parser.parse_args()
+
+    database_queries.read_engine.echo = False
+
+    start = time.time()
+    rows = exportListings(args.output, args.format, args.chunk_size)
+    elapsed = time.time() - start
+
+    # Progress goes to stderr so stdout can carry the export itself
+    sys.stderr.write("%d listings in %.2fs (%d rows/s), peak RSS %.1f MB\n" % (
+        rows, elapsed, rows / elapsed if elapsed else 0,
+        resource.getrusage(resource.RUSAGE_SELF).ru_maxrss / 1024.0))
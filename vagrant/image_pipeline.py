@@ -0,0 +1,187 @@
+import argparse
+import hashlib
+import json
+import multiprocessing
+import os
+
+from sqlalchemy import create_engine
+from sqlalchemy.orm import sessionmaker
+
+from database_setup import Base, PuppyProfile, DATABASE_URL
+
+try:
+    from PIL import Image
+except ImportError:  # Pillow is only needed to generate variants
+    Image = None
+
+# Width in pixels of each derived size. Pictures no wider than a size are not
+# upscaled or re-encoded; that size's variant is the original file itself.
+VARIANT_WIDTHS = [("thumb", 160), ("small", 320), ("medium", 640),
+                  ("large", 1280)]
+
+CACHE_DIR = "image_cache"
+
+engine = create_engine(DATABASE_URL)
+Base.metadata.bind = engine
+
+DBSession = sessionmaker(bind=engine)
+session = DBSession()
+
+
+def fileHash(path):
+    """SHA-256 of a file's contents, read in 64KB chunks"""
+    digest = hashlib.sha256()
+
+    with open(path, "rb") as f:
+        for chunk in iter(lambda: f.read(65536), b""):
+            digest.update(chunk)
+
+    return digest.hexdigest()
+
+
+def fileStat(path):
+    """Cheap change stamp for a picture file: size and modification time"""
+    st = os.stat(path)
+    return "%d:%d" % (st.st_size, int(st.st_mtime))
+
+
+def cachePath(cache_dir, picture_hash, size_name):
+    """Content-addressed location of one variant: <dir>/ab/<hash>/<size>.jpg"""
+    return os.path.join(
+        cache_dir, picture_hash[:2], picture_hash, size_name + ".jpg")
+
+
+def processPicture(task):
+    """Worker: processPictureVariants, returning (path, None, error message)
+    for a picture that is missing or cannot be decoded so that one bad file
+    does not abort the whole pool"""
+    path, cache_dir = task
+    try:
+        return processPictureVariants(path, cache_dir)
+    except Exception as e:
+        return path, None, "%s: %s" % (type(e).__name__, e)
+
+
+def processPictureVariants(path, cache_dir):
+    """Hash a picture and write any missing variants to the cache.
+    Identical pictures hash the same, so they are only resized once."""
+    picture_hash = fileHash(path)
+    variants = dict(
+        (name, cachePath(cache_dir, picture_hash, name))
+        for name, width in VARIANT_WIDTHS)
+
+    if all(os.path.exists(p) for p in variants.values()):
+        return path, picture_hash, variants
+
+    # Image.open only reads the header; decode once a size needs resizing
+    source = Image.open(path)
+    pixels = None
+
+    for name, width in VARIANT_WIDTHS:
+        target = variants[name]
+        if source.size[0] <= width:
+            variants[name] = path
+            continue
+        if os.path.exists(target):
+            continue
+
+        directory = os.path.dirname(target)
+        if not os.path.isdir(directory):
+            try:
+                os.makedirs(directory)
+            except OSError:  # another worker created it first
+                pass
+
+        if pixels is None:
+            pixels = source.convert("RGB")
+        height = int(round(source.size[1] * float(width) / source.size[0]))
+        image = pixels.resize((width, max(height, 1)), Image.ANTIALIAS)
+
+        # Write then rename so readers never see a partial file
+        tmp = "%s.%d.tmp" % (target, os.getpid())
+        image.save(tmp, "JPEG", quality=85, optimize=True)
+        os.rename(tmp, target)
+
+    return path, picture_hash, variants
+
+
+def changedProfiles():
+    """Profiles with a local picture that is new or changed since the last
+    run, judged by the size:mtime stamp so unchanged files are not rehashed"""
+    profiles = session.query(
+        PuppyProfile.id, PuppyProfile.picture, PuppyProfile.picture_stat).\
+        filter(PuppyProfile.picture.isnot(None)).all()
+
+    changed = []
+    for profile in profiles:
+        if not os.path.isfile(profile.picture):
+            continue  # remote URL or placeholder such as "No image"
+
+        stat = fileStat(profile.picture)
+        if stat != profile.picture_stat:
+            changed.append((profile.id, profile.picture, stat))
+
+    return changed
+
+
+def processPictures(cache_dir=CACHE_DIR, processes=None):
+    """Generate variants for new or changed profile pictures in a process
+    pool and record them on the profiles. Pictures that cannot be read are
+    reported and skipped, and retried on the next run. Returns the number
+    processed."""
+    if Image is None:
+        raise RuntimeError("Pillow is required: pip install Pillow")
+
+    changed = changedProfiles()
+    if not changed:
+        return 0
+
+    paths = sorted(set(path for profile_id, path, stat in changed))
+
+    results = {}
+    pool = multiprocessing.Pool(processes)
+    try:
+        for path, picture_hash, variants in pool.imap_unordered(
+                processPicture, [(path, cache_dir) for path in paths]):
+            if picture_hash is None:
+                print "Skipping %s: %s" % (path, variants)
+            else:
+                results[path] = (picture_hash, variants)
+    finally:
+        pool.close()
+        pool.join()
+
+    updates = []
+    for profile_id, path, stat in changed:
+        if path not in results:
+            continue
+        picture_hash, variants = results[path]
+        updates.append({
+            'id': profile_id,
+            'picture_hash': picture_hash,
+            'picture_stat': stat,
+            'picture_variants': json.dumps(variants, sort_keys=True)})
+
+    if not updates:
+        return 0
+
+    session.bulk_update_mappings(PuppyProfile, updates)
+    session.commit()
+
+    return len(updates)
+
+
+if __name__ == '__main__':
+    parser = argparse.ArgumentParser(
+        description="Generate thumbnails and responsive sizes for local "
+        "puppy pictures")
+    parser.add_argument(
+        "--cache-dir", default=CACHE_DIR,
+        help="content-addressed variant cache (default: %s)" % CACHE_DIR)
+    parser.add_argument(
+        "--processes", type=int,
+        help="worker processes (default: one per CPU)")
+    args = parser.parse_args()
+
+    count = processPictures(args.cache_dir, args.processes)
+    print "Processed %d new or changed picture(s)" % count
@@ -0,0 +1,268 @@
+import argparse
+import collections
+import multiprocessing
+import os
+import Queue
+import random
+import sys
+import time
+import traceback
+
+from sqlalchemy import func
+from sqlalchemy.exc import OperationalError
+
+import database_queries
+from database_queries import (
+    adoptPuppy, checkInPuppy, createRandomAge, createRandomWeight,
+    getPuppyAndProfile, groupByShelter, sortAscendingName,
+    sortAscendingWeight, sortLessthanSixMonthsOld)
+from database_setup import Adopter, Puppy, Shelter, puppies_adopters_table
+
+LISTINGS = [
+    sortAscendingName, sortLessthanSixMonthsOld, sortAscendingWeight,
+    groupByShelter, getPuppyAndProfile]
+
+DEFAULT_MIX = "checkin=1,adopt=1,list=4"
+
+# How long past the run's duration to wait for a worker's results before
+# giving up on it (setup, and the operation in flight at the deadline)
+RESULT_MARGIN = 60.0
+
+
+def parseMix(value):
+    """argparse type for an operation mix such as checkin=1,adopt=1,list=4"""
+    mix = []
+    for part in value.split(","):
+        name, weight = part.split("=")
+        if name not in ("checkin", "adopt", "list"):
+            raise argparse.ArgumentTypeError("unknown operation %s" % name)
+        mix.append((name, float(weight)))
+    return mix
+
+
+def isLocked(error):
+    return "database is locked" in str(error)
+
+
+def occupancyDrift(session):
+    """Per shelter, current_occupancy minus the puppies actually housed
+    there (not yet adopted). Check-ins and adoptions move both by one, so
+    this should not change over a run, whatever its starting value."""
+    adopted = session.query(puppies_adopters_table.c.puppy_id)
+    housed = dict(session.query(Puppy.shelter_id, func.count(Puppy.id)).
+                  filter(~Puppy.id.in_(adopted)).
+                  group_by(Puppy.shelter_id).all())
+
+    return dict(
+        (shelter.id, shelter.current_occupancy - housed.get(shelter.id, 0))
+        for shelter in session.query(Shelter))
+
+
+def runWorker(worker_id, mix, duration, retries, seed, results):
+    """Worker process: run randomly chosen operations until duration is up,
+    then put (latencies, error counts, traceback or None) on the results
+    queue. It always puts them, so the parent never waits on a worker that
+    died."""
+    latencies = collections.defaultdict(list)
+    counts = collections.Counter()
+    error = None
+    try:
+        runOperations(worker_id, mix, duration, retries, seed, latencies,
+                      counts)
+    except Exception:
+        error = traceback.format_exc()
+    finally:
+        results.put((dict(latencies), dict(counts), error))
+
+
+def runOperations(worker_id, mix, duration, retries, seed, latencies,
+                  counts):
+    """runWorker's loop, adding to latencies and counts as it goes"""
+    # Connections must not be shared with the parent across fork
+    database_queries.engine.dispose()
+    database_queries.read_engine.dispose()
+    sys.stdout = open(os.devnull, "w")
+
+    session = database_queries.session
+    rng = random.Random(seed + worker_id)
+    shelter_ids = [s_id for (s_id,) in session.query(Shelter.id)]
+    adopter_ids = [a_id for (a_id,) in session.query(Adopter.id)]
+    puppy_ids = [p_id for (p_id,) in session.query(Puppy.id)]
+    session.commit()
+
+    if not adopter_ids:
+        # adoptPuppy() rejects an adoption without adopters
+        mix = [(name, weight) for name, weight in mix if name != "adopt"]
+        if not mix:
+            raise RuntimeError("No adopters to adopt puppies with")
+
+    names = [name for name, weight in mix]
+    weights = [weight for name, weight in mix]
+    total_weight = sum(weights)
+
+    deadline = time.time() + duration
+    sequence = 0
+
+    while time.time() < deadline:
+        pick = rng.uniform(0, total_weight)
+        for op, weight in zip(names, weights):
+            pick -= weight
+            if pick <= 0:
+                break
+
+        # Arguments are drawn up front, so retries repeat the same call and
+        # a seed gives the same sequence of operations whatever is locked
+        if op == "checkin":
+            sequence += 1
+            args = ("Load%d-%d" % (worker_id, sequence),
+                    rng.choice(["male", "female"]), createRandomAge(rng),
+                    createRandomWeight(rng), rng.choice(shelter_ids))
+            call = lambda: checkInPuppy(*args)
+        elif op == "adopt":
+            args = (rng.choice(puppy_ids), rng.sample(
+                adopter_ids, min(rng.randint(1, 2), len(adopter_ids))))
+            call = lambda: adoptPuppy(*args)
+        else:
+            call = rng.choice(LISTINGS)
+
+        for attempt in range(retries + 1):
+            start = time.time()
+            try:
+                outcome = call()
+            except OperationalError as e:
+                session.rollback()
+                if not isLocked(e):
+                    raise
+                counts["locked"] += 1
+                if attempt == retries:
+                    counts["failed"] += 1
+                else:
+                    counts["retries"] += 1
+                    time.sleep(0.01 * (2 ** attempt) * rng.random())
+                continue
+
+            latencies[op].append(time.time() - start)
+            if op == "checkin" and outcome is False:
+                counts["rejected"] += 1
+            break
+
+
+def percentile(sorted_values, p):
+    if not sorted_values:
+        return 0.0
+    index = int(round(p / 100.0 * (len(sorted_values) - 1)))
+    return sorted_values[index]
+
+
+def runLoadTest(workers=4, duration=10.0, mix=None, retries=5, seed=0):
+    """Run workers processes against the configured database for duration
+    seconds, then print throughput, latency percentiles, lock errors and
+    whether shelter occupancy stayed consistent"""
+    mix = mix or parseMix(DEFAULT_MIX)
+    session = database_queries.session
+
+    drift_before = occupancyDrift(session)
+    session.commit()
+    database_queries.engine.dispose()
+    database_queries.read_engine.dispose()
+
+    results = multiprocessing.Queue()
+    processes = [
+        multiprocessing.Process(
+            target=runWorker,
+            args=(i, mix, duration, retries, seed, results))
+        for i in range(workers)]
+
+    start = time.time()
+    for process in processes:
+        process.start()
+
+    latencies = collections.defaultdict(list)
+    counts = collections.Counter()
+    errors = []
+    for process in processes:
+        try:
+            worker_latencies, worker_counts, error = results.get(
+                timeout=max(0, start + duration + RESULT_MARGIN - time.time()))
+        except Queue.Empty:
+            errors.append("no results %.0fs after the run ended" %
+                          RESULT_MARGIN)
+            break
+        for op, values in worker_latencies.items():
+            latencies[op].extend(values)
+        counts.update(worker_counts)
+        if error:
+            errors.append(error)
+
+    for process in processes:
+        if errors:
+            process.terminate()
+        process.join()
+    elapsed = time.time() - start
+
+    if errors:
+        print "Load test FAILED, %d worker error(s):\n" % len(errors)
+        for error in errors:
+            print error
+        return False
+
+    print "%d workers, %.1fs, mix %s\n" % (
+        workers, elapsed, ",".join("%s=%g" % m for m in mix))
+    print "%-8s %8s %8s %9s %9s %9s" % (
+        "op", "count", "ops/s", "p50 ms", "p95 ms", "p99 ms")
+
+    for op in sorted(latencies):
+        values = sorted(latencies[op])
+        print "%-8s %8d %8.1f %9.2f %9.2f %9.2f" % (
+            op, len(values), len(values) / elapsed,
+            percentile(values, 50) * 1000, percentile(values, 95) * 1000,
+            percentile(values, 99) * 1000)
+
+    total = sum(len(values) for values in latencies.values())
+    print "\nTotal: %d ops, %.1f ops/s" % (total, total / elapsed)
+    print "Check-ins rejected (shelters full): %d" % counts["rejected"]
+    print "'database is locked' errors: %d (%d retried, %d failed)" % (
+        counts["locked"], counts["retries"], counts["failed"])
+
+    drift_after = occupancyDrift(session)
+    session.commit()
+    inconsistent = sorted(
+        s_id for s_id in drift_after
+        if drift_after[s_id] != drift_before.get(s_id, 0))
+    over_capacity = session.query(Shelter).filter(
+        (Shelter.current_occupancy > Shelter.maximum_capacity) |
+        (Shelter.current_occupancy < 0)).count()
+
+    if inconsistent or over_capacity:
+        print "Occupancy INCONSISTENT: shelters %s drifted, %d out of " \
+            "bounds" % (inconsistent, over_capacity)
+    else:
+        print "Occupancy consistent"
+
+    return not inconsistent and not over_capacity
+
+
+if __name__ == '__main__':
+    parser = argparse.ArgumentParser(
+        description="Concurrent check-in/adoption/listing load test")
+    parser.add_argument(
+        "--workers", type=int, default=4,
+        help="worker processes (default: 4)")
+    parser.add_argument(
+        "--duration", type=float, default=10.0,
+        help="seconds to run (default: 10)")
+    parser.add_argument(
+        "--mix", type=parseMix, default=parseMix(DEFAULT_MIX),
+        help="operation weights (default: %s)" % DEFAULT_MIX)
+    parser.add_argument(
+        "--retries", type=int, default=5,
+        help="retries after 'database is locked' (default: 5)")
+    parser.add_argument("--seed", type=int, default=0)
+    args = parser.parse_args()
+
+    database_queries.engine.echo = False
+    database_queries.read_engine.echo = False
+
+    consistent = runLoadTest(
+        args.workers, args.duration, args.mix, args.retries, args.seed)
+    sys.exit(0 if consistent else 1)
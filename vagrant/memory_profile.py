@@ -0,0 +1,225 @@
+import argparse
+import datetime
+import gc
+import multiprocessing
+import os
+import random
+import resource
+import shutil
+import sys
+import tempfile
+
+try:
+    import tracemalloc
+except ImportError:  # Python 2 without the pytracemalloc backport
+    tracemalloc = None
+
+# Peak memory allowed per 100k puppies, in MB, set at roughly 1.5-2x the peak
+# RSS measured when introduced. --check fails when a measurement, scaled to
+# 100k puppies, goes over.
+BUDGETS_MB = {
+    'puppiesByName': 60,
+    'puppiesBornAfter': 30,
+    'puppiesByWeight': 80,
+    'puppiesByShelter': 80,
+    'puppiesWithProfiles': 170,
+    'populatorBatch': 100,
+}
+
+# Filled in by loadTargets() once the database modules are imported
+TARGETS = {}
+
+
+def maxRss():
+    """Peak resident set size of this process in bytes (Linux reports KB)"""
+    return resource.getrusage(resource.RUSAGE_SELF).ru_maxrss * 1024
+
+
+def traceCall(func, top=10):
+    """Run func under tracemalloc. Returns peak bytes, bytes still allocated
+    once its result is dropped, and the top allocation sites of memory live
+    when it returned."""
+    gc.collect()
+    tracemalloc.start()
+    try:
+        result = func()
+        peak = tracemalloc.get_traced_memory()[1]
+        snapshot = tracemalloc.take_snapshot()
+        del result
+        gc.collect()
+        retained = tracemalloc.get_traced_memory()[0]
+    finally:
+        tracemalloc.stop()
+
+    sites = [(str(stat.traceback[0]), stat.size)
+             for stat in snapshot.statistics('lineno')[:top]]
+    return {'peak': peak, 'retained': retained, 'sites': sites}
+
+
+def rssChild(name):
+    """Forked child for the RSS fallback: peak RSS growth while running one
+    target, which a fresh process can attribute to it alone"""
+    gc.collect()
+    before = maxRss()
+    TARGETS[name]()
+    return maxRss() - before
+
+
+def rssCall(name):
+    """Measure a target without tracemalloc. Only peak is available."""
+    pool = multiprocessing.Pool(1)
+    try:
+        peak = pool.apply(rssChild, (name,))
+    finally:
+        pool.close()
+        pool.join()
+    return {'peak': peak, 'retained': None, 'sites': []}
+
+
+def loadTargets(batch_size):
+    """Report queries and one populator batch, keyed by BUDGETS_MB name"""
+    import database_queries
+    import puppypopulator
+    from sqlalchemy import func
+    from database_setup import Puppy
+
+    database_queries.engine.echo = False
+    database_queries.read_engine.echo = False
+
+    def report(query, *args):
+        def run():
+            # Measure the query itself, not a cached result
+            database_queries.report_cache.clear()
+            return database_queries.readOnly(query)(*args)
+        return run
+
+    def populatorBatch():
+        session = puppypopulator.session
+        start = (session.query(func.max(Puppy.id)).scalar() or 0) + 1
+        names = [random.choice(puppypopulator.male_names)
+                 for i in range(batch_size)]
+        sys.stdout = open(os.devnull, "w")
+        try:
+            puppypopulator.EnumeratePuppies(names, start)
+        finally:
+            sys.stdout = sys.__stdout__
+        return session
+
+    six_months_ago = datetime.date.today() - datetime.timedelta(180)
+    TARGETS.update({
+        'puppiesByName': report(database_queries.puppiesByName),
+        'puppiesBornAfter': report(
+            database_queries.puppiesBornAfter, six_months_ago),
+        'puppiesByWeight': report(database_queries.puppiesByWeight),
+        'puppiesByShelter': report(database_queries.puppiesByShelter),
+        'puppiesWithProfiles': report(database_queries.puppiesWithProfiles),
+        'populatorBatch': populatorBatch,
+    })
+
+
+def useDatabase(path):
+    """Point the database modules at the SQLite file path. They bind
+    DATABASE_URL when first imported, so this must run before that, unless
+    they were imported with path already."""
+    url = 'sqlite:///' + path
+    if 'database_setup' not in sys.modules:
+        os.environ['DATABASE_URL'] = url
+        os.environ['DATABASE_READ_URL'] = url
+
+    import database_setup
+    if database_setup.DATABASE_URL != url:
+        raise RuntimeError("the database modules already use %s, not %s" %
+                           (database_setup.DATABASE_URL, url))
+
+    # Nothing may hold the file open while a template is copied over it
+    for name in ('database_queries', 'puppypopulator'):
+        module = sys.modules.get(name)
+        if module is not None:
+            module.session.close()
+            module.engine.dispose()
+    if 'database_queries' in sys.modules:
+        sys.modules['database_queries'].read_session.remove()
+        sys.modules['database_queries'].read_engine.dispose()
+    for leftover in (path + '-wal', path + '-shm'):
+        if os.path.exists(leftover):
+            os.remove(leftover)
+
+
+def profileMemory(puppies=100000, batch_size=3000, top=5, check=False,
+                  path=None):
+    """Clone a template with puppies puppies to path (default: a temporary
+    file), measure every target and print peak and retained memory, scaled
+    per 100k puppies. See useDatabase() for when the database modules may
+    already be imported. Returns {target: peak MB per 100k puppies}; with
+    check set, raises AssertionError if any target is over its budget."""
+    directory = None
+    if path is None:
+        directory = tempfile.mkdtemp()
+        path = os.path.join(directory, 'memory.db')
+    try:
+        useDatabase(path)
+        from templates import cloneTemplate
+        cloneTemplate(path, puppies)
+        loadTargets(batch_size)
+
+        mode = "tracemalloc" if tracemalloc else "peak RSS (no tracemalloc)"
+        print "%d puppies, populator batch of %d, measured with %s\n" % (
+            puppies, batch_size, mode)
+
+        measured = {}
+        for name in sorted(TARGETS):
+            if tracemalloc:
+                stats = traceCall(TARGETS[name], top)
+            else:
+                stats = rssCall(name)
+
+            rows = batch_size if name == 'populatorBatch' else puppies
+            per_100k = stats['peak'] * 100000.0 / rows / 2 ** 20
+            budget = BUDGETS_MB[name]
+            measured[name] = per_100k
+
+            retained = "n/a" if stats['retained'] is None else \
+                "%.1f MB" % (stats['retained'] / 2.0 ** 20)
+            print "%-20s peak %7.1f MB  retained %9s  %7.1f MB/100k " \
+                "(budget %d)%s" % (
+                    name, stats['peak'] / 2.0 ** 20, retained, per_100k,
+                    budget, "  OVER BUDGET" if per_100k > budget else "")
+
+            for site, size in stats['sites']:
+                print "    %8.1f KB  %s" % (size / 1024.0, site)
+
+        over = sorted(name for name in measured
+                      if measured[name] > BUDGETS_MB[name])
+        if check and over:
+            raise AssertionError(
+                "over budget: %s" % ", ".join(
+                    "%s %.1f MB/100k (budget %d)" % (
+                        name, measured[name], BUDGETS_MB[name])
+                    for name in over))
+        return measured
+    finally:
+        if directory is not None:
+            shutil.rmtree(directory)
+
+
+if __name__ == '__main__':
+    parser = argparse.ArgumentParser(
+        description="Peak and retained memory of reports and population")
+    parser.add_argument(
+        "--puppies", type=int, default=100000,
+        help="puppies in the scratch database (default: 100000)")
+    parser.add_argument(
+        "--batch-size", type=int, default=3000,
+        help="puppies in the measured populator batch (default: 3000)")
+    parser.add_argument(
+        "--top", type=int, default=5,
+        help="allocation sites to show per target (default: 5)")
+    parser.add_argument(
+        "--check", action="store_true",
+        help="exit non-zero if any target exceeds its budget")
+    args = parser.parse_args()
+
+    try:
+        profileMemory(args.puppies, args.batch_size, args.top, args.check)
+    except AssertionError as e:
+        sys.exit(str(e))
@@ -0,0 +1,241 @@
+from sqlalchemy import create_engine, inspect
+from sqlalchemy.orm import sessionmaker
+from sqlalchemy.pool import NullPool
+from sqlalchemy.schema import CreateIndex, CreateTable
+
+from database_setup import (
+    Base, createChangeTriggers, createOccupancyTriggers, engine,
+    GRAMS_PER_POUND, puppy_name_trigrams_table)
+from name_lookup import rebuildNameIndex
+
+# Indexes the models no longer define, replaced by others
+OBSOLETE_INDEXES = [
+    ('puppy', 'ix_puppy_name_lower'),  # by ix_puppy_name_key
+]
+
+
+def indexNames(engine, inspector, table_name):
+    """Names of a table's indexes. SQLite's reflection skips expression
+    indexes such as ix_puppy_name_key, so ask sqlite_master directly."""
+    if engine.dialect.name == 'sqlite':
+        return set(row[0] for row in engine.execute(
+            "SELECT name FROM sqlite_master "
+            "WHERE type = 'index' AND tbl_name = ?", table_name))
+    return set(i['name'] for i in inspector.get_indexes(table_name))
+
+
+def createMissingIndexes(engine):
+    """Create indexes defined on the models but missing from an existing
+    database (create_all() only adds them together with new tables)"""
+    inspector = inspect(engine)
+    tables = set(inspector.get_table_names())
+    created = 0
+
+    for table in Base.metadata.sorted_tables:
+        if table.name not in tables:
+            continue
+
+        existing = indexNames(engine, inspector, table.name)
+
+        for index in table.indexes:
+            if index.name not in existing:
+                index.create(engine)
+                created += 1
+
+    return created
+
+
+def dropObsoleteIndexes(engine):
+    """Drop the OBSOLETE_INDEXES an existing database still has"""
+    inspector = inspect(engine)
+    tables = set(inspector.get_table_names())
+    dropped = 0
+
+    for table_name, index_name in OBSOLETE_INDEXES:
+        if table_name in tables and \
+                index_name in indexNames(engine, inspector, table_name):
+            engine.execute('DROP INDEX %s' % index_name)
+            dropped += 1
+
+    return dropped
+
+
+def migrateNameIndex(engine):
+    """Fill the fuzzy name index of a database created before it existed.
+    Returns the number of names indexed."""
+    if engine.execute(
+            puppy_name_trigrams_table.select().limit(1)).first() is not None:
+        return 0
+    session = sessionmaker(bind=engine)()
+    try:
+        return rebuildNameIndex(session)
+    finally:
+        session.close()
+
+
+def migrateNativeColumns(engine):
+    """Copy puppy weights and birth dates from the old Numeric weight and ISO
+    date dateOfBirth columns into weight_grams and birth_day. Only rows not
+    yet migrated are touched, so it is safe to rerun. The old columns are
+    left in place; SQLite before 3.35 cannot drop them."""
+    columns = set(c['name'] for c in inspect(engine).get_columns('puppy'))
+    if 'weight' not in columns or 'dateOfBirth' not in columns:
+        return 0
+
+    if engine.dialect.name == 'sqlite':
+        days = 'CAST(julianday("dateOfBirth") - 2440587.5 AS INTEGER)'
+    else:
+        days = '"dateOfBirth" - DATE \'1970-01-01\''
+
+    result = engine.execute(
+        'UPDATE puppy SET '
+        'weight_grams = CAST(round(weight * %f) AS INTEGER), '
+        'birth_day = %s '
+        'WHERE (weight_grams IS NULL AND weight IS NOT NULL) '
+        'OR (birth_day IS NULL AND "dateOfBirth" IS NOT NULL)' % (
+            GRAMS_PER_POUND, days))
+
+    return result.rowcount
+
+
+def foreignKeyActions(engine, inspector, table_name):
+    """{constrained column: (constraint name, ON DELETE action or None)}
+    for a table's single-column foreign keys. SQLite's reflection leaves out
+    the actions, so ask PRAGMA foreign_key_list directly."""
+    if engine.dialect.name == 'sqlite':
+        result = engine.execute("PRAGMA foreign_key_list(%s)" % table_name)
+        # Rows are (id, seq, table, from, to, on_update, on_delete, match);
+        # tables without foreign keys return no result set at all
+        return dict(
+            (row[3], (None, None if row[6] == 'NO ACTION' else row[6]))
+            for row in (result.fetchall() if result.returns_rows else []))
+    return dict(
+        (fk['constrained_columns'][0],
+         (fk['name'], fk['options'].get('ondelete')))
+        for fk in inspector.get_foreign_keys(table_name))
+
+
+def rebuildSqliteTable(connection, dialect, table, columns):
+    """Recreate table from its model, the way SQLite's documentation
+    describes for schema changes ALTER TABLE can't make, copying columns
+    across. Rows whose foreign keys point at missing rows are dropped, or
+    the new constraints would reject them. Returns how many were dropped."""
+    create = str(CreateTable(table).compile(dialect=dialect))
+    connection.execute(create.replace(
+        'CREATE TABLE %s ' % table.name, 'CREATE TABLE %s_new ' % table.name,
+        1))
+
+    valid = ' AND '.join(
+        '(%s IS NULL OR %s IN (SELECT %s FROM %s))' % (
+            fk.parent.name, fk.parent.name, fk.column.name,
+            fk.column.table.name)
+        for fk in table.foreign_keys) or '1'
+    names = ', '.join('"%s"' % name for name in columns)
+    connection.execute('INSERT INTO %s_new (%s) SELECT %s FROM %s WHERE %s' % (
+        table.name, names, names, table.name, valid))
+    dropped = connection.execute(
+        'SELECT (SELECT count(*) FROM %s) - (SELECT count(*) FROM %s_new)' % (
+            table.name, table.name)).fetchone()[0]
+
+    # Dropping the old table also drops its indexes and change triggers
+    connection.execute('DROP TABLE %s' % table.name)
+    connection.execute('ALTER TABLE %s_new RENAME TO %s' % (
+        table.name, table.name))
+    for index in table.indexes:
+        connection.execute(str(CreateIndex(index).compile(dialect=dialect)))
+
+    return dropped
+
+
+def migrateForeignKeys(engine):
+    """Give existing tables the ON DELETE actions their models declare
+    (e.g. CASCADE from puppy_profile and the association tables to puppy).
+    SQLite can't alter a constraint, so its tables are rebuilt, dropping
+    rows that already point at deleted puppies. Returns the number of
+    tables migrated."""
+    inspector = inspect(engine)
+    tables = set(inspector.get_table_names())
+    stale = []
+
+    for table in Base.metadata.sorted_tables:
+        if table.name not in tables:
+            continue
+
+        actions = foreignKeyActions(engine, inspector, table.name)
+        fks = [(fk, actions[fk.parent.name][0]) for fk in table.foreign_keys
+               if fk.parent.name in actions and (fk.ondelete or '').upper() !=
+               (actions[fk.parent.name][1] or '').upper()]
+        if fks:
+            existing = set(
+                c['name'] for c in inspector.get_columns(table.name))
+            stale.append((table, fks, [
+                c.name for c in table.columns if c.name in existing]))
+
+    if not stale:
+        return 0
+
+    # Own connection: SQLite needs foreign keys off, outside a transaction,
+    # while tables are rebuilt, and the pysqlite driver's implicit commits
+    # before DDL are disabled so everything is one transaction
+    migrator = create_engine(engine.url, poolclass=NullPool)
+    connection = migrator.raw_connection()
+    sqlite = engine.dialect.name == 'sqlite'
+    try:
+        if sqlite:
+            connection.connection.isolation_level = None
+            connection.execute("PRAGMA foreign_keys=OFF")
+            connection.execute("BEGIN")
+
+        for table, fks, columns in stale:
+            if sqlite:
+                dropped = rebuildSqliteTable(
+                    connection, engine.dialect, table, columns)
+                if dropped:
+                    print "Dropped %d orphaned row(s) from %s" % (
+                        dropped, table.name)
+                continue
+
+            for fk, constraint in fks:
+                connection.cursor().execute(
+                    'ALTER TABLE %s DROP CONSTRAINT %s, '
+                    'ADD FOREIGN KEY (%s) REFERENCES %s (%s)%s' % (
+                        table.name, constraint, fk.parent.name,
+                        fk.column.table.name, fk.column.name,
+                        ' ON DELETE ' + fk.ondelete if fk.ondelete else ''))
+
+        if sqlite:
+            problems = connection.execute("PRAGMA foreign_key_check").\
+                fetchall()
+            if problems:
+                raise RuntimeError(
+                    "foreign key violations after migration: %r" % problems)
+            connection.execute("COMMIT")
+        else:
+            connection.commit()
+    except Exception:
+        if sqlite:
+            connection.execute("ROLLBACK")
+        else:
+            connection.rollback()
+        raise
+    finally:
+        connection.close()
+        migrator.dispose()
+
+    # Put back the triggers dropped with rebuilt tables
+    with engine.connect() as trigger_connection:
+        createChangeTriggers(Base.metadata, trigger_connection)
+        createOccupancyTriggers(Base.metadata, trigger_connection)
+
+    return len(stale)
+
+
+if __name__ == '__main__':
+    print "Dropped %d obsolete index(es)" % dropObsoleteIndexes(engine)
+    print "Created %d missing index(es)" % createMissingIndexes(engine)
+    print "Migrated %d puppies to native weight and birth date columns" % (
+        migrateNativeColumns(engine))
+    print "Added ON DELETE actions to %d table(s)" % (
+        migrateForeignKeys(engine))
+    print "Indexed %d puppy name(s) for fuzzy lookup" % (
+        migrateNameIndex(engine))
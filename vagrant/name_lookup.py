@@ -0,0 +1,143 @@
+from sqlalchemy import event, func, inspect, select
+
+from database_setup import Puppy, Shelter, puppy_name_trigrams_table
+
+# Fuzzy candidates must share at least this fraction of trigrams with the
+# search term (Jaccard similarity) to be returned
+SIMILARITY_THRESHOLD = 0.25
+
+# How many distinct fuzzy name matches to expand into puppies
+MAX_FUZZY_NAMES = 5
+
+
+def nameKey(name):
+    """Normalized form of a name used by both indexes. Strips spaces only,
+    as SQL's trim() does, so it equals nameKeyColumn() for stored names."""
+    return name.strip(' ').lower()
+
+
+def nameKeyColumn():
+    """nameKey() of Puppy.name in SQL, as indexed by ix_puppy_name_key"""
+    return func.lower(func.trim(Puppy.name))
+
+
+def puppiesNamed(session, name):
+    """Query for the puppies whose name is name, ignoring case and
+    surrounding spaces, by id"""
+    return session.query(Puppy).\
+        filter(nameKeyColumn() == nameKey(name)).order_by(Puppy.id)
+
+
+def trigrams(key):
+    """Trigrams of a name key, padded like pg_trgm so word edges count"""
+    padded = "  " + key + " "
+    return set(padded[i:i + 3] for i in range(len(padded) - 2))
+
+
+def indexName(connection, name):
+    """Add a name's trigrams to the fuzzy index unless it is already there"""
+    key = nameKey(name)
+    table = puppy_name_trigrams_table
+
+    indexed = connection.execute(
+        select([table.c.name_key]).where(table.c.name_key == key).limit(1)).\
+        first()
+
+    if indexed is None:
+        connection.execute(table.insert(), [
+            {'trigram': t, 'name_key': key} for t in trigrams(key)])
+
+
+def indexNames(connection, names):
+    """indexName for many names at once: one query for the names already
+    indexed and one executemany for the rest"""
+    keys = set(nameKey(name) for name in names)
+    table = puppy_name_trigrams_table
+
+    indexed = set(key for (key,) in connection.execute(
+        select([table.c.name_key]).where(table.c.name_key.in_(keys)).
+        distinct()))
+
+    rows = [{'trigram': t, 'name_key': key}
+            for key in keys - indexed for t in trigrams(key)]
+    if rows:
+        connection.execute(table.insert(), rows)
+
+
+def rebuildNameIndex(session):
+    """Index every puppy name not yet in the fuzzy index and commit. Run
+    after bulk loads that bypass the ORM (e.g. COPY). Returns the number of
+    names indexed."""
+    table = puppy_name_trigrams_table
+    missing = session.query(nameKeyColumn()).\
+        filter(~nameKeyColumn().in_(select([table.c.name_key]))).\
+        distinct().all()
+
+    connection = session.connection()
+    for (key,) in missing:
+        indexName(connection, key)
+
+    session.commit()
+    return len(missing)
+
+
+@event.listens_for(Puppy, 'after_insert')
+@event.listens_for(Puppy, 'after_update')
+def indexPuppyName(mapper, connection, target):
+    """Keep the fuzzy index current for puppies written through the ORM"""
+    if inspect(target).attrs.name.history.has_changes():
+        indexName(connection, target.name)
+
+
+def fuzzyNameKeys(session, name):
+    """Rank indexed names by trigram similarity to name, best first"""
+    table = puppy_name_trigrams_table
+    query_trigrams = trigrams(nameKey(name))
+
+    shared = func.count(table.c.trigram).label('shared')
+    rows = session.query(table.c.name_key, shared).\
+        filter(table.c.trigram.in_(query_trigrams)).\
+        group_by(table.c.name_key).\
+        order_by(shared.desc()).\
+        limit(MAX_FUZZY_NAMES * 10).all()
+
+    ranked = []
+    for key, count in rows:
+        score = float(count) / (
+            len(query_trigrams) + len(trigrams(key)) - count)
+        if score >= SIMILARITY_THRESHOLD:
+            ranked.append((score, key))
+
+    ranked.sort(key=lambda r: (-r[0], r[1]))
+    return ranked[:MAX_FUZZY_NAMES]
+
+
+def findPuppiesByName(session, name, limit=20):
+    """Look up puppies by name, tolerating case differences and typos.
+
+    Returns up to limit candidates as (score, puppy_id, name, gender,
+    shelter_name) tuples, best first. Exact (case-insensitive) matches score
+    1.0 and come from the ix_puppy_name_key index; typo matches come from the
+    trigram index. Gender and shelter let staff tell same-named puppies
+    apart."""
+    key = nameKey(name)
+    ranked = [(1.0, key)] + [
+        (score, k) for score, k in fuzzyNameKeys(session, name) if k != key]
+
+    candidates = []
+    for score, k in ranked:
+        if len(candidates) >= limit:
+            break
+
+        puppies = session.query(
+            Puppy.id, Puppy.name, Puppy.gender,
+            Shelter.name.label('shelter_name')).\
+            outerjoin(Shelter, Puppy.shelter_id == Shelter.id).\
+            filter(nameKeyColumn() == k).\
+            order_by(Shelter.name, Puppy.id).\
+            limit(limit - len(candidates)).all()
+
+        candidates.extend(
+            (score, p.id, p.name, p.gender, p.shelter_name) for p in puppies)
+
+    return candidates
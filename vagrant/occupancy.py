@@ -0,0 +1,320 @@
+import argparse
+import collections
+import datetime
+
+try:
+    import numpy
+except ImportError:  # forecasts and histories fall back to Python loops
+    numpy = None
+
+from sqlalchemy import bindparam, case, func, select
+
+import database_queries
+from database_setup import (
+    dateToDays, daysToDate, EPOCH, Shelter, occupancy_daily_table,
+    occupancy_events_table, occupancy_hourly_table)
+from tag_index import batches
+
+SECONDS_PER_HOUR = 3600
+HOURS_PER_DAY = 24
+
+# Days of rollups a forecast looks back over, and the weight of each day
+# relative to the day after it, so recent trends count most
+FORECAST_WINDOW = 28
+DECAY = 0.9
+
+
+def addCounts(connection, table, bucket, counts):
+    """Add {(shelter_id, bucket): (arrivals, departures)} to a rollup
+    table's rows, inserting the buckets it doesn't have yet"""
+    column = table.c[bucket]
+    first = min(key[1] for key in counts)
+    existing = set()
+    for shelter_ids in batches(set(key[0] for key in counts)):
+        existing.update(tuple(row) for row in connection.execute(
+            select([table.c.shelter_id, column]).
+            where(table.c.shelter_id.in_(shelter_ids)).
+            where(column >= first)))
+
+    rows = [{'b_shelter': shelter_id, 'b_bucket': value,
+             'b_arrivals': arrivals, 'b_departures': departures}
+            for (shelter_id, value), (arrivals, departures) in counts.items()]
+    updates = [row for row in rows
+               if (row['b_shelter'], row['b_bucket']) in existing]
+    inserts = [{'shelter_id': row['b_shelter'], bucket: row['b_bucket'],
+                'arrivals': row['b_arrivals'],
+                'departures': row['b_departures']}
+               for row in rows
+               if (row['b_shelter'], row['b_bucket']) not in existing]
+
+    if updates:
+        connection.execute(
+            table.update().
+            where(table.c.shelter_id == bindparam('b_shelter')).
+            where(column == bindparam('b_bucket')).
+            values(arrivals=table.c.arrivals + bindparam('b_arrivals'),
+                   departures=table.c.departures +
+                   bindparam('b_departures')),
+            updates)
+    if inserts:
+        connection.execute(table.insert(), inserts)
+
+
+def eventCounts(events):
+    """(shelter_id, hour, arrivals, departures, events) per shelter and hour
+    of a selectable with occupancy_event's columns"""
+    hour = (events.c.at / SECONDS_PER_HOUR).label('hour')
+    return select([
+        events.c.shelter_id, hour,
+        func.sum(case([(events.c.delta > 0, events.c.delta)], else_=0)),
+        func.sum(case([(events.c.delta < 0, -events.c.delta)], else_=0)),
+        func.count()]).group_by(events.c.shelter_id, hour)
+
+
+def rollUpOccupancy(db_session):
+    """Fold the pending occupancy events into the hourly and daily rollups
+    and delete them, without committing. The work depends on the events
+    since the last rollup, not on the history already rolled up. Returns
+    the number of events folded."""
+    connection = db_session.connection()
+    events = occupancy_events_table
+
+    if connection.dialect.name == 'postgresql':
+        # Under READ COMMITTED an event committed after a max(id) read could
+        # still be deleted by id; delete first and count exactly the rows
+        # the DELETE removed
+        deleted = events.delete().returning(
+            events.c.shelter_id, events.c.at, events.c.delta).cte('deleted')
+        rows = connection.execute(eventCounts(deleted)).fetchall()
+    else:
+        # The SQLite writer begins IMMEDIATE, so no event can commit
+        # between this read and the delete below
+        last_id = connection.execute(
+            select([func.max(events.c.id)])).scalar()
+        if last_id is None:
+            return 0
+        rows = connection.execute(
+            eventCounts(events).where(events.c.id <= last_id)).fetchall()
+        connection.execute(events.delete().where(events.c.id <= last_id))
+
+    if not rows:
+        return 0
+
+    hourly = {}
+    daily = collections.defaultdict(lambda: [0, 0])
+    folded = 0
+    for shelter_id, hour_value, arrivals, departures, count in rows:
+        hourly[(shelter_id, hour_value)] = (arrivals, departures)
+        day = daily[(shelter_id, hour_value // HOURS_PER_DAY)]
+        day[0] += arrivals
+        day[1] += departures
+        folded += count
+
+    addCounts(connection, occupancy_hourly_table, 'hour', hourly)
+    addCounts(connection, occupancy_daily_table, 'day', daily)
+    return folded
+
+
+def pendingEvents(session, before=None):
+    """Whether any events (older than the Unix time before) are waiting to
+    be rolled up"""
+    events = occupancy_events_table
+    query = select([events.c.id]).limit(1)
+    if before is not None:
+        query = query.where(events.c.at < before)
+    return session.execute(query).first() is not None
+
+
+def dailyNet(session, shelter_ids, first_day, last_day):
+    """{shelter_id: [arrivals - departures for each day from first_day to
+    last_day]}, 0 for days without a rollup row"""
+    table = occupancy_daily_table
+    width = last_day - first_day + 1
+    nets = dict((shelter_id, [0] * width) for shelter_id in shelter_ids)
+    for batch in batches(shelter_ids):
+        for shelter_id, day, net in session.execute(
+                select([table.c.shelter_id, table.c.day,
+                        table.c.arrivals - table.c.departures]).
+                where(table.c.shelter_id.in_(batch)).
+                where(table.c.day.between(first_day, last_day))):
+            nets[shelter_id][day - first_day] = net
+    return nets
+
+
+def weightedRates(nets, decay=DECAY):
+    """Decay-weighted average of each row of daily net changes, the last
+    day weighted most"""
+    if not nets:
+        return []
+    width = len(nets[0])
+
+    if numpy is not None:
+        weights = decay ** numpy.arange(width - 1, -1, -1, dtype=float)
+        return (numpy.dot(numpy.array(nets, dtype=float), weights) /
+                weights.sum()).tolist()
+
+    weights = [decay ** (width - 1 - i) for i in range(width)]
+    total = sum(weights)
+    return [sum(net * weight for net, weight in zip(row, weights)) / total
+            for row in nets]
+
+
+def daysUntilFull(rooms, rates):
+    """Spots left divided by net arrivals per day, per shelter: 0 once full,
+    None if occupancy isn't rising"""
+    if numpy is not None:
+        rooms = numpy.array(rooms, dtype=float)
+        rates = numpy.array(rates, dtype=float)
+        with numpy.errstate(divide='ignore', invalid='ignore'):
+            days = numpy.where(rooms <= 0, 0.0, rooms / rates)
+        return [None if not (room <= 0 or rate > 0) else day
+                for room, rate, day in zip(rooms, rates, days.tolist())]
+
+    return [0.0 if room <= 0 else (room / rate if rate > 0 else None)
+            for room, rate in zip(rooms, rates)]
+
+
+def forecastCapacity(session, window=FORECAST_WINDOW, today=None):
+    """(shelter_id, name, occupancy, capacity, net arrivals per day, days
+    until full) for every shelter, by id. The rate is the decay-weighted
+    average of the window complete days of rollups before today (UTC), so
+    roll up first for the latest figures; the math runs over all shelters
+    at once."""
+    today = dateToDays(today or datetime.datetime.utcnow().date())
+    shelters = session.query(
+        Shelter.id, Shelter.name, Shelter.current_occupancy,
+        Shelter.maximum_capacity).order_by(Shelter.id).all()
+
+    nets = dailyNet(session, [s.id for s in shelters], today - window,
+                    today - 1)
+    rates = weightedRates([nets[s.id] for s in shelters])
+    days = daysUntilFull(
+        [s.maximum_capacity - s.current_occupancy for s in shelters], rates)
+
+    return [(s.id, s.name, s.current_occupancy, s.maximum_capacity, rate,
+             until) for s, rate, until in zip(shelters, rates, days)]
+
+
+def occupancyHistory(session, shelter_id, first_day, last_day):
+    """(date, arrivals, departures, occupancy at the end of the day) for
+    first_day to last_day (dates), worked back from the shelter's current
+    occupancy through the daily rollups. Changes not yet rolled up are not
+    counted."""
+    table = occupancy_daily_table
+    first, last = dateToDays(first_day), dateToDays(last_day)
+    counts = dict((day, (arrivals, departures)) for day, arrivals, departures
+                  in session.execute(
+                      select([table.c.day, table.c.arrivals,
+                              table.c.departures]).
+                      where(table.c.shelter_id == shelter_id).
+                      where(table.c.day.between(first, last))))
+    later = session.execute(
+        select([func.sum(table.c.arrivals - table.c.departures)]).
+        where(table.c.shelter_id == shelter_id).
+        where(table.c.day > last)).scalar() or 0
+    current = session.query(Shelter.current_occupancy).\
+        filter(Shelter.id == shelter_id).scalar()
+
+    days = range(first, last + 1)
+    arrivals = [counts.get(day, (0, 0))[0] for day in days]
+    departures = [counts.get(day, (0, 0))[1] for day in days]
+    nets = [a - d for a, d in zip(arrivals, departures)]
+
+    # End-of-day occupancy is today's minus everything that happened after
+    if numpy is not None:
+        after = numpy.cumsum(numpy.array(nets[::-1]))[::-1] - nets
+        levels = (current - later - after).tolist()
+    else:
+        levels = []
+        after = 0
+        for net in reversed(nets):
+            levels.append(current - later - after)
+            after += net
+        levels.reverse()
+
+    return [(daysToDate(day), a, d, level) for day, a, d, level in
+            zip(days, arrivals, departures, levels)]
+
+
+def hourlyActivity(session, shelter_id, since):
+    """(hour as a UTC datetime, arrivals, departures) for every hour with
+    activity at the shelter since the datetime since"""
+    table = occupancy_hourly_table
+    start = datetime.datetime.combine(EPOCH, datetime.time())
+    first_hour = int((since - start).total_seconds()) // SECONDS_PER_HOUR
+    return [(start + datetime.timedelta(hours=hour), arrivals, departures)
+            for hour, arrivals, departures in session.execute(
+                select([table.c.hour, table.c.arrivals, table.c.departures]).
+                where(table.c.shelter_id == shelter_id).
+                where(table.c.hour >= first_hour).
+                order_by(table.c.hour))]
+
+
+def rollUp(before=None):
+    """Roll up pending events and commit, skipping the write transaction
+    when there are none (older than the Unix time before)"""
+    pending = pendingEvents(database_queries.read_session, before)
+    # End the read snapshot so later reads see the new rollups
+    database_queries.read_session.rollback()
+
+    folded = 0
+    if pending:
+        folded = rollUpOccupancy(database_queries.session)
+        database_queries.session.commit()
+    print "Rolled up %d occupancy events\n" % folded
+
+
+if __name__ == '__main__':
+    parser = argparse.ArgumentParser(
+        description="Shelter occupancy history and capacity forecasts")
+    commands = parser.add_subparsers(dest="command")
+    commands.add_parser("rollup", help="fold new events into the rollups")
+    forecast = commands.add_parser(
+        "forecast", help="days until each shelter is full")
+    forecast.add_argument(
+        "--window", type=int, default=FORECAST_WINDOW, metavar="DAYS",
+        help="days of history to weigh (default: %d)" % FORECAST_WINDOW)
+    history = commands.add_parser(
+        "history", help="daily arrivals, departures and occupancy")
+    history.add_argument("shelter_id", type=int)
+    history.add_argument("--days", type=int, default=30)
+    hourly = commands.add_parser("hourly", help="hourly activity")
+    hourly.add_argument("shelter_id", type=int)
+    hourly.add_argument("--hours", type=int, default=48)
+    args = parser.parse_args()
+
+    database_queries.engine.echo = False
+    database_queries.read_engine.echo = False
+    session = database_queries.read_session
+
+    if args.command == "rollup":
+        rollUp()
+
+    elif args.command == "forecast":
+        # The forecast only reads complete days, so today's events can wait
+        rollUp(dateToDays(datetime.datetime.utcnow().date()) *
+               HOURS_PER_DAY * SECONDS_PER_HOUR)
+        print "Shelter                                      Occupancy  " \
+            "Per day  Days until full"
+        for shelter_id, name, occupancy, capacity, rate, until in \
+                forecastCapacity(session, args.window):
+            print "%-44s %4d/%-4d %+8.2f  %s" % (
+                name[:44], occupancy, capacity, rate,
+                "never" if until is None else "%.1f" % until)
+
+    elif args.command == "history":
+        rollUp()
+        today = datetime.datetime.utcnow().date()
+        for date, arrivals, departures, level in occupancyHistory(
+                session, args.shelter_id,
+                today - datetime.timedelta(args.days - 1), today):
+            print "%s  +%-4d -%-4d %5d" % (date, arrivals, departures, level)
+
+    elif args.command == "hourly":
+        rollUp()
+        since = datetime.datetime.utcnow() - datetime.timedelta(
+            hours=args.hours)
+        for hour, arrivals, departures in hourlyActivity(
+                session, args.shelter_id, since):
+            print "%s  +%-4d -%d" % (
+                hour.strftime("%Y-%m-%d %H:00"), arrivals, departures)
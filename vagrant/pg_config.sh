@@ -3,6 +3,7 @@ apt-get -qqy install postgresql python-psycopg2
 apt-get -qqy install python-flask python-sqlalchemy
 apt-get -qqy install python-pip
 pip install bleach
+pip install Pillow
 pip install oauth2client
 pip install requests
 pip install httplib2
@@ -10,9 +11,11 @@ pip install redis
 pip install passlib
 pip install itsdangerous
 pip install flask-httpauth
+pip install numpy
 su postgres -c 'createuser -dRS vagrant'
 su vagrant -c 'createdb'
 su vagrant -c 'createdb forum'
+su vagrant -c 'createdb puppyshelter'
 su vagrant -c 'psql forum -f /vagrant/forum/forum.sql'
 
 vagrantTip="[35m[1mThe shared directory is located at /vagrant\nTo access your shared files: cd /vagrant(B[m"
@@ -0,0 +1,252 @@
+import argparse
+import collections
+import datetime
+import json
+import os
+import re
+import shutil
+import sqlite3
+import sys
+import tempfile
+
+from memory_profile import useDatabase
+
+# Expected plans, checked in: {operation: {statement: [plan lines]}}
+EXPECTED_PLANS = os.path.join(
+    os.path.dirname(os.path.abspath(__file__)), 'query_plans.json')
+
+# Template size plans are captured against
+PLAN_PUPPIES = 10000
+
+# Plan lines that read a whole table or index, or sort in a temporary
+# B-tree because no index gives the order
+PROBLEM = re.compile(r'^SCAN (?!CONSTANT ROW)|USE TEMP B-TREE')
+
+# Statements EXPLAIN QUERY PLAN says something useful about
+PLANNED = ('SELECT', 'INSERT', 'UPDATE', 'DELETE', 'WITH')
+
+
+def normalizeSql(statement):
+    """Statement on one line, with IN lists of any length collapsed so
+    batches of different sizes compare equal"""
+    return re.sub(r'\?(?:, \?)+', '?, ...', " ".join(statement.split()))
+
+
+def problemKey(line):
+    """What a plan line is flagged as: the table for a scan, whichever index
+    (if any) it scans, or the temporary sort; None if it is fine"""
+    if not PROBLEM.search(line):
+        return None
+    if line.startswith('SCAN '):
+        return " ".join(line.split()[:2])
+    return line
+
+
+def normalizePlanLine(detail):
+    """SQLite before 3.36 says SCAN TABLE / SEARCH TABLE"""
+    return re.sub(r'^(SCAN|SEARCH) TABLE ', r'\1 ', detail)
+
+
+class PlanRecorder(object):
+    """before_cursor_execute listener that runs EXPLAIN QUERY PLAN for each
+    distinct statement executed while operation is set, on the same
+    connection, and files the plan under operation"""
+
+    def __init__(self):
+        self.operation = None
+        self.plans = collections.defaultdict(dict)
+
+    def __call__(self, conn, cursor, statement, parameters, context,
+                 executemany):
+        if self.operation is None or conn.dialect.name != 'sqlite' or \
+                not statement.lstrip().upper().startswith(PLANNED):
+            return
+
+        key = normalizeSql(statement)
+        if key in self.plans[self.operation]:
+            return
+
+        if executemany:
+            parameters = parameters[0]
+        rows = cursor.connection.execute(
+            "EXPLAIN QUERY PLAN " + statement, parameters).fetchall()
+        self.plans[self.operation][key] = [
+            normalizePlanLine(row[-1]) for row in rows]
+
+
+def operations(database_queries, puppypopulator, puppy_ids):
+    """(name, callable) for every report and mutation guarded, in the order
+    they run. puppy_ids are unadopted puppies they may adopt or delete."""
+    from sqlalchemy import func
+    from database_setup import Puppy
+    import occupancy
+
+    dq = database_queries
+    today = datetime.date.today()
+    arrivals = [("Plan%d" % i, "female", today - datetime.timedelta(30 * i),
+                 5.0 + i, i) for i in range(1, 6)]
+
+    def placePuppies():
+        dq.placePuppies(dq.session, arrivals)
+        dq.session.commit()
+
+    # Run twice below: first to insert the hour and day rows, then to add
+    # to them
+    def rollUpOccupancy():
+        occupancy.rollUpOccupancy(dq.session)
+        dq.session.commit()
+
+    def populatorPuppies():
+        session = puppypopulator.session
+        start = (session.query(func.max(Puppy.id)).scalar() or 0) + 1
+        puppypopulator.EnumeratePuppies(
+            puppypopulator.male_names[:10], start)
+
+    return [
+        ('puppiesByName', dq.sortAscendingName),
+        ('puppiesBornAfter', dq.sortLessthanSixMonthsOld),
+        ('puppiesByWeight', dq.sortAscendingWeight),
+        ('puppiesByShelter', dq.groupByShelter),
+        ('puppiesWithProfiles', dq.getPuppyAndProfile),
+        ('findPuppy', lambda: dq.findPuppy("Bela")),
+        ('findTagged', lambda: dq.findTagged(
+            ["good with cats"], ["hypoallergenic", "house trained"],
+            ["needs a yard"])),
+        ('changes', lambda: dq.printChanges(0, 100)),
+        ('joinWaitlist', lambda: dq.joinWaitlist(
+            1, gender="female", max_age_days=365, max_weight=30.0,
+            city="Oakland")),
+        ('checkInPuppy', lambda: dq.checkInPuppy(
+            "Plan", "female", today - datetime.timedelta(60), 12.5, 1)),
+        ('placePuppies', placePuppies),
+        ('rollUpOccupancy', rollUpOccupancy),
+        ('notifyAdopters', lambda: dq.notifyAdopters(100)),
+        ('adoptPuppy', lambda: dq.adoptPuppy(puppy_ids[0], [1])),
+        ('adoptPuppies', lambda: dq.adoptPuppies(
+            [(puppy_ids[1], [1, 2]), (puppy_ids[2], [3])])),
+        ('tagPuppy', lambda: dq.tagPuppy(puppy_ids[3], ["plan guard"])),
+        ('removePuppies', lambda: dq.removePuppies(puppy_ids[4:6])),
+        ('leaveWaitlist', lambda: dq.leaveWaitlist(1)),
+        ('rollUpOccupancy', rollUpOccupancy),
+        ('forecastCapacity', lambda: occupancy.forecastCapacity(
+            dq.read_session)),
+        ('occupancyHistory', lambda: occupancy.occupancyHistory(
+            dq.read_session, 1, today - datetime.timedelta(365), today)),
+        ('hourlyActivity', lambda: occupancy.hourlyActivity(
+            dq.read_session, 1, datetime.datetime.utcnow() -
+            datetime.timedelta(hours=48))),
+        ('populatorPuppies', populatorPuppies),
+        ('populatorTags', puppypopulator.CreateTags),
+    ]
+
+
+def capturePlans(puppies=PLAN_PUPPIES, path=None):
+    """Clone a template of puppies puppies to path (default: a temporary
+    file), run every operation against it and return the plans recorded.
+    See memory_profile.useDatabase() for when the database modules may
+    already be imported."""
+    directory = None
+    if path is None:
+        directory = tempfile.mkdtemp()
+        path = os.path.join(directory, 'plans.db')
+    try:
+        useDatabase(path)
+        from templates import cloneTemplate
+        cloneTemplate(path, puppies)
+
+        connection = sqlite3.connect(path)
+        puppy_ids = [puppy_id for (puppy_id,) in connection.execute(
+            "SELECT id FROM puppy WHERE id NOT IN "
+            "(SELECT puppy_id FROM puppies_adopters) ORDER BY id LIMIT 6")]
+        connection.close()
+
+        from sqlalchemy import event
+        from sqlalchemy.engine import Engine
+        import database_queries
+        import puppypopulator
+
+        database_queries.engine.echo = False
+        database_queries.read_engine.echo = False
+
+        recorder = PlanRecorder()
+        event.listen(Engine, 'before_cursor_execute', recorder)
+        try:
+            for name, operation in operations(
+                    database_queries, puppypopulator, puppy_ids):
+                database_queries.report_cache.clear()
+                recorder.operation = name
+                sys.stdout = open(os.devnull, "w")
+                try:
+                    operation()
+                finally:
+                    sys.stdout = sys.__stdout__
+                    recorder.operation = None
+        finally:
+            event.remove(Engine, 'before_cursor_execute', recorder)
+
+        return dict(recorder.plans)
+    finally:
+        if directory is not None:
+            shutil.rmtree(directory)
+
+
+def loadExpectedPlans():
+    with open(EXPECTED_PLANS) as expected_file:
+        return json.load(expected_file)
+
+
+def writeExpectedPlans(plans):
+    with open(EXPECTED_PLANS, 'w') as out:
+        json.dump(plans, out, indent=2, separators=(',', ': '),
+                  sort_keys=True)
+        out.write("\n")
+
+
+def comparePlans(plans, expected):
+    """(failures, unlisted): failures are (operation, statement, plan lines)
+    for statements whose plan has a scan or temporary sort their expected
+    plan doesn't, or that have one and no expected plan at all. unlisted
+    are statements with no expected plan but nothing to flag."""
+    failures = []
+    unlisted = []
+    for operation, statements in sorted(plans.items()):
+        for statement, plan in sorted(statements.items()):
+            problems = [line for line in plan if problemKey(line)]
+            known = expected.get(operation, {}).get(statement)
+            if known is not None:
+                accepted = set(problemKey(line) for line in known)
+                problems = [line for line in problems
+                            if problemKey(line) not in accepted]
+            if problems:
+                failures.append((operation, statement, problems))
+            elif known is None:
+                unlisted.append((operation, statement))
+    return failures, unlisted
+
+
+if __name__ == '__main__':
+    parser = argparse.ArgumentParser(
+        description="Accept the current query plans as expected. The check "
+        "itself is python -m unittest test_query_plans.")
+    parser.add_argument(
+        "--puppies", type=int, default=PLAN_PUPPIES,
+        help="template size to plan against (default: %d)" % PLAN_PUPPIES)
+    parser.add_argument(
+        "--update", action="store_true",
+        help="rewrite %s with the current plans" %
+        os.path.basename(EXPECTED_PLANS))
+    args = parser.parse_args()
+    if not args.update:
+        parser.error("run the check with python -m unittest "
+                     "test_query_plans, or pass --update to accept the "
+                     "current plans")
+
+    plans = capturePlans(args.puppies)
+    failures, unlisted = comparePlans(plans, loadExpectedPlans())
+    for operation, statement, problems in failures:
+        print "Accepting in %s: %s\n    %s" % (
+            operation, statement, "\n    ".join(problems))
+
+    writeExpectedPlans(plans)
+    print "Wrote %d plans for %d operations to %s" % (
+        sum(len(s) for s in plans.values()), len(plans), EXPECTED_PLANS)
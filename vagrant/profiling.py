@@ -0,0 +1,107 @@
+import argparse
+import collections
+import cProfile
+import os
+import pstats
+import sys
+import threading
+import time
+
+
+class StackSampler(object):
+    """Sample one thread's call stack at a fixed interval and count each
+    distinct stack, written out in the collapsed format flamegraph.pl reads"""
+
+    def __init__(self, thread_id, interval=0.001):
+        self.thread_id = thread_id
+        self.interval = interval
+        self.counts = collections.Counter()
+        self._stop = threading.Event()
+        self._thread = threading.Thread(target=self._run)
+        self._thread.daemon = True
+
+    def start(self):
+        self._thread.start()
+
+    def stop(self):
+        self._stop.set()
+        self._thread.join()
+
+    def _run(self):
+        while not self._stop.wait(self.interval):
+            frame = sys._current_frames().get(self.thread_id)
+            stack = []
+
+            while frame is not None:
+                code = frame.f_code
+                stack.append("%s (%s:%d)" % (
+                    code.co_name, os.path.basename(code.co_filename),
+                    code.co_firstlineno))
+                frame = frame.f_back
+
+            if stack:
+                self.counts[";".join(reversed(stack))] += 1
+
+    def write(self, path):
+        with open(path, "w") as f:
+            for stack, count in sorted(self.counts.items()):
+                f.write("%s %d\n" % (stack, count))
+
+
+def timeRuns(func, repeat=1):
+    """Call func repeat times and return the wall-clock time of each run"""
+    timings = []
+
+    for i in range(repeat):
+        start = time.time()
+        func()
+        timings.append(time.time() - start)
+
+    return timings
+
+
+def profileRuns(func, name, repeat=1, output_dir="profiles"):
+    """Run func under cProfile and the stack sampler. Writes
+    <name>-<timestamp>.pstats and .collapsed files to output_dir, prints the
+    top functions by cumulative time and returns the run timings"""
+    if not os.path.isdir(output_dir):
+        os.makedirs(output_dir)
+
+    prefix = os.path.join(
+        output_dir, "%s-%s" % (name, time.strftime("%Y%m%d-%H%M%S")))
+
+    profiler = cProfile.Profile()
+    sampler = StackSampler(threading.current_thread().ident)
+
+    sampler.start()
+    profiler.enable()
+    try:
+        timings = timeRuns(func, repeat)
+    finally:
+        profiler.disable()
+        sampler.stop()
+
+    profiler.dump_stats(prefix + ".pstats")
+    sampler.write(prefix + ".collapsed")
+
+    pstats.Stats(profiler).sort_stats("cumulative").print_stats(20)
+    print "Profile written to %s.pstats" % prefix
+    print "Collapsed stacks written to %s.collapsed" % prefix
+
+    return timings
+
+
+def parseRepeat(value):
+    """argparse type for --repeat: a whole number of runs, at least one"""
+    repeat = int(value)
+    if repeat < 1:
+        raise argparse.ArgumentTypeError("must run at least once")
+    return repeat
+
+
+def printTimings(name, timings):
+    """Print min/median/max of the run timings"""
+    timings = sorted(timings)
+    print "%s: %d run(s), min %.4fs, median %.4fs, max %.4fs" % (
+        name, len(timings), timings[0], timings[len(timings) // 2],
+        timings[-1])
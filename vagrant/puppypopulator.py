@@ -1,13 +1,20 @@
-from sqlalchemy import create_engine
+from sqlalchemy import create_engine, func
 from sqlalchemy.orm import sessionmaker
 
-from database_setup import Base, Shelter, Puppy, PuppyProfile, Adopter
+from database_setup import (
+	Base, Shelter, Puppy, PuppyProfile, Adopter, DATABASE_URL, dateToDays,
+	poundsToGrams)
+from name_lookup import rebuildNameIndex
+from tag_index import tagPuppies
 #from flask.ext.sqlalchemy import SQLAlchemy
 from random import randint
+from StringIO import StringIO
+import argparse
+import csv
 import datetime
 import random
 
-engine = create_engine('sqlite:///puppyshelter.db')
+engine = create_engine(DATABASE_URL)
 
 Base.metadata.bind = engine
 
@@ -17,20 +24,18 @@ session = DBSession()
 
 
 #Add Shelters
-shelter1 = Shelter(name="Oakland Animal Services", address="1101 29th Ave", city="Oakland", state="California", zipCode="94601", website="oaklandanimalservices.org", current_occupancy=0, maximum_capacity=31)
-session.add(shelter1)
+shelters = [
+	dict(name="Oakland Animal Services", address="1101 29th Ave", city="Oakland", county="Alameda", state="California", zipCode="94601", website="oaklandanimalservices.org", maximum_capacity=31),
+	dict(name="San Francisco SPCA Mission Adoption Center", address="250 Florida St", city="San Francisco", county="San Francisco", state="California", zipCode="94103", website="sfspca.org", maximum_capacity=15),
+	dict(name="Wonder Dog Rescue", address="2926 16th Street", city="San Francisco", county="San Francisco", state="California", zipCode="94103", website="http://wonderdogrescue.org", maximum_capacity=20),
+	dict(name="Humane Society of Alameda", address="PO Box 1571", city="Alameda", county="Alameda", state="California", zipCode="94501", website="hsalameda.org", maximum_capacity=15),
+	dict(name="Palo Alto Humane Society", address="1149 Chestnut St.", city="Menlo Park", county="San Mateo", state="California", zipCode="94025", website="paloaltohumane.org", maximum_capacity=20)]
 
-shelter2 = Shelter(name="San Francisco SPCA Mission Adoption Center", address="250 Florida St", city="San Francisco", state="California", zipCode="94103", website="sfspca.org", current_occupancy=0, maximum_capacity=15)
-session.add(shelter2)
 
-shelter3 = Shelter(name="Wonder Dog Rescue", address="2926 16th Street", city="San Francisco", state="California", zipCode="94103", website="http://wonderdogrescue.org", current_occupancy=0, maximum_capacity=20)
-session.add(shelter3)
-
-shelter4 = Shelter(name="Humane Society of Alameda", address="PO Box 1571", city="Alameda", state="California", zipCode="94501", website="hsalameda.org", current_occupancy=0, maximum_capacity=15)
-session.add(shelter4)
-
-shelter5 = Shelter(name="Palo Alto Humane Society", address="1149 Chestnut St.", city="Menlo Park", state="California", zipCode="94025", website="paloaltohumane.org", current_occupancy=0, maximum_capacity=20)
-session.add(shelter5)
+def CreateShelters():
+	session.add_all([Shelter(current_occupancy=0, **fields)
+		for fields in shelters])
+	session.commit()
 
 
 #Add Puppies
@@ -130,6 +135,73 @@ def CreatePuppiesAndProfiles():
 	EnumeratePuppies(female_names, 50, "female")
 
 
+# Bulk load Puppy and PuppyProfile rows with PostgreSQL's COPY instead of one
+# INSERT and commit per puppy. Ids are assigned here so profiles can reference
+# their puppy, and the id sequence is moved past them afterwards.
+def CopyPuppiesAndProfiles():
+	session.flush()
+	shelters = session.query(Shelter).order_by(Shelter.id).all()
+	start_id = (session.query(func.max(Puppy.id)).scalar() or 0) + 1
+
+	puppy_buf = StringIO()
+	profile_buf = StringIO()
+	puppy_writer = csv.writer(puppy_buf)
+	profile_writer = csv.writer(profile_buf)
+
+	names = [(x, "male") for x in male_names] + \
+		[(x, "female") for x in female_names]
+
+	for i, (x, gender_type) in enumerate(names, start=start_id):
+		vacant = [s for s in shelters
+			if s.current_occupancy < s.maximum_capacity]
+
+		if not vacant:
+			print "All shelters are full. Please open more shelters."
+			break
+
+		shelter = random.choice(vacant)
+		shelter.current_occupancy = shelter.current_occupancy + 1
+
+		puppy_writer.writerow([
+			i, x, gender_type, dateToDays(CreateRandomAge()),
+			poundsToGrams(CreateRandomWeight()), shelter.id])
+		profile_writer.writerow([
+			random.choice(puppy_images), random.choice(puppy_descriptions),
+			random.choice(puppy_special_needs), i])
+
+	puppy_buf.seek(0)
+	profile_buf.seek(0)
+
+	cursor = session.connection().connection.cursor()
+	cursor.copy_expert(
+		'COPY puppy (id, name, gender, birth_day, weight_grams, shelter_id) '
+		'FROM STDIN WITH CSV', puppy_buf)
+	cursor.copy_expert(
+		'COPY puppy_profile (picture, description, special_needs, puppy_id) '
+		'FROM STDIN WITH CSV', profile_buf)
+	cursor.execute(
+		"SELECT setval(pg_get_serial_sequence('puppy', 'id'), "
+		"(SELECT max(id) FROM puppy))")
+
+	session.commit()
+
+	# COPY bypasses the ORM events that maintain the name index
+	rebuildNameIndex(session)
+
+
+puppy_tags = [
+	"hypoallergenic", "good with cats", "good with kids", "senior-friendly",
+	"house trained", "leash trained", "apartment friendly", "needs a yard"]
+
+
+# Give each puppy up to three random tags (many-to-many relationship with Tag)
+def CreateTags():
+	assignments = [(puppy_id, random.sample(puppy_tags, randint(0, 3)))
+		for (puppy_id,) in session.query(Puppy.id)]
+	tagPuppies(session, assignments)
+	session.commit()
+
+
 # Create Adopters (many-to-many relationship with Puppy)
 def CreateAdopters():
 	james_smith = Adopter("James", "Smith")
@@ -138,5 +210,18 @@ def CreateAdopters():
 	session.add_all([james_smith, maggie_smith, crazy_dog_lady])
 	session.commit()
 
-CreatePuppiesAndProfiles()
-CreateAdopters()
+
+if __name__ == '__main__':
+	parser = argparse.ArgumentParser(description="Fill the database with sample shelters, puppies and adopters")
+	parser.add_argument("--seed", type=int, help="seed random for a repeatable population")
+	args = parser.parse_args()
+	if args.seed is not None:
+		random.seed(args.seed)
+
+	CreateShelters()
+	if engine.dialect.name == 'postgresql':
+		CopyPuppiesAndProfiles()
+	else:
+		CreatePuppiesAndProfiles()
+	CreateTags()
+	CreateAdopters()
@@ -0,0 +1,239 @@
+import argparse
+import collections
+
+from sqlalchemy import case, select
+
+import database_queries
+from database_setup import Puppy, Shelter, puppies_adopters_table
+
+# How far apart two shelters are, in steps: same city, same county, same
+# state, anywhere. Shelters have no coordinates, so this stands in for
+# distance when limiting transfers with max_distance.
+SAME_CITY, SAME_COUNTY, SAME_STATE, ANYWHERE = range(4)
+
+
+def shelterDistance(a, b):
+    """Distance step between two shelter rows"""
+    if a.state and a.state == b.state:
+        if a.county and a.county == b.county:
+            return SAME_CITY if a.city and a.city == b.city else SAME_COUNTY
+        return SAME_STATE
+    return ANYWHERE
+
+
+def occupancyTargets(shelters):
+    """{shelter id: occupancy} spreading the puppies housed over all
+    shelters in proportion to capacity, rounded so the totals still match"""
+    housed = sum(s.current_occupancy for s in shelters)
+    capacity = sum(s.maximum_capacity for s in shelters)
+    if not capacity:
+        return dict((s.id, s.current_occupancy) for s in shelters)
+
+    shares = dict((s.id, float(housed) * s.maximum_capacity / capacity)
+                  for s in shelters)
+    targets = dict((s_id, int(share)) for s_id, share in shares.items())
+
+    # Largest remainders get the puppies lost to rounding down
+    by_remainder = sorted(
+        shares, key=lambda s_id: (targets[s_id] - shares[s_id], s_id))
+    for s_id in by_remainder[:housed - sum(targets.values())]:
+        targets[s_id] += 1
+
+    return targets
+
+
+def minCostTransfers(surplus, deficit, cost):
+    """Min-cost flow from surplus {shelter id: puppies to give} to deficit
+    {shelter id: room to fill}, where cost(from_id, to_id) is the cost per
+    puppy, or None if that transfer is not allowed. Moves as many puppies
+    as possible, as cheaply as possible. Returns {(from_id, to_id): count}.
+
+    Successive shortest paths with Bellman-Ford (SPFA), which is plenty for
+    the few hundred shelters a county or state has."""
+    givers = sorted(surplus)
+    takers = sorted(deficit)
+    source, sink = 0, len(givers) + len(takers) + 1
+    graph = [[] for node in range(sink + 1)]
+
+    def addEdge(u, v, capacity, edge_cost):
+        # Edges are [to, residual capacity, cost, index of reverse edge]
+        graph[u].append([v, capacity, edge_cost, len(graph[v])])
+        graph[v].append([u, 0, -edge_cost, len(graph[u]) - 1])
+
+    transfers = []
+    for i, giver in enumerate(givers, 1):
+        addEdge(source, i, surplus[giver], 0)
+        for j, taker in enumerate(takers, len(givers) + 1):
+            edge_cost = cost(giver, taker)
+            if edge_cost is not None:
+                transfers.append((giver, taker, i, len(graph[i])))
+                addEdge(i, j, surplus[giver], edge_cost)
+    for j, taker in enumerate(takers, len(givers) + 1):
+        addEdge(j, sink, deficit[taker], 0)
+
+    while True:
+        dist = [None] * len(graph)
+        via = [None] * len(graph)
+        dist[source] = 0
+        queue = collections.deque([source])
+        queued = set(queue)
+
+        while queue:
+            u = queue.popleft()
+            queued.discard(u)
+            for index, (v, capacity, edge_cost, rev) in enumerate(graph[u]):
+                if capacity > 0 and (
+                        dist[v] is None or dist[u] + edge_cost < dist[v]):
+                    dist[v] = dist[u] + edge_cost
+                    via[v] = (u, index)
+                    if v not in queued:
+                        queue.append(v)
+                        queued.add(v)
+
+        if dist[sink] is None:
+            break
+
+        path = []
+        v = sink
+        while v != source:
+            u, index = via[v]
+            path.append(graph[u][index])
+            v = u
+
+        amount = min(edge[1] for edge in path)
+        for edge in path:
+            edge[1] -= amount
+            graph[edge[0]][edge[3]][1] += amount
+
+    # Flow on a transfer edge is what its reverse edge has gained
+    flows = {}
+    for giver, taker, node, index in transfers:
+        v, capacity, edge_cost, rev = graph[node][index]
+        if graph[v][rev][1]:
+            flows[(giver, taker)] = graph[v][rev][1]
+    return flows
+
+
+def planTransfers(shelters, max_distance=None, distance=shelterDistance):
+    """Transfers that bring every shelter as close as allowed to the same
+    utilization, moving puppies the shortest distances possible and never
+    further than max_distance. Returns (from_id, to_id, count, distance)
+    tuples, largest first."""
+    by_id = dict((s.id, s) for s in shelters)
+    targets = occupancyTargets(shelters)
+
+    surplus = dict((s.id, s.current_occupancy - targets[s.id])
+                   for s in shelters if s.current_occupancy > targets[s.id])
+    deficit = dict((s.id, targets[s.id] - s.current_occupancy)
+                   for s in shelters if s.current_occupancy < targets[s.id])
+
+    def cost(from_id, to_id):
+        steps = distance(by_id[from_id], by_id[to_id])
+        if max_distance is not None and steps > max_distance:
+            return None
+        return steps
+
+    flows = minCostTransfers(surplus, deficit, cost)
+    return sorted(
+        ((from_id, to_id, count, cost(from_id, to_id))
+         for (from_id, to_id), count in flows.items()),
+        key=lambda t: (-t[2], t[0], t[1]))
+
+
+def applyTransfers(db_session, transfers):
+    """Move puppies per transfers, without committing: one UPDATE of
+    puppy.shelter_id per transfer, taking the most recently checked-in
+    puppies that are not adopted, and one UPDATE for every shelter's
+    occupancy. Returns the number actually moved per transfer, which is
+    lower if a shelter houses fewer puppies than its occupancy says."""
+    adopted = select([puppies_adopters_table.c.puppy_id])
+    moved = []
+    deltas = collections.Counter()
+
+    for from_id, to_id, count, steps in transfers:
+        leaving = select([Puppy.id]).\
+            where(Puppy.shelter_id == from_id).\
+            where(~Puppy.id.in_(adopted)).\
+            order_by(Puppy.id.desc()).limit(count)
+        # Wrapped again so MySQL/SQLite accept LIMIT inside IN
+        result = db_session.execute(
+            Puppy.__table__.update().
+            where(Puppy.id.in_(select([leaving.alias().c.id]))).
+            values(shelter_id=to_id))
+
+        moved.append(result.rowcount)
+        deltas[from_id] -= result.rowcount
+        deltas[to_id] += result.rowcount
+
+    changed = [s_id for s_id, delta in deltas.items() if delta]
+    if changed:
+        db_session.query(Shelter).filter(Shelter.id.in_(changed)).update(
+            {Shelter.current_occupancy: Shelter.current_occupancy + case(
+                [(Shelter.id == s_id, deltas[s_id]) for s_id in changed],
+                else_=0)},
+            synchronize_session=False)
+
+    return moved
+
+
+def utilization(capacity, occupancy):
+    """(lowest, highest) occupancy/capacity over shelters"""
+    ratios = [float(occupancy[s_id]) / capacity[s_id]
+              for s_id in capacity if capacity[s_id]]
+    return (min(ratios), max(ratios)) if ratios else (0.0, 0.0)
+
+
+def rebalanceShelters(db_session, max_distance=None, dry_run=False):
+    """Plan transfers evening out shelter utilization and, unless dry_run,
+    apply them in one transaction. Prints the moves and utilization before
+    and after. Returns the planned transfers."""
+    # Locked for the whole plan-and-apply, so check-ins and adoptions
+    # can't change occupancy underneath the plan
+    shelters = db_session.query(Shelter).with_for_update().\
+        order_by(Shelter.id).all()
+    transfers = planTransfers(shelters, max_distance)
+
+    # Kept for the report, so it doesn't reload shelters after the
+    # transaction ends
+    names = dict((s.id, s.name) for s in shelters)
+    capacity = dict((s.id, s.maximum_capacity) for s in shelters)
+    before = dict((s.id, s.current_occupancy) for s in shelters)
+    if dry_run:
+        db_session.rollback()
+        moved = [count for from_id, to_id, count, steps in transfers]
+    else:
+        moved = applyTransfers(db_session, transfers)
+        db_session.commit()
+
+    after = collections.Counter(before)
+    print "%s %d transfers: \n" % (
+        "Planned" if dry_run else "Applied", len(transfers))
+
+    for (from_id, to_id, count, steps), done in zip(transfers, moved):
+        after[from_id] -= done
+        after[to_id] += done
+        print "%4d puppies  %s -> %s  (distance %d)" % (
+            done, names[from_id], names[to_id], steps)
+
+    print "\nUtilization %.0f%%-%.0f%% before, %.0f%%-%.0f%% after\n" % (
+        tuple(100 * r for r in utilization(capacity, before)) +
+        tuple(100 * r for r in utilization(capacity, after)))
+
+    return transfers
+
+
+if __name__ == '__main__':
+    parser = argparse.ArgumentParser(
+        description="Move puppies to even out shelter utilization")
+    parser.add_argument(
+        "--max-distance", type=int, choices=range(4), metavar="STEPS",
+        help="furthest transfer allowed: 0 same city, 1 same county, "
+        "2 same state, 3 anywhere (default: 3)")
+    parser.add_argument(
+        "--dry-run", action="store_true",
+        help="print the planned moves without applying them")
+    args = parser.parse_args()
+
+    database_queries.engine.echo = False
+    rebalanceShelters(
+        database_queries.session, args.max_distance, args.dry_run)
@@ -0,0 +1,77 @@
+import collections
+import functools
+import threading
+
+
+class ResultCache(object):
+    """Bounded LRU cache of query results. Each entry remembers the data
+    version it was computed at and is only served while that is still the
+    current version, so any write invalidates every entry at once."""
+
+    def __init__(self, max_entries=128):
+        self.max_entries = max_entries
+        self.entries = collections.OrderedDict()
+        self.lock = threading.Lock()
+        self.hits = 0
+        self.misses = 0
+        self.evictions = 0
+
+    def get(self, key, version):
+        """Return (True, result) if key is cached at version, else
+        (False, None)"""
+        with self.lock:
+            entry = self.entries.get(key)
+
+            if entry is None or entry[0] != version:
+                self.misses += 1
+                return False, None
+
+            # Move to the most recently used end
+            del self.entries[key]
+            self.entries[key] = entry
+            self.hits += 1
+            return True, entry[1]
+
+    def put(self, key, version, result):
+        with self.lock:
+            self.entries.pop(key, None)
+            self.entries[key] = (version, result)
+
+            while len(self.entries) > self.max_entries:
+                self.entries.popitem(last=False)
+                self.evictions += 1
+
+    def clear(self):
+        with self.lock:
+            self.entries.clear()
+
+    def stats(self):
+        with self.lock:
+            lookups = self.hits + self.misses
+            return {
+                'entries': len(self.entries),
+                'hits': self.hits,
+                'misses': self.misses,
+                'evictions': self.evictions,
+                'hit_rate': float(self.hits) / lookups if lookups else 0.0}
+
+
+def cachedResult(cache, current_version):
+    """Decorator caching a query function's result in cache, keyed by the
+    function's module and name and its arguments. current_version() is called on every lookup
+    and must change whenever the underlying data does. Results are shared
+    between callers, so the function should return immutable values."""
+    def decorator(query):
+        @functools.wraps(query)
+        def wrapper(*args):
+            key = (query.__module__, query.__name__) + args
+            version = current_version()
+
+            found, result = cache.get(key, version)
+            if not found:
+                result = query(*args)
+                cache.put(key, version, result)
+
+            return result
+        return wrapper
+    return decorator
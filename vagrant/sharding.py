@@ -0,0 +1,389 @@
+import argparse
+import glob
+import heapq
+import os
+import re
+import threading
+from multiprocessing.pool import ThreadPool
+
+from sqlalchemy import and_, create_engine, func, or_, select
+from sqlalchemy.orm import sessionmaker
+
+from database_queries import (
+    createReadEngine, createWriterEngine, placePuppy, recordAdoption)
+from database_setup import (
+    Adopter, Base, DATABASE_URL, occupancy_daily_table,
+    occupancy_events_table, occupancy_hourly_table, Puppy, PuppyProfile,
+    Shelter, Tag, puppies_adopters_table, puppy_tags_table, WaitlistEntry,
+    waitlist_matches_table)
+from name_lookup import rebuildNameIndex
+from tag_index import rebuildTagIndex
+from waitlist import locationKey
+
+# One SQLite file per (state, county) shard lives here
+SHARD_DIR = os.environ.get('SHARD_DIR', 'shards')
+
+
+def shardKey(state, county):
+    """File-safe shard name for a shelter's state and county, e.g.
+    california-alameda. Shelters missing either go to an 'unknown' part"""
+    parts = [re.sub(r'[^a-z0-9]+', '-', (value or 'unknown').lower()).
+             strip('-') or 'unknown' for value in (state, county)]
+    return '-'.join(parts)
+
+
+class Shard(object):
+    """Writer and read-only engines for one shard's database file"""
+
+    def __init__(self, key, path):
+        url = 'sqlite:///' + path
+        self.key = key
+        self.engine = createWriterEngine(url)
+        Base.metadata.create_all(self.engine)
+        self.read_engine = createReadEngine(url)
+        self.Session = sessionmaker(bind=self.engine, expire_on_commit=False)
+        self.ReadSession = sessionmaker(bind=self.read_engine)
+
+    def dispose(self):
+        self.engine.dispose()
+        self.read_engine.dispose()
+
+
+class ShardSet(object):
+    """The shards under directory. Shelters, and the puppies, profiles,
+    adoptions, tags, waitlist matches and occupancy history that belong to
+    them, are stored in the shard for the shelter's state and county. Ids
+    are only unique within a shard, so rows are addressed as (shard key,
+    id). Adopters are the exception: every shard has every adopter, under
+    the same id, so anyone can adopt in any county.
+
+    Writes go to one shard and take only that file's write lock, so intake
+    in different counties does not contend. Reports fan out to every shard
+    on a thread pool and merge the per-shard results, each already sorted by
+    its query, with a k-way merge."""
+
+    def __init__(self, directory=SHARD_DIR, threads=8):
+        self.directory = directory
+        self.threads = threads
+        self.lock = threading.Lock()
+        self.open_shards = {}
+
+    def shard(self, key):
+        """The shard named key, creating its database file if needed. A
+        new shard starts with a copy of the adopters of an existing one."""
+        with self.lock:
+            if key not in self.open_shards:
+                if not os.path.isdir(self.directory):
+                    os.makedirs(self.directory)
+                existing = self.keys()
+                shard = Shard(key, os.path.join(self.directory, key + '.db'))
+
+                if existing and key not in existing:
+                    source = create_engine('sqlite:///' + os.path.join(
+                        self.directory, existing[0] + '.db'))
+                    try:
+                        with shard.engine.begin() as target:
+                            copyRows(source, target, Adopter.__table__)
+                    finally:
+                        source.dispose()
+
+                self.open_shards[key] = shard
+            return self.open_shards[key]
+
+    def shardFor(self, state, county):
+        return self.shard(shardKey(state, county))
+
+    def keys(self):
+        """Keys of every shard with a database file, sorted"""
+        paths = glob.glob(os.path.join(self.directory, '*.db'))
+        return sorted(os.path.basename(path)[:-3] for path in paths)
+
+    def fanOut(self, query):
+        """Run query(session, shard_key) on a read session of every shard in
+        parallel. Returns the results in keys() order."""
+        def run(key):
+            session = self.shard(key).ReadSession()
+            try:
+                return query(session, key)
+            finally:
+                session.close()
+
+        pool = ThreadPool(self.threads)
+        try:
+            return pool.map(run, self.keys())
+        finally:
+            pool.close()
+            pool.join()
+
+    def close(self):
+        with self.lock:
+            for shard in self.open_shards.values():
+                shard.dispose()
+            self.open_shards.clear()
+
+
+def mergeSorted(results, key):
+    """k-way merge of lists that are each sorted by key (heapq.merge has no
+    key argument before Python 3.5). Ties keep the order of results."""
+    decorated = [[(key(row), i, row) for row in rows]
+                 for i, rows in enumerate(results)]
+    return [row for sort_key, i, row in heapq.merge(*decorated)]
+
+
+def addShelter(shards, **fields):
+    """Create a shelter in the shard for its state and county. Returns
+    (shard key, shelter id)."""
+    shard = shards.shardFor(fields.get('state'), fields.get('county'))
+    fields.setdefault('current_occupancy', 0)
+
+    db_session = shard.Session()
+    try:
+        shelter = Shelter(**fields)
+        db_session.add(shelter)
+        db_session.commit()
+        return shard.key, shelter.id
+    finally:
+        db_session.close()
+
+
+def addAdopter(shards, first_name, last_name):
+    """Register an adopter in every shard under one id, and return it.
+    Each shard's write lock is taken, in key order, before the id is chosen,
+    so concurrent registrations from other processes wait rather than
+    claiming the same id."""
+    sessions = [shards.shard(key).Session() for key in shards.keys()]
+    if not sessions:
+        raise ValueError("No shards; add a shelter or split a database first")
+
+    try:
+        adopter_id = 1 + max(
+            db_session.query(func.max(Adopter.id)).scalar() or 0
+            for db_session in sessions)
+
+        for db_session in sessions:
+            db_session.execute(Adopter.__table__.insert(), {
+                'id': adopter_id, 'first_name': first_name,
+                'last_name': last_name})
+
+        for db_session in sessions:
+            db_session.commit()
+        return adopter_id
+    finally:
+        for db_session in sessions:
+            db_session.close()
+
+
+def checkInPuppy(shards, puppy_name, puppy_gender, puppy_dob, puppy_weight,
+                 state, county, shelter_id):
+    """placePuppy in shelter_id of the shard for the shelter's state and
+    county. When it is full the puppy goes to the emptiest shelter in the
+    same county. Returns the new puppy's (shard key, id), or False if every
+    shelter there is full."""
+    shard = shards.shardFor(state, county)
+    db_session = shard.Session()
+    try:
+        new_puppy = placePuppy(
+            db_session, puppy_name, puppy_gender, puppy_dob, puppy_weight,
+            shelter_id)
+
+        if(new_puppy is None):
+            db_session.rollback()
+            return False
+
+        db_session.commit()
+        return shard.key, new_puppy.id
+    finally:
+        db_session.close()
+
+
+def adoptPuppy(shards, shard_key, puppy_id, adopters_list):
+    """recordAdoption in the puppy's shard, adopters_list being ids from
+    addAdopter(). Returns False if the puppy was already adopted."""
+    db_session = shards.shard(shard_key).Session()
+    try:
+        puppy, adopted = recordAdoption(db_session, puppy_id, adopters_list)
+        db_session.commit()
+        return adopted
+    finally:
+        db_session.close()
+
+
+def puppiesByName(shards):
+    """(name, shard_key, puppy_id) of every puppy in every shard, in
+    ascending alphabetical order"""
+    def query(session, key):
+        return [(name, key, puppy_id) for puppy_id, name in
+                session.query(Puppy.id, Puppy.name).
+                order_by(Puppy.name, Puppy.id)]
+
+    return mergeSorted(shards.fanOut(query), key=lambda row: row[0])
+
+
+def puppiesByShelter(shards):
+    """(shelter_name, puppy_name, shard_key) ordered by shelter, then puppy
+    name"""
+    def query(session, key):
+        return [(shelter_name, puppy_name, key)
+                for puppy_name, shelter_name in session.query(
+                    Puppy.name, Shelter.name).
+                filter(Puppy.shelter_id == Shelter.id).
+                order_by(Shelter.name, Puppy.name)]
+
+    return mergeSorted(
+        shards.fanOut(query), key=lambda row: (row[0], row[1]))
+
+
+def sortAscendingName(shards):
+    """Print all puppies across shards in ascending alphabetical order"""
+    print "Sort Puppies by name alphabetically: \n"
+
+    for name, key, puppy_id in puppiesByName(shards):
+        print(key, puppy_id, name)
+
+    print "\n"
+
+
+def groupByShelter(shards):
+    """Print all puppies across shards grouped by shelter name"""
+    print "Sort Puppies by shelter name ascending \n"
+
+    for shelter_name, puppy_name, key in puppiesByShelter(shards):
+        print(puppy_name, shelter_name, key)
+
+    print "\n"
+
+
+def copyRows(source, target, table, where=None):
+    rows = source.execute(
+        select([table]) if where is None else select([table]).where(where))
+    batch = rows.fetchmany(1000)
+    while batch:
+        target.execute(table.insert(), [dict(row) for row in batch])
+        batch = rows.fetchmany(1000)
+
+
+def splitDatabase(shards, source_url=DATABASE_URL):
+    """Copy a single-file database into shards, one per shelter state and
+    county, keeping row ids. Every adopter is copied to every shard. A
+    waitlist entry goes to each shard it could match in: its shelter's, any
+    with a shelter in its city, or all of them when it names neither.
+    Occupancy events and rollups, and pending matches, go with their
+    shelter and puppy. Puppies without a shelter stay behind. Shards that
+    already have a file are left alone, so a split that failed part way can
+    simply be rerun; delete the shard directory to split again from
+    scratch. Returns {shard key: shelters copied} for the shards written."""
+    source = create_engine(source_url)
+    shelters = source.execute(select(
+        [Shelter.id, Shelter.state, Shelter.county, Shelter.city])).fetchall()
+
+    by_shard = {}
+    cities = {}
+    for shelter_id, state, county, city in shelters:
+        key = shardKey(state, county)
+        by_shard.setdefault(key, []).append(shelter_id)
+        cities.setdefault(key, set()).add(locationKey(None, city))
+
+    # Entries waiting on a city, by the city's location key
+    city_entries = {}
+    for entry_id, city in source.execute(
+            select([WaitlistEntry.id, WaitlistEntry.city]).
+            where(WaitlistEntry.shelter_id.is_(None)).
+            where(WaitlistEntry.city != '')):
+        city_entries.setdefault(locationKey(None, city), []).append(entry_id)
+
+    if not os.path.isdir(shards.directory):
+        os.makedirs(shards.directory)
+
+    copied = {}
+    for key, shelter_ids in sorted(by_shard.items()):
+        path = os.path.join(shards.directory, key + '.db')
+        if os.path.exists(path):
+            continue
+
+        # Built under another name and renamed once complete, so a failed
+        # split never leaves a partial shard that a rerun would skip
+        partial = os.path.join(shards.directory, key + '.partial')
+        for leftover in (partial, partial + '-wal', partial + '-shm'):
+            if os.path.exists(leftover):
+                os.remove(leftover)
+
+        shard = Shard(key, partial)
+        try:
+            db_session = shard.Session()
+            target = db_session.connection()
+
+            puppy_ids = select([Puppy.id]).where(
+                Puppy.shelter_id.in_(shelter_ids))
+            adopters = puppies_adopters_table.c
+            tags = puppy_tags_table.c
+            matches = waitlist_matches_table.c
+            entry_ids = [entry_id for city in cities[key]
+                         for entry_id in city_entries.get(city, [])]
+            entries = or_(
+                WaitlistEntry.shelter_id.in_(shelter_ids),
+                WaitlistEntry.id.in_(entry_ids),
+                and_(WaitlistEntry.shelter_id.is_(None),
+                     func.coalesce(WaitlistEntry.city, '') == ''))
+
+            copyRows(source, target, Shelter.__table__,
+                     Shelter.id.in_(shelter_ids))
+            copyRows(source, target, Puppy.__table__,
+                     Puppy.shelter_id.in_(shelter_ids))
+            copyRows(source, target, PuppyProfile.__table__,
+                     PuppyProfile.puppy_id.in_(puppy_ids))
+            copyRows(source, target, Adopter.__table__)
+            copyRows(source, target, puppies_adopters_table,
+                     adopters.puppy_id.in_(puppy_ids))
+            copyRows(source, target, Tag.__table__)
+            copyRows(source, target, puppy_tags_table,
+                     tags.puppy_id.in_(puppy_ids))
+            copyRows(source, target, WaitlistEntry.__table__, entries)
+            copyRows(source, target, waitlist_matches_table,
+                     matches.puppy_id.in_(puppy_ids) & matches.entry_id.in_(
+                         select([WaitlistEntry.id]).where(entries)))
+            for table in (occupancy_events_table, occupancy_hourly_table,
+                          occupancy_daily_table):
+                copyRows(source, target, table,
+                         table.c.shelter_id.in_(shelter_ids))
+
+            # Both commit; the copied rows bypassed the ORM events
+            rebuildTagIndex(db_session)
+            rebuildNameIndex(db_session)
+            db_session.close()
+        finally:
+            shard.dispose()
+
+        os.rename(partial, path)
+        copied[key] = len(shelter_ids)
+
+    source.dispose()
+    return copied
+
+
+if __name__ == '__main__':
+    parser = argparse.ArgumentParser(
+        description="Puppy shelter databases sharded by state and county")
+    parser.add_argument(
+        "--shard-dir", default=SHARD_DIR,
+        help="directory of shard files (default: %s)" % SHARD_DIR)
+    commands = parser.add_subparsers(dest="command")
+    commands.add_parser(
+        "split", help="copy DATABASE_URL into per-county shards")
+    commands.add_parser("sort-name", help="puppies by name, all shards")
+    commands.add_parser(
+        "group-by-shelter", help="puppies grouped by shelter, all shards")
+    args = parser.parse_args()
+
+    shards = ShardSet(args.shard_dir)
+    if args.command == "split":
+        copied = splitDatabase(shards)
+        for key in shards.keys():
+            if key in copied:
+                print "%s: %d shelters" % (key, copied[key])
+            else:
+                print "%s: already split, skipped" % key
+    elif args.command == "sort-name":
+        sortAscendingName(shards)
+    else:
+        groupByShelter(shards)
+    shards.close()
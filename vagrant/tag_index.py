@@ -0,0 +1,309 @@
+import binascii
+import collections
+import itertools
+import operator
+import zlib
+
+from sqlalchemy import event, func, inspect, select
+from sqlalchemy.orm import Session
+
+from database_setup import (
+    Puppy, Tag, puppy_tag_postings_table, puppy_tags_table)
+
+# Puppy ids per bitmap chunk. A chunk is 8 KB uncompressed; sparse ones
+# compress to a few dozen bytes
+CHUNK_BITS = 65536
+CHUNK_BYTES = CHUNK_BITS // 8
+EMPTY_CHUNK = bytearray(CHUNK_BYTES)
+
+# Keep IN lists under SQLite's default limit of 999 bound parameters
+IN_BATCH = 500
+
+# Set bit positions of every byte value, for walking a bitmap
+BYTE_BITS = [[bit for bit in range(8) if value >> bit & 1]
+             for value in range(256)]
+
+
+def tagKey(name):
+    """Normalized tag name: tags match case-insensitively, whatever the
+    spacing"""
+    return " ".join(name.lower().split())
+
+
+def batches(values):
+    values = list(values)
+    for start in range(0, len(values), IN_BATCH):
+        yield values[start:start + IN_BATCH]
+
+
+def packBitmap(bits):
+    return zlib.compress(str(bits))
+
+
+def unpackBitmap(blob):
+    return bytearray(zlib.decompress(blob))
+
+
+def bitmapToInt(bits):
+    """Little-endian bitmap as an integer whose bit n is puppy id n, so AND,
+    OR and NOT of whole postings run as single integer operations"""
+    return int(binascii.hexlify(str(bits[::-1])) or '0', 16)
+
+
+def intToIds(value):
+    """Puppy ids whose bits are set in value, ascending"""
+    digits = '%x' % value
+    data = bytearray(binascii.unhexlify('0' * (len(digits) % 2) + digits))
+    data.reverse()
+
+    ids = []
+    for offset, byte in enumerate(data):
+        if byte:
+            ids.extend(offset * 8 + bit for bit in BYTE_BITS[byte])
+    return ids
+
+
+def tagIds(connection, keys, create=False):
+    """{tag key: id} for the tags named by keys, creating missing tags if
+    create is set"""
+    keys = set(keys)
+    found = {}
+    for batch in batches(keys):
+        found.update(connection.execute(
+            select([Tag.name, Tag.id]).where(Tag.name.in_(batch))).
+            fetchall())
+
+    missing = keys - set(found)
+    if create and missing:
+        connection.execute(
+            Tag.__table__.insert(), [{'name': key} for key in missing])
+        return tagIds(connection, keys)
+
+    return found
+
+
+def storeChunk(connection, tag_id, chunk, bits, existed):
+    """Write back one edited chunk, dropping it once it is empty"""
+    table = puppy_tag_postings_table
+    key = (table.c.tag_id == tag_id) & (table.c.chunk == chunk)
+
+    if bits == EMPTY_CHUNK:
+        if existed:
+            connection.execute(table.delete().where(key))
+    elif existed:
+        connection.execute(
+            table.update().where(key).values(bitmap=packBitmap(bits)))
+    else:
+        connection.execute(table.insert().values(
+            tag_id=tag_id, chunk=chunk, bitmap=packBitmap(bits)))
+
+
+def updatePostings(connection, tag_id, puppy_ids, present):
+    """Set (present) or clear the bits of puppy_ids in tag_id's posting"""
+    table = puppy_tag_postings_table
+    offsets = collections.defaultdict(list)
+    for puppy_id in puppy_ids:
+        offsets[puppy_id // CHUNK_BITS].append(puppy_id % CHUNK_BITS)
+
+    for chunk in sorted(offsets):
+        # Locked so concurrent PostgreSQL writers don't lose each other's
+        # bits; SQLite writers already hold the database write lock
+        blob = connection.execute(
+            select([table.c.bitmap]).
+            where((table.c.tag_id == tag_id) & (table.c.chunk == chunk)).
+            with_for_update()).scalar()
+        if blob is None and not present:
+            continue
+
+        bits = bytearray(EMPTY_CHUNK) if blob is None else unpackBitmap(blob)
+        for offset in offsets[chunk]:
+            if present:
+                bits[offset >> 3] |= 1 << (offset & 7)
+            else:
+                bits[offset >> 3] &= ~(1 << (offset & 7)) & 0xFF
+
+        storeChunk(connection, tag_id, chunk, bits, blob is not None)
+
+
+def clearPuppies(connection, puppy_ids):
+    """Remove puppies from every posting, e.g. once they are deleted"""
+    table = puppy_tag_postings_table
+    offsets = collections.defaultdict(list)
+    for puppy_id in puppy_ids:
+        offsets[puppy_id // CHUNK_BITS].append(puppy_id % CHUNK_BITS)
+
+    for chunk in sorted(offsets):
+        rows = connection.execute(
+            select([table.c.tag_id, table.c.bitmap]).
+            where(table.c.chunk == chunk).with_for_update()).fetchall()
+
+        for tag_id, blob in rows:
+            bits = unpackBitmap(blob)
+            for offset in offsets[chunk]:
+                bits[offset >> 3] &= ~(1 << (offset & 7)) & 0xFF
+            storeChunk(connection, tag_id, chunk, bits, True)
+
+
+def tagPuppies(db_session, assignments, present=True):
+    """Add tags to puppies from (puppy_id, [tag names]) pairs, creating tags
+    as needed, or remove them if present is False, without committing.
+    Returns the number of puppy/tag links added or removed."""
+    connection = db_session.connection()
+    table = puppy_tags_table
+    keys = set(tagKey(n) for puppy_id, names in assignments for n in names)
+    ids = tagIds(connection, keys, create=present)
+
+    links = set((puppy_id, ids[tagKey(n)])
+                for puppy_id, names in assignments
+                for n in names if tagKey(n) in ids)
+
+    existing = set()
+    for batch in batches(set(puppy_id for puppy_id, tag_id in links)):
+        existing.update(tuple(row) for row in connection.execute(
+            select([table.c.puppy_id, table.c.tag_id]).
+            where(table.c.puppy_id.in_(batch))))
+
+    changed = links - existing if present else links & existing
+    if not changed:
+        return 0
+
+    if present:
+        connection.execute(table.insert(), [
+            {'puppy_id': puppy_id, 'tag_id': tag_id}
+            for puppy_id, tag_id in changed])
+    else:
+        for puppy_id, tag_id in changed:
+            connection.execute(table.delete().where(
+                (table.c.puppy_id == puppy_id) & (table.c.tag_id == tag_id)))
+
+    by_tag = collections.defaultdict(list)
+    for puppy_id, tag_id in changed:
+        by_tag[tag_id].append(puppy_id)
+    for tag_id, puppy_ids in by_tag.items():
+        updatePostings(connection, tag_id, puppy_ids, present)
+
+    return len(changed)
+
+
+def rebuildTagIndex(session):
+    """Rebuild every posting from puppy_tags. Run after bulk loads that
+    bypass tagPuppies() and the ORM (e.g. COPY or Core inserts)"""
+    connection = session.connection()
+    table = puppy_tags_table
+    connection.execute(puppy_tag_postings_table.delete())
+
+    rows = connection.execute(
+        select([table.c.tag_id, table.c.puppy_id]).
+        order_by(table.c.tag_id))
+
+    # One tag's chunks in memory at a time
+    for tag_id, links in itertools.groupby(rows, operator.itemgetter(0)):
+        chunks = collections.defaultdict(lambda: bytearray(EMPTY_CHUNK))
+        for tag_id, puppy_id in links:
+            offset = puppy_id % CHUNK_BITS
+            chunks[puppy_id // CHUNK_BITS][offset >> 3] |= 1 << (offset & 7)
+
+        connection.execute(puppy_tag_postings_table.insert(), [
+            {'tag_id': tag_id, 'chunk': chunk, 'bitmap': packBitmap(bits)}
+            for chunk, bits in chunks.items()])
+
+    session.commit()
+
+
+@event.listens_for(Session, 'after_flush')
+def indexTagChanges(session, flush_context):
+    """Keep the postings current for tags changed through Puppy.tags or
+    Tag.puppies, and drop deleted puppies and tags from them"""
+    added = collections.defaultdict(list)
+    removed = collections.defaultdict(list)
+
+    for obj in itertools.chain(session.new, session.dirty):
+        if isinstance(obj, Puppy):
+            history = inspect(obj).attrs.tags.history
+            for tag in history.added or ():
+                added[tag.id].append(obj.id)
+            for tag in history.deleted or ():
+                removed[tag.id].append(obj.id)
+        elif isinstance(obj, Tag):
+            history = inspect(obj).attrs.puppies.history
+            for puppy in history.added or ():
+                added[obj.id].append(puppy.id)
+            for puppy in history.deleted or ():
+                removed[obj.id].append(puppy.id)
+
+    deleted_puppies = [obj.id for obj in session.deleted
+                       if isinstance(obj, Puppy)]
+    deleted_tags = [obj.id for obj in session.deleted if isinstance(obj, Tag)]
+    if not (added or removed or deleted_puppies or deleted_tags):
+        return
+
+    connection = session.connection()
+    for tag_id, puppy_ids in removed.items():
+        updatePostings(connection, tag_id, puppy_ids, False)
+    for tag_id, puppy_ids in added.items():
+        updatePostings(connection, tag_id, puppy_ids, True)
+    if deleted_puppies:
+        clearPuppies(connection, deleted_puppies)
+    for batch in batches(deleted_tags):
+        connection.execute(puppy_tag_postings_table.delete().where(
+            puppy_tag_postings_table.c.tag_id.in_(batch)))
+
+
+def loadPostings(session, tag_ids):
+    """{tag_id: posting as an integer bitmap} for tag_ids"""
+    table = puppy_tag_postings_table
+    chunks = collections.defaultdict(dict)
+    for batch in batches(tag_ids):
+        for tag_id, chunk, blob in session.execute(
+                select([table.c.tag_id, table.c.chunk, table.c.bitmap]).
+                where(table.c.tag_id.in_(batch))):
+            chunks[tag_id][chunk] = unpackBitmap(blob)
+
+    postings = dict((tag_id, 0) for tag_id in tag_ids)
+    for tag_id, by_chunk in chunks.items():
+        data = bytearray(CHUNK_BYTES * (max(by_chunk) + 1))
+        for chunk, bits in by_chunk.items():
+            data[chunk * CHUNK_BYTES:(chunk + 1) * CHUNK_BYTES] = bits
+        postings[tag_id] = bitmapToInt(data)
+
+    return postings
+
+
+def allPuppies(session):
+    """Bitmap of every puppy id: the universe for queries with only
+    none_of tags. Scans the puppy table"""
+    max_id = session.query(func.max(Puppy.id)).scalar() or 0
+    data = bytearray(max_id // 8 + 1)
+    for (puppy_id,) in session.query(Puppy.id).filter(Puppy.id <= max_id).\
+            yield_per(10000):
+        data[puppy_id >> 3] |= 1 << (puppy_id & 7)
+    return bitmapToInt(data)
+
+
+def puppyIdsWithTags(session, all_of=(), any_of=(), none_of=()):
+    """Ids of puppies that have every tag in all_of, at least one in any_of
+    (if given) and none in none_of, ascending.
+
+    Evaluated on the tag postings, one integer AND/OR/NOT per tag, with no
+    joins through puppy_tags. Unknown tag names match no puppies."""
+    ids = tagIds(session, [tagKey(name) for name in
+                           itertools.chain(all_of, any_of, none_of)])
+    postings = loadPostings(session, ids.values())
+
+    def posting(name):
+        tag_id = ids.get(tagKey(name))
+        return 0 if tag_id is None else postings[tag_id]
+
+    result = None
+    if all_of:
+        result = reduce(operator.and_, map(posting, all_of))
+    if any_of:
+        either = reduce(operator.or_, map(posting, any_of))
+        result = either if result is None else result & either
+    if result is None:
+        result = allPuppies(session)
+
+    for name in none_of:
+        result &= ~posting(name)
+
+    return intToIds(result)
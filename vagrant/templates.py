@@ -0,0 +1,266 @@
+import argparse
+import datetime
+import glob
+import hashlib
+import os
+import random
+import shutil
+import sqlite3
+import tempfile
+import time
+
+from sqlalchemy import create_engine
+from sqlalchemy.orm import sessionmaker
+from sqlalchemy.pool import StaticPool
+
+from database_setup import (
+    Adopter, Base, dateToDays, Puppy, PuppyProfile, Shelter, Tag,
+    change_log_table, puppies_adopters_table, puppy_tags_table)
+from name_lookup import rebuildNameIndex
+from puppypopulator import (
+    female_names, male_names, puppy_descriptions, puppy_images,
+    puppy_special_needs, puppy_tags, shelters)
+from tag_index import rebuildTagIndex
+
+# Built templates are cached here, one SQLite file per size, seed, date and
+# schema
+TEMPLATE_DIR = os.environ.get('TEMPLATE_DIR', 'template_cache')
+
+# Rows per bulk insert
+INSERT_BATCH = 10000
+
+# Template shape: a shelter per PUPPIES_PER_SHELTER puppies (at least the
+# populator's five), ADOPTED of the puppies adopted, one adopter per
+# PUPPIES_PER_ADOPTER puppies, and shelters filled to about FILL of capacity
+PUPPIES_PER_SHELTER = 1000
+ADOPTED = 0.1
+PUPPIES_PER_ADOPTER = 10
+FILL = 0.75
+
+# schemaVersion(), once computed
+SCHEMA_VERSION = []
+
+last_names = [
+    "Smith", "Johnson", "Williams", "Brown", "Jones", "Garcia", "Miller",
+    "Davis", "Rodriguez", "Martinez", "Hernandez", "Lopez", "Gonzalez",
+    "Wilson", "Anderson", "Thomas", "Taylor", "Moore", "Jackson", "Martin"]
+
+
+def schemaVersion():
+    """Short hash of the schema create_all() builds, tables, indexes and
+    triggers included, so templates are rebuilt whenever it changes"""
+    if SCHEMA_VERSION:
+        return SCHEMA_VERSION[0]
+
+    engine = create_engine('sqlite://')
+    Base.metadata.create_all(engine)
+    ddl = [sql for (sql,) in engine.execute(
+        "SELECT sql FROM sqlite_master WHERE sql IS NOT NULL "
+        "ORDER BY type, name")]
+    engine.dispose()
+    SCHEMA_VERSION.append(hashlib.sha1("\n".join(ddl)).hexdigest()[:10])
+    return SCHEMA_VERSION[0]
+
+
+def templatePath(puppies, seed=0, as_of=None, directory=TEMPLATE_DIR):
+    """Cache file for a template, e.g.
+    template_cache/puppies-100000-seed0-2016-06-01-1f2e3d4c5b.db"""
+    as_of = as_of or datetime.date.today()
+    return os.path.join(directory, "puppies-%d-seed%d-%s-%s.db" % (
+        puppies, seed, as_of.isoformat(), schemaVersion()))
+
+
+def insertRows(connection, table, rows):
+    for start in range(0, len(rows), INSERT_BATCH):
+        connection.execute(table.insert(), rows[start:start + INSERT_BATCH])
+
+
+def buildTemplate(path, puppies, seed=0, as_of=None):
+    """Write a database with puppies puppies to path. Everything comes from
+    random.Random(seed), and ages count back from as_of (default: today),
+    so the same arguments always give the same rows and ids.
+
+    Shelters reuse the populator's five locations; puppies get profiles and
+    up to three tags, and a tenth of them are adopted. Rows go in with Core
+    bulk inserts in one transaction, then the tag and name indexes are
+    rebuilt. The triggers' change_log entries are dropped, so clones start
+    at version 0."""
+    rng = random.Random(seed)
+    today = dateToDays(as_of or datetime.date.today())
+
+    shelter_rows = []
+    for i in range(max(len(shelters), puppies // PUPPIES_PER_SHELTER)):
+        shelter = dict(shelters[i % len(shelters)], id=i + 1)
+        if i >= len(shelters):
+            shelter['name'] = "%s %d" % (shelter['name'], i // len(shelters)
+                                         + 1)
+        shelter_rows.append(shelter)
+
+    puppy_rows = []
+    profile_rows = []
+    for puppy_id in range(1, puppies + 1):
+        gender = rng.choice(["male", "female"])
+        puppy_rows.append({
+            'id': puppy_id,
+            'name': rng.choice(male_names if gender == "male"
+                               else female_names),
+            'gender': gender,
+            'birth_day': today - rng.randint(0, 540),
+            'weight_grams': rng.randint(450, 18000),
+            'shelter_id': rng.randint(1, len(shelter_rows))})
+        profile_rows.append({
+            'id': puppy_id,
+            'picture': rng.choice(puppy_images),
+            'description': rng.choice(puppy_descriptions),
+            'special_needs': rng.choice(puppy_special_needs),
+            'puppy_id': puppy_id})
+
+    adopter_rows = [
+        {'id': i, 'first_name': rng.choice(male_names + female_names),
+         'last_name': rng.choice(last_names)}
+        for i in range(1, puppies // PUPPIES_PER_ADOPTER + 2)]
+    adopted = sorted(rng.sample(range(1, puppies + 1),
+                                int(puppies * ADOPTED)))
+    adoption_rows = [
+        {'puppy_id': puppy_id, 'adopter_id': adopter_id}
+        for puppy_id in adopted
+        for adopter_id in rng.sample(range(1, len(adopter_rows) + 1),
+                                     min(rng.randint(1, 2),
+                                         len(adopter_rows)))]
+
+    tag_rows = [{'id': i, 'name': name}
+                for i, name in enumerate(puppy_tags, 1)]
+    puppy_tag_rows = [
+        {'puppy_id': puppy_id, 'tag_id': tag_id}
+        for puppy_id in range(1, puppies + 1)
+        for tag_id in sorted(rng.sample(range(1, len(tag_rows) + 1),
+                                        rng.randint(0, 3)))]
+
+    # Occupancy counts the puppies not adopted; capacity leaves room
+    adopted = set(adopted)
+    for shelter in shelter_rows:
+        shelter['current_occupancy'] = 0
+    for puppy in puppy_rows:
+        if puppy['id'] not in adopted:
+            shelter_rows[puppy['shelter_id'] - 1]['current_occupancy'] += 1
+    for shelter in shelter_rows:
+        shelter['maximum_capacity'] = max(
+            int(shelter['current_occupancy'] / FILL), 10)
+
+    engine = create_engine('sqlite:///' + path)
+    Base.metadata.create_all(engine)
+    with engine.begin() as connection:
+        for table, rows in [
+                (Shelter.__table__, shelter_rows),
+                (Puppy.__table__, puppy_rows),
+                (PuppyProfile.__table__, profile_rows),
+                (Adopter.__table__, adopter_rows),
+                (puppies_adopters_table, adoption_rows),
+                (Tag.__table__, tag_rows),
+                (puppy_tags_table, puppy_tag_rows)]:
+            insertRows(connection, table, rows)
+
+    # Both commit; the rows above bypassed the ORM events
+    session = sessionmaker(bind=engine)()
+    rebuildTagIndex(session)
+    rebuildNameIndex(session)
+    session.close()
+
+    engine.execute(change_log_table.delete())
+    engine.execute("DELETE FROM sqlite_sequence WHERE name = 'change_log'")
+    engine.execute("VACUUM")
+    engine.dispose()
+
+
+def ensureTemplate(puppies, seed=0, as_of=None, directory=TEMPLATE_DIR):
+    """Path of the cached template, building it first if it is missing.
+    Built under a temporary name and renamed, so concurrent builders never
+    see a half-written file."""
+    path = templatePath(puppies, seed, as_of, directory)
+    if not os.path.exists(path):
+        if not os.path.isdir(directory):
+            os.makedirs(directory)
+        handle, partial = tempfile.mkstemp('.partial', dir=directory)
+        os.close(handle)
+        try:
+            buildTemplate(partial, puppies, seed, as_of)
+            # mkstemp creates the file readable by its owner only
+            os.chmod(partial, 0o644)
+            os.rename(partial, path)
+        finally:
+            if os.path.exists(partial):
+                os.remove(partial)
+    return path
+
+
+def cloneTemplate(target, puppies, seed=0, as_of=None):
+    """Copy the template for puppies and seed to the file target, building
+    it once if needed. Templates are single files (rollback journal, no
+    WAL), so a plain file copy is a complete database."""
+    shutil.copyfile(ensureTemplate(puppies, seed, as_of), target)
+    return 'sqlite:///' + target
+
+
+def memoryEngine(puppies, seed=0, as_of=None):
+    """Engine on a private in-memory copy of the template for puppies and
+    seed. The template is attached and copied table by table with
+    INSERT ... SELECT, then indexes and triggers are created, all inside
+    SQLite.
+
+    backup.py's backupDatabase() is not used: it reaches SQLite's backup API
+    through ctypes handles of its own, and a :memory: database is private to
+    the handle that opened it, so its copy could never become the sqlite3
+    connection the engine runs on."""
+    path = ensureTemplate(puppies, seed, as_of)
+    connection = sqlite3.connect(':memory:', check_same_thread=False,
+                                 isolation_level=None)
+    connection.execute("ATTACH DATABASE ? AS template", (path,))
+    schema = connection.execute(
+        "SELECT type, name, sql FROM template.sqlite_master "
+        "WHERE sql IS NOT NULL AND name NOT LIKE 'sqlite_%' "
+        "ORDER BY rootpage").fetchall()
+
+    connection.execute("BEGIN")
+    for kind, name, sql in schema:
+        if kind == 'table':
+            connection.execute(sql)
+            connection.execute('INSERT INTO main."%s" SELECT * FROM '
+                               'template."%s"' % (name, name))
+    for kind, name, sql in schema:
+        if kind != 'table':
+            connection.execute(sql)
+    connection.execute("COMMIT")
+    connection.execute("DETACH DATABASE template")
+    # Back to pysqlite's implicit transactions, which SQLAlchemy expects
+    connection.isolation_level = ''
+
+    return create_engine('sqlite://', creator=lambda: connection,
+                         poolclass=StaticPool)
+
+
+if __name__ == '__main__':
+    parser = argparse.ArgumentParser(
+        description="Seeded, cached database templates for tests and "
+        "benchmarks")
+    parser.add_argument(
+        "--puppies", type=int, default=100000,
+        help="template size (default: 100000)")
+    parser.add_argument("--seed", type=int, default=0)
+    commands = parser.add_subparsers(dest="command")
+    commands.add_parser("build", help="build the template if not cached")
+    clone = commands.add_parser(
+        "clone", help="copy the template to a database file")
+    clone.add_argument("target")
+    commands.add_parser("list", help="cached templates")
+    args = parser.parse_args()
+
+    if args.command == "list":
+        for path in sorted(glob.glob(os.path.join(TEMPLATE_DIR, '*.db'))):
+            print "%s  %.1f MB" % (path, os.path.getsize(path) / 2.0 ** 20)
+    else:
+        start = time.time()
+        if args.command == "build":
+            path = ensureTemplate(args.puppies, args.seed)
+        else:
+            path = cloneTemplate(args.target, args.puppies, args.seed)
+        print "%s in %.3fs" % (path, time.time() - start)
@@ -0,0 +1,97 @@
+import datetime
+import os
+import shutil
+import sys
+import tempfile
+import unittest
+
+# Keep the database modules off the real database unless told otherwise
+SCRATCH = tempfile.mkdtemp()
+os.environ.setdefault(
+    'DATABASE_URL', 'sqlite:///' + os.path.join(SCRATCH, 'shelter.db'))
+os.environ.setdefault('DATABASE_READ_URL', os.environ['DATABASE_URL'])
+
+from sqlalchemy.orm import sessionmaker
+
+import database_queries
+from database_setup import Adopter, Base, Puppy, Shelter
+
+
+def quietly(function, *args):
+    """function(*args) with its progress messages discarded"""
+    sys.stdout = open(os.devnull, 'w')
+    try:
+        return function(*args)
+    finally:
+        sys.stdout.close()
+        sys.stdout = sys.__stdout__
+
+
+class RecordAdoptionTest(unittest.TestCase):
+    """recordAdoption() rejects bad input before it changes anything"""
+
+    @classmethod
+    def tearDownClass(cls):
+        shutil.rmtree(SCRATCH, ignore_errors=True)
+
+    def setUp(self):
+        self.directory = tempfile.mkdtemp()
+        self.engine = database_queries.createWriterEngine(
+            'sqlite:///' + os.path.join(self.directory, 'adoptions.db'))
+        Base.metadata.create_all(self.engine)
+        self.session = sessionmaker(bind=self.engine)()
+
+        shelter = Shelter(name="Test Shelter", current_occupancy=0,
+                          maximum_capacity=10)
+        self.session.add(shelter)
+        self.session.commit()
+        self.puppy_id = quietly(
+            database_queries.placePuppy, self.session, "Rex", "male",
+            datetime.date(2016, 1, 1), 10.0, shelter.id).id
+        adopter = Adopter("Ada", "Lovelace")
+        self.session.add(adopter)
+        self.session.commit()
+        self.adopter_id = adopter.id
+
+    def tearDown(self):
+        self.session.close()
+        self.engine.dispose()
+        shutil.rmtree(self.directory)
+
+    def assertUnchanged(self):
+        self.session.rollback()
+        self.assertEqual(self.session.query(Shelter.current_occupancy).
+                         scalar(), 1)
+        self.assertEqual(self.session.query(Puppy).get(self.puppy_id).
+                         adopters, [])
+
+    def testUnknownPuppy(self):
+        self.assertRaises(ValueError, database_queries.recordAdoption,
+                          self.session, self.puppy_id + 1, [self.adopter_id])
+        self.assertUnchanged()
+
+    def testUnknownAdopter(self):
+        self.assertRaises(
+            ValueError, database_queries.recordAdoption, self.session,
+            self.puppy_id, [self.adopter_id, self.adopter_id + 1])
+        self.assertUnchanged()
+
+    def testNoAdopters(self):
+        self.assertRaises(ValueError, database_queries.recordAdoption,
+                          self.session, self.puppy_id, [])
+        self.assertUnchanged()
+
+    def testAdoption(self):
+        puppy, adopted = database_queries.recordAdoption(
+            self.session, self.puppy_id, [self.adopter_id])
+        self.session.commit()
+
+        self.assertTrue(adopted)
+        self.assertEqual([adopter.id for adopter in puppy.adopters],
+                         [self.adopter_id])
+        self.assertEqual(self.session.query(Shelter.current_occupancy).
+                         scalar(), 0)
+
+
+if __name__ == '__main__':
+    unittest.main()
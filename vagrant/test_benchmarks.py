@@ -0,0 +1,51 @@
+import os
+import shutil
+import sys
+import tempfile
+import traceback
+import unittest
+
+# Keep the database modules, imported with benchmarks, off the real database
+# and template cache unless told otherwise
+SCRATCH = tempfile.mkdtemp()
+os.environ.setdefault(
+    'DATABASE_URL', 'sqlite:///' + os.path.join(SCRATCH, 'benchmarks.db'))
+os.environ.setdefault('DATABASE_READ_URL', os.environ['DATABASE_URL'])
+os.environ.setdefault('TEMPLATE_DIR', os.path.join(SCRATCH, 'templates'))
+
+import benchmarks
+
+# Small enough to run every benchmark in seconds
+SMOKE_PUPPIES = 500
+SMOKE_OPTIONS = {
+    'group-commit': {'threads': 8},
+    'occupancy': {'events': 5000},
+    'waitlist': {'entries': 500, 'arrivals': 20},
+}
+
+
+class BenchmarkSuiteTest(unittest.TestCase):
+    """Every registered benchmark runs to completion on a small dataset, so
+    a schema or connection change (e.g. a new pragma) can't break one
+    unnoticed"""
+
+    @classmethod
+    def tearDownClass(cls):
+        shutil.rmtree(SCRATCH, ignore_errors=True)
+
+    def testEveryBenchmarkRuns(self):
+        failures = []
+        for name, benchmark in sorted(benchmarks.BENCHMARKS.items()):
+            sys.stdout = open(os.devnull, 'w')
+            try:
+                benchmark(SMOKE_PUPPIES, 1, **SMOKE_OPTIONS.get(name, {}))
+            except Exception:
+                failures.append("%s:\n%s" % (name, traceback.format_exc()))
+            finally:
+                sys.stdout.close()
+                sys.stdout = sys.__stdout__
+        self.assertEqual(failures, [], "\n".join(failures))
+
+
+if __name__ == '__main__':
+    unittest.main()
@@ -0,0 +1,62 @@
+import os
+import shutil
+import sys
+import tempfile
+import unittest
+
+# Keep the database modules, imported with memory_profile, off the real
+# database and template cache unless told otherwise
+SCRATCH = tempfile.mkdtemp()
+os.environ.setdefault(
+    'DATABASE_URL', 'sqlite:///' + os.path.join(SCRATCH, 'memory.db'))
+os.environ.setdefault('DATABASE_READ_URL', os.environ['DATABASE_URL'])
+os.environ.setdefault('TEMPLATE_DIR', os.path.join(SCRATCH, 'templates'))
+
+from sqlalchemy.engine.url import make_url
+
+import memory_profile
+from database_setup import DATABASE_URL
+
+# Smallest template whose measurements scale to 100k puppies: below about
+# 30k, each query's fixed 1-3 MB (statement compilation, the connection)
+# outweighs the rows and the scaled figures overshoot
+MEMORY_PUPPIES = 30000
+
+DATABASE = make_url(DATABASE_URL)
+
+
+@unittest.skipUnless(
+    DATABASE.get_backend_name() == 'sqlite' and DATABASE.database and
+    os.path.abspath(DATABASE.database).startswith(tempfile.gettempdir()),
+    "DATABASE_URL is not a scratch SQLite database")
+class MemoryBudgetTest(unittest.TestCase):
+    """Peak memory of every report query and a populator batch, scaled to
+    100k puppies, stays within memory_profile.BUDGETS_MB"""
+
+    @classmethod
+    def tearDownClass(cls):
+        shutil.rmtree(SCRATCH, ignore_errors=True)
+
+    def testPeaksWithinBudget(self):
+        # The modules were bound to DATABASE_URL on import; another test
+        # module may have set it, and removed its directory since
+        directory = os.path.dirname(os.path.abspath(DATABASE.database))
+        if not os.path.isdir(directory):
+            os.makedirs(directory)
+
+        sys.stdout = open(os.devnull, 'w')
+        try:
+            measured = memory_profile.profileMemory(
+                MEMORY_PUPPIES, check=True, path=DATABASE.database)
+        finally:
+            sys.stdout.close()
+            sys.stdout = sys.__stdout__
+
+        self.assertEqual(sorted(measured), sorted(memory_profile.BUDGETS_MB))
+        for name, per_100k in measured.items():
+            self.assertLessEqual(per_100k, memory_profile.BUDGETS_MB[name],
+                                 name)
+
+
+if __name__ == '__main__':
+    unittest.main()
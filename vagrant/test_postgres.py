@@ -0,0 +1,301 @@
+import datetime
+import os
+import sys
+import unittest
+
+try:
+    import psycopg2
+except ImportError:  # the tests below skip without it
+    psycopg2 = None
+
+from sqlalchemy import create_engine, exc, func, select
+from sqlalchemy.engine.url import make_url
+from sqlalchemy.orm import sessionmaker
+
+# The server to test against. The tests run in a scratch database of their
+# own on it, so the one DATABASE_URL names is left alone.
+DATABASE_URL = os.environ.get('DATABASE_URL', '')
+POSTGRES = psycopg2 is not None and DATABASE_URL.startswith('postgresql')
+
+SCRATCH_DATABASE = 'puppyshelter_test'
+
+if POSTGRES:
+    # The database modules create their tables and triggers on import, so
+    # create the scratch database and point them at it first
+    admin = create_engine(DATABASE_URL, isolation_level='AUTOCOMMIT')
+    admin.execute("DROP DATABASE IF EXISTS %s" % SCRATCH_DATABASE)
+    admin.execute("CREATE DATABASE %s" % SCRATCH_DATABASE)
+
+    scratch_url = make_url(DATABASE_URL)
+    scratch_url.database = SCRATCH_DATABASE
+    os.environ['DATABASE_URL'] = str(scratch_url)
+    os.environ['DATABASE_READ_URL'] = str(scratch_url)
+
+    import database_queries
+    import database_setup
+    import migrations
+    import occupancy
+    import puppypopulator
+    from database_setup import (
+        Adopter, Base, change_log_table, createChangeTriggers,
+        createOccupancyTriggers, occupancy_daily_table,
+        occupancy_events_table, Puppy, PuppyProfile, Shelter)
+
+
+def quietly(function, *args):
+    """function(*args) with its progress messages discarded"""
+    sys.stdout = open(os.devnull, 'w')
+    try:
+        return function(*args)
+    finally:
+        sys.stdout.close()
+        sys.stdout = sys.__stdout__
+
+
+@unittest.skipUnless(psycopg2 is not None, "psycopg2 is not installed")
+@unittest.skipUnless(DATABASE_URL.startswith('postgresql'),
+                     "DATABASE_URL is not a PostgreSQL database")
+class PostgresTest(unittest.TestCase):
+    """The PostgreSQL-only paths: COPY loading, the plpgsql triggers,
+    read-only report connections, foreign key migration, row locking on
+    check-in and the DELETE ... RETURNING occupancy rollup"""
+
+    @classmethod
+    def setUpClass(cls):
+        cls.url = str(scratch_url)
+        cls.engine = database_queries.createWriterEngine(cls.url)
+
+    @classmethod
+    def tearDownClass(cls):
+        # The scratch database can only be dropped once nothing is
+        # connected to it
+        cls.engine.dispose()
+        for module in (database_queries, puppypopulator):
+            module.session.close()
+            module.engine.dispose()
+        database_queries.read_session.remove()
+        database_queries.read_engine.dispose()
+        database_setup.engine.dispose()
+
+        admin.execute("DROP DATABASE IF EXISTS %s" % SCRATCH_DATABASE)
+        admin.dispose()
+
+    def setUp(self):
+        Base.metadata.drop_all(self.engine)
+        Base.metadata.create_all(self.engine)
+        self.Session = sessionmaker(bind=self.engine)
+        self.session = self.Session()
+
+    def tearDown(self):
+        self.session.close()
+
+    def addShelter(self, capacity=10):
+        shelter = Shelter(name="Test Shelter", current_occupancy=0,
+                          maximum_capacity=capacity)
+        self.session.add(shelter)
+        self.session.commit()
+        return shelter.id
+
+    def triggerNames(self):
+        return sorted(name for (name,) in self.engine.execute(
+            "SELECT tgname FROM pg_trigger WHERE NOT tgisinternal"))
+
+    def testCopyLoadsPuppiesAndProfiles(self):
+        populator_session = puppypopulator.session
+        puppypopulator.session = self.session
+        try:
+            puppypopulator.CreateShelters()
+            quietly(puppypopulator.CopyPuppiesAndProfiles)
+        finally:
+            puppypopulator.session = populator_session
+
+        names = len(puppypopulator.male_names) + \
+            len(puppypopulator.female_names)
+        self.assertEqual(self.session.query(Puppy).count(), names)
+        self.assertEqual(self.session.query(PuppyProfile).count(), names)
+        self.assertEqual(
+            self.session.query(func.sum(Shelter.current_occupancy)).scalar(),
+            names)
+
+        # setval() moved the id sequence past the copied ids
+        puppy = Puppy(name="Next", gender="male", shelter_id=1)
+        self.session.add(puppy)
+        self.session.flush()
+        self.assertEqual(puppy.id, names + 1)
+
+        # COPY skipped the ORM events; rebuildNameIndex() caught up
+        self.assertEqual(
+            database_queries.findPuppiesByName(self.session, "bayley")[0][2],
+            "Bailey")
+
+    def testTriggersRecordChanges(self):
+        shelter_id = self.addShelter()
+        self.session.query(Shelter).filter(Shelter.id == shelter_id).update(
+            {Shelter.current_occupancy: 3})
+        self.session.commit()
+
+        self.assertEqual(
+            [tuple(row) for row in self.engine.execute(
+                select([change_log_table.c.table_name,
+                        change_log_table.c.operation]).
+                order_by(change_log_table.c.version))],
+            [('shelter', 'insert'), ('shelter', 'update')])
+        self.assertEqual(
+            [tuple(row) for row in self.engine.execute(
+                select([occupancy_events_table.c.shelter_id,
+                        occupancy_events_table.c.delta]))],
+            [(shelter_id, 3)])
+
+    def testExistingTriggersTakeNoTableLocks(self):
+        shelter_id = self.addShelter()
+        triggers = self.triggerNames()
+
+        # A check-in in progress holds a row lock on the shelter; dropping
+        # or creating a trigger would wait for it
+        blocker = self.engine.connect()
+        transaction = blocker.begin()
+        blocker.execute(Shelter.__table__.update().
+                        where(Shelter.id == shelter_id).
+                        values(current_occupancy=1))
+        try:
+            with self.engine.connect() as connection:
+                connection.execute("SET lock_timeout = '1s'")
+                createChangeTriggers(Base.metadata, connection)
+                createOccupancyTriggers(Base.metadata, connection)
+        finally:
+            transaction.rollback()
+            blocker.close()
+
+        self.assertEqual(self.triggerNames(), triggers)
+
+    def testReadEngineIsReadOnly(self):
+        self.addShelter()
+        reader = database_queries.createReadEngine(self.url, pool_size=1)
+        try:
+            with reader.connect() as connection:
+                self.assertEqual(connection.execute(
+                    select([func.count()]).select_from(Shelter.__table__)).
+                    scalar(), 1)
+                self.assertRaises(
+                    exc.InternalError, connection.execute,
+                    Shelter.__table__.insert(), name="Nope",
+                    current_occupancy=0, maximum_capacity=1)
+        finally:
+            reader.dispose()
+
+    def testMigrateForeignKeysAddsCascade(self):
+        shelter_id = self.addShelter()
+        puppy = database_queries.placePuppy(
+            self.session, "Rex", "male", datetime.date(2016, 1, 1), 10.0,
+            shelter_id)
+        self.session.commit()
+
+        # Put back the constraint as it was before ON DELETE CASCADE
+        with self.engine.begin() as connection:
+            name = connection.execute(
+                "SELECT conname FROM pg_constraint WHERE contype = 'f' AND "
+                "conrelid = 'puppy_profile'::regclass").scalar()
+            connection.execute(
+                "ALTER TABLE puppy_profile DROP CONSTRAINT %s, ADD "
+                "CONSTRAINT %s FOREIGN KEY (puppy_id) REFERENCES puppy (id)"
+                % (name, name))
+
+        self.assertEqual(migrations.migrateForeignKeys(self.engine), 1)
+        self.assertEqual(self.engine.execute(
+            "SELECT confdeltype FROM pg_constraint WHERE contype = 'f' AND "
+            "conrelid = 'puppy_profile'::regclass").scalar(), 'c')
+
+        self.engine.execute(
+            Puppy.__table__.delete().where(Puppy.id == puppy.id))
+        self.assertEqual(self.session.query(PuppyProfile).count(), 0)
+
+    def testCheckInLocksItsShelter(self):
+        shelter_id = self.addShelter()
+        first = self.Session()
+        second = self.Session()
+        try:
+            puppy = database_queries.placePuppy(
+                first, "Rex", "male", datetime.date(2016, 1, 1), 10.0,
+                shelter_id)
+            self.assertIsNotNone(puppy.id)
+
+            # The shelter row stays locked until the first check-in ends
+            second.execute("SET lock_timeout = '500ms'")
+            self.assertRaises(
+                exc.OperationalError, database_queries.placePuppy, second,
+                "Max", "male", datetime.date(2016, 1, 1), 10.0, shelter_id)
+            second.rollback()
+            first.commit()
+        finally:
+            first.close()
+            second.close()
+
+        self.assertEqual(self.session.query(Shelter.current_occupancy).
+                         filter(Shelter.id == shelter_id).scalar(), 1)
+
+    def testAdoptPuppiesLocksItsPuppies(self):
+        shelter_id = self.addShelter()
+        puppy = database_queries.placePuppy(
+            self.session, "Rex", "male", datetime.date(2016, 1, 1), 10.0,
+            shelter_id)
+        self.session.add(Adopter(first_name="Ada", last_name="Lovelace"))
+        self.session.commit()
+        adopter_id = self.session.query(Adopter.id).scalar()
+
+        # A concurrent edit of the puppy holds its row until it commits
+        blocker = self.engine.connect()
+        transaction = blocker.begin()
+        blocker.execute(Puppy.__table__.update().
+                        where(Puppy.id == puppy.id).values(name="Rexy"))
+        queries_session = database_queries.session
+        database_queries.session = self.Session()
+        try:
+            database_queries.session.execute("SET lock_timeout = '500ms'")
+            self.assertRaises(
+                exc.OperationalError, database_queries.adoptPuppies,
+                [(puppy.id, [adopter_id])])
+            database_queries.session.rollback()
+            transaction.rollback()
+
+            self.assertRaises(ValueError, database_queries.adoptPuppies,
+                              [(puppy.id, [adopter_id]), (puppy.id + 1, [1])])
+            self.assertEqual(database_queries.adoptPuppies(
+                [(puppy.id, [adopter_id])]), [puppy.id])
+        finally:
+            database_queries.session.close()
+            database_queries.session = queries_session
+            blocker.close()
+
+        self.assertEqual(self.session.query(Shelter.current_occupancy).
+                         filter(Shelter.id == shelter_id).scalar(), 0)
+
+    def testRollUpKeepsUncommittedEvents(self):
+        shelter_id = self.addShelter()
+        self.session.query(Shelter).filter(Shelter.id == shelter_id).update(
+            {Shelter.current_occupancy: 2})
+        self.session.commit()
+
+        # An event still uncommitted when the rollup runs is left for the
+        # next one rather than deleted uncounted
+        late = self.engine.connect()
+        transaction = late.begin()
+        late.execute(Shelter.__table__.update().
+                     where(Shelter.id == shelter_id).
+                     values(current_occupancy=3))
+        try:
+            self.assertEqual(occupancy.rollUpOccupancy(self.session), 1)
+            self.session.commit()
+            transaction.commit()
+        finally:
+            late.close()
+
+        self.assertEqual(occupancy.rollUpOccupancy(self.session), 1)
+        self.session.commit()
+        self.assertEqual(self.session.query(occupancy_events_table).count(),
+                         0)
+        self.assertEqual(
+            self.session.query(occupancy_daily_table.c.arrivals).scalar(), 3)
+
+
+if __name__ == '__main__':
+    unittest.main()
@@ -0,0 +1,50 @@
+import os
+import shutil
+import tempfile
+import unittest
+
+# Keep the database modules, imported by capturePlans(), off the real
+# database and template cache unless told otherwise
+SCRATCH = tempfile.mkdtemp()
+os.environ.setdefault(
+    'DATABASE_URL', 'sqlite:///' + os.path.join(SCRATCH, 'plans.db'))
+os.environ.setdefault('DATABASE_READ_URL', os.environ['DATABASE_URL'])
+os.environ.setdefault('TEMPLATE_DIR', os.path.join(SCRATCH, 'templates'))
+
+from sqlalchemy.engine.url import make_url
+
+import plan_guard
+from database_setup import DATABASE_URL
+
+DATABASE = make_url(DATABASE_URL)
+
+
+@unittest.skipUnless(
+    DATABASE.get_backend_name() == 'sqlite' and DATABASE.database and
+    os.path.abspath(DATABASE.database).startswith(tempfile.gettempdir()),
+    "DATABASE_URL is not a scratch SQLite database")
+class QueryPlanTest(unittest.TestCase):
+    """No statement in query_plans.json gains a full scan or temp sort.
+    After an intended change run python plan_guard.py --update."""
+
+    @classmethod
+    def tearDownClass(cls):
+        shutil.rmtree(SCRATCH, ignore_errors=True)
+
+    def testNoNewScansOrSorts(self):
+        # The modules were bound to DATABASE_URL on import; another test
+        # module may have set it, and removed its directory since
+        directory = os.path.dirname(os.path.abspath(DATABASE.database))
+        if not os.path.isdir(directory):
+            os.makedirs(directory)
+
+        plans = plan_guard.capturePlans(path=DATABASE.database)
+        failures, unlisted = plan_guard.comparePlans(
+            plans, plan_guard.loadExpectedPlans())
+        self.assertEqual(failures, [], "\n".join(
+            "%s: %s\n    %s" % (operation, statement, "\n    ".join(problems))
+            for operation, statement, problems in failures))
+
+
+if __name__ == '__main__':
+    unittest.main()
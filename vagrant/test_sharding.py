@@ -0,0 +1,153 @@
+import datetime
+import os
+import shutil
+import sys
+import tempfile
+import unittest
+
+# Keep the database modules, imported with sharding, off the real database
+# unless told otherwise
+SCRATCH = tempfile.mkdtemp()
+os.environ.setdefault(
+    'DATABASE_URL', 'sqlite:///' + os.path.join(SCRATCH, 'shelter.db'))
+os.environ.setdefault('DATABASE_READ_URL', os.environ['DATABASE_URL'])
+
+from sqlalchemy import create_engine, func, select
+from sqlalchemy.orm import sessionmaker
+
+import sharding
+from database_setup import (
+    Adopter, Base, occupancy_events_table, occupancy_hourly_table, Puppy,
+    Shelter, WaitlistEntry, waitlist_matches_table)
+from waitlist import addToWaitlist
+
+
+def quietly(function, *args):
+    """function(*args) with its progress messages discarded"""
+    sys.stdout = open(os.devnull, 'w')
+    try:
+        return function(*args)
+    finally:
+        sys.stdout.close()
+        sys.stdout = sys.__stdout__
+
+
+class ShardingTest(unittest.TestCase):
+    """splitDatabase() keeps adopters, waitlists and occupancy history, and
+    writes after the split reach the right shard"""
+
+    @classmethod
+    def tearDownClass(cls):
+        shutil.rmtree(SCRATCH, ignore_errors=True)
+
+    def setUp(self):
+        self.directory = tempfile.mkdtemp()
+        self.url = 'sqlite:///' + os.path.join(self.directory, 'source.db')
+        self.source = create_engine(self.url)
+        Base.metadata.create_all(self.source)
+
+        session = sessionmaker(bind=self.source)()
+        oakland, alameda, mission = shelters = [
+            Shelter(name="Oakland", city="Oakland", county="Alameda",
+                    state="California", current_occupancy=0,
+                    maximum_capacity=10),
+            Shelter(name="Alameda", city="Alameda", county="Alameda",
+                    state="California", current_occupancy=0,
+                    maximum_capacity=10),
+            Shelter(name="Mission", city="San Francisco",
+                    county="San Francisco", state="California",
+                    current_occupancy=0, maximum_capacity=10)]
+        ann, bob = Adopter("Ann", "Adopted"), Adopter("Bob", "Waiting")
+        session.add_all(shelters + [ann, bob])
+        session.commit()
+
+        addToWaitlist(session, bob.id, shelter_id=mission.id)
+        addToWaitlist(session, bob.id, city=" OAKLAND")
+        addToWaitlist(session, ann.id, gender="female")
+        session.commit()
+
+        today = datetime.date.today()
+        puppies = [Puppy(name=name, gender="female", dateOfBirth=today,
+                         weight=10.0, shelter=shelter)
+                   for name, shelter in [("Ruby", oakland), ("Nell", alameda),
+                                         ("Pip", mission)]]
+        session.add_all(puppies)
+        for shelter in shelters:
+            shelter.current_occupancy = 1
+        puppies[0].adopters.append(ann)
+        session.commit()
+
+        session.execute(occupancy_hourly_table.insert(), [
+            {'shelter_id': shelter.id, 'hour': 1, 'arrivals': 1,
+             'departures': 0} for shelter in shelters])
+        session.commit()
+        session.close()
+
+        self.shards = sharding.ShardSet(os.path.join(self.directory, 'shards'))
+
+    def tearDown(self):
+        self.shards.close()
+        self.source.dispose()
+        shutil.rmtree(self.directory)
+
+    def count(self, key, table, where=None):
+        query = select([func.count()]).select_from(table)
+        if where is not None:
+            query = query.where(where)
+        return self.shards.shard(key).engine.execute(query).scalar()
+
+    def waitlist(self, key):
+        return sorted(self.shards.shard(key).engine.execute(
+            select([WaitlistEntry.adopter_id, WaitlistEntry.shelter_id,
+                    WaitlistEntry.city, WaitlistEntry.gender])).fetchall())
+
+    def testSplitKeepsAdoptersWaitlistsAndOccupancy(self):
+        copied = sharding.splitDatabase(self.shards, self.url)
+        self.assertEqual(copied, {'california-alameda': 2,
+                                  'california-san-francisco': 1})
+
+        for key in copied:
+            self.assertEqual(self.count(key, Adopter.__table__), 2)
+            self.assertEqual(self.count(key, occupancy_hourly_table),
+                             copied[key])
+            self.assertEqual(self.count(key, occupancy_events_table),
+                             copied[key])
+
+        # Entries go where they could match: the city's shard, the
+        # shelter's shard, and every shard for those naming neither
+        self.assertEqual(self.waitlist('california-alameda'), [
+            (1, None, None, "female"), (2, None, " OAKLAND", None)])
+        self.assertEqual(self.waitlist('california-san-francisco'), [
+            (1, None, None, "female"), (2, 3, None, None)])
+
+        # Ann matched all three puppies, Bob Ruby (by city) and Pip
+        self.assertEqual(self.count(
+            'california-alameda', waitlist_matches_table), 3)
+        self.assertEqual(self.count(
+            'california-san-francisco', waitlist_matches_table), 2)
+
+    def testWritesAfterSplitReachTheirShard(self):
+        sharding.splitDatabase(self.shards, self.url)
+        key, shelter_id = sharding.addShelter(
+            self.shards, name="Menlo Park", city="Menlo Park",
+            county="San Mateo", state="California", maximum_capacity=5)
+        self.assertEqual(key, 'california-san-mateo')
+        self.assertEqual(self.count(key, Adopter.__table__), 2)
+
+        adopter_id = sharding.addAdopter(self.shards, "Cal", "New")
+        self.assertEqual(adopter_id, 3)
+        for shard_key in self.shards.keys():
+            self.assertEqual(self.count(
+                shard_key, Adopter.__table__, Adopter.id == adopter_id), 1)
+
+        puppy = quietly(
+            sharding.checkInPuppy, self.shards, "Scout", "male",
+            datetime.date.today(), 12.0, "California", "San Mateo",
+            shelter_id)
+        self.assertEqual(puppy[0], key)
+        self.assertTrue(quietly(
+            sharding.adoptPuppy, self.shards, key, puppy[1], [adopter_id]))
+
+
+if __name__ == '__main__':
+    unittest.main()
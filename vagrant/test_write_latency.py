@@ -0,0 +1,56 @@
+import os
+import shutil
+import subprocess
+import sys
+import tempfile
+import unittest
+
+# Keep templates, and the database modules it imports, off the real
+# database and template cache unless told otherwise
+SCRATCH = tempfile.mkdtemp()
+os.environ.setdefault(
+    'DATABASE_URL', 'sqlite:///' + os.path.join(SCRATCH, 'shelter.db'))
+os.environ.setdefault('DATABASE_READ_URL', os.environ['DATABASE_URL'])
+os.environ.setdefault('TEMPLATE_DIR', os.path.join(SCRATCH, 'templates'))
+
+from templates import cloneTemplate
+
+HERE = os.path.dirname(os.path.abspath(__file__))
+
+# Template the check runs against; big enough for reports to take real work
+LATENCY_PUPPIES = 10000
+
+
+class WriteLatencyTest(unittest.TestCase):
+    """Check-ins keep their median latency (within database_queries'
+    LATENCY_FACTOR and LATENCY_SLACK) while report processes run"""
+
+    @classmethod
+    def tearDownClass(cls):
+        shutil.rmtree(SCRATCH, ignore_errors=True)
+
+    def setUp(self):
+        self.directory = tempfile.mkdtemp()
+
+    def tearDown(self):
+        shutil.rmtree(self.directory)
+
+    def testCheckInsKeepLatencyUnderReports(self):
+        # database_queries binds its engines at import, so run the check in
+        # a process of its own pointed at a scratch copy of the template
+        url = cloneTemplate(os.path.join(self.directory, 'latency.db'),
+                            LATENCY_PUPPIES)
+        environment = dict(os.environ, DATABASE_URL=url,
+                           DATABASE_READ_URL=url)
+        check = subprocess.Popen(
+            [sys.executable, 'database_queries.py', 'write-latency'],
+            cwd=HERE, env=environment, stdout=subprocess.PIPE,
+            stderr=subprocess.STDOUT)
+        output = check.communicate()[0]
+        self.assertEqual(check.returncode, 0,
+                         "\n".join(output.splitlines()[-15:]))
+        self.assertIn("report processes: median", output)
+
+
+if __name__ == '__main__':
+    unittest.main()
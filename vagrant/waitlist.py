@@ -0,0 +1,302 @@
+import collections
+import datetime
+import itertools
+import operator
+import weakref
+
+from sqlalchemy import event, func, select
+from sqlalchemy.orm import Session
+
+from database_setup import (
+    dateToDays, poundsToGrams, Puppy, Shelter, WaitlistEntry,
+    waitlist_matches_table)
+from tag_index import batches
+
+NEG_INF = float('-inf')
+POS_INF = float('inf')
+
+
+class IntervalTree(object):
+    """Static centered interval tree over closed intervals (low, high, key),
+    None meaning an open end. stab(x) finds the keys of every interval
+    containing x in O(log n + matches)"""
+
+    def __init__(self, intervals):
+        intervals = list(intervals)
+        self.unbounded = [key for low, high, key in intervals
+                          if low is None and high is None]
+        self.root = self.build([
+            (NEG_INF if low is None else low,
+             POS_INF if high is None else high, key)
+            for low, high, key in intervals])
+
+    @classmethod
+    def build(cls, intervals):
+        """(center, intervals containing it by low end, the same by high end
+        descending, left subtree, right subtree)"""
+        if not intervals:
+            return None
+
+        ends = sorted(itertools.chain.from_iterable(
+            (low, high) for low, high, key in intervals))
+        center = ends[len(ends) // 2]
+
+        left, here, right = [], [], []
+        for interval in intervals:
+            if interval[1] < center:
+                left.append(interval)
+            elif interval[0] > center:
+                right.append(interval)
+            else:
+                here.append(interval)
+
+        return (center,
+                sorted(here, key=operator.itemgetter(0)),
+                sorted(here, key=operator.itemgetter(1), reverse=True),
+                cls.build(left), cls.build(right))
+
+    def stab(self, x):
+        """Keys of the intervals containing x. An unknown x (None) is only
+        contained by intervals open at both ends."""
+        if x is None:
+            return list(self.unbounded)
+
+        found = []
+        node = self.root
+        while node is not None:
+            center, by_low, by_high, left, right = node
+            if x < center:
+                for low, high, key in by_low:
+                    if low > x:
+                        break
+                    found.append(key)
+                node = left
+            elif x > center:
+                for low, high, key in by_high:
+                    if high < x:
+                        break
+                    found.append(key)
+                node = right
+            else:
+                found.extend(key for low, high, key in by_low)
+                break
+        return found
+
+
+def locationKey(shelter_id, city):
+    """Hash bucket for a waitlist entry's location criterion"""
+    if shelter_id is not None:
+        return ('shelter', shelter_id)
+    if city:
+        return ('city', " ".join(city.lower().split()))
+    return None
+
+
+class WaitlistIndex(object):
+    """Standing waitlist criteria, bucketed by (gender, shelter or city)
+    with interval trees on weight and age inside each bucket. A puppy is
+    looked up in the at most six buckets it can fall in (its gender or any,
+    its shelter, its city or anywhere) and only stabs their trees, so
+    matching costs about the same however long the waitlist grows"""
+
+    def __init__(self, entries):
+        grouped = collections.defaultdict(list)
+        self.adopters = {}
+        for entry in entries:
+            self.adopters[entry.id] = entry.adopter_id
+            grouped[(entry.gender,
+                     locationKey(entry.shelter_id, entry.city))].append(entry)
+
+        self.buckets = dict(
+            (key, (IntervalTree((e.min_weight_grams, e.max_weight_grams, e.id)
+                                for e in group),
+                   IntervalTree((e.min_age_days, e.max_age_days, e.id)
+                                for e in group)))
+            for key, group in grouped.items())
+
+    def match(self, gender, age_days, weight_grams, shelter_id, city):
+        """Ids of the entries a puppy satisfies"""
+        matched = []
+        for gender_key in set([gender, None]):
+            for location in set([locationKey(shelter_id, None),
+                                 locationKey(None, city), None]):
+                bucket = self.buckets.get((gender_key, location))
+                if bucket:
+                    by_weight, by_age = bucket
+                    matched.extend(set(by_weight.stab(weight_grams)).
+                                   intersection(by_age.stab(age_days)))
+        return matched
+
+
+# {engine: ((generation, entry count, highest entry id), WaitlistIndex)}
+INDEXES = weakref.WeakKeyDictionary()
+
+# Bumped whenever a session in this process adds or removes waitlist
+# entries, or rolls back a transaction that did
+GENERATION = [0]
+
+
+def waitlistIndex(connection):
+    """The WaitlistIndex for connection's database. Rebuilt only when
+    entries were added or removed since it was last built; entries are
+    never edited in place (see removeFromWaitlist).
+
+    Other processes' changes show in the entry count and highest id, as
+    committed ids are never reused (AUTOINCREMENT). An id given out in a
+    transaction that rolls back can be given out again, so this process's
+    own changes and rollbacks bump GENERATION as well."""
+    stamp = (GENERATION[0],) + tuple(connection.execute(
+        select([func.count(), func.max(WaitlistEntry.id)])).first())
+
+    cached = INDEXES.get(connection.engine)
+    if cached and cached[0] == stamp:
+        return cached[1]
+
+    index = WaitlistIndex(connection.execute(
+        select([WaitlistEntry.__table__])))
+    INDEXES[connection.engine] = (stamp, index)
+    return index
+
+
+def matchArrivals(connection, puppy_ids, today=None):
+    """Match newly checked-in puppies against every standing waitlist entry
+    and queue a notification per match, without committing. Returns the
+    number of matches queued."""
+    index = waitlistIndex(connection)
+    if not index.adopters:
+        return 0
+
+    today = dateToDays(today or datetime.date.today())
+    matches = []
+    for batch in batches(puppy_ids):
+        for puppy_id, gender, birth_day, weight_grams, shelter_id, city in \
+                connection.execute(
+                    select([Puppy.id, Puppy.gender, Puppy.birth_day,
+                            Puppy.weight_grams, Puppy.shelter_id,
+                            Shelter.city]).
+                    select_from(Puppy.__table__.outerjoin(
+                        Shelter.__table__, Puppy.shelter_id == Shelter.id)).
+                    where(Puppy.id.in_(batch))):
+            age_days = None if birth_day is None else today - birth_day
+            matches.extend(
+                {'entry_id': entry_id, 'puppy_id': puppy_id}
+                for entry_id in index.match(
+                    gender, age_days, weight_grams, shelter_id, city))
+
+    if matches:
+        connection.execute(waitlist_matches_table.insert(), matches)
+    return len(matches)
+
+
+@event.listens_for(Session, 'after_flush')
+def matchNewPuppies(session, flush_context):
+    """Match puppies added through the ORM (placePuppy and the like) once
+    their rows are written. Core bulk inserts call matchArrivals()
+    themselves"""
+    puppy_ids = [obj.id for obj in session.new if isinstance(obj, Puppy)]
+    if puppy_ids:
+        matchArrivals(session.connection(), puppy_ids)
+
+
+def noteWaitlistChange(session):
+    GENERATION[0] += 1
+    session.info['waitlist_changed'] = True
+
+
+@event.listens_for(Session, 'after_flush')
+def waitlistFlushed(session, flush_context):
+    """Invalidate cached indexes when entries are added or deleted through
+    the ORM"""
+    if any(isinstance(obj, WaitlistEntry)
+           for obj in itertools.chain(session.new, session.deleted)):
+        noteWaitlistChange(session)
+
+
+@event.listens_for(Session, 'after_bulk_delete')
+def waitlistBulkDeleted(delete_context):
+    """The same for Query.delete(), as used by removeFromWaitlist"""
+    if delete_context.mapper.class_ is WaitlistEntry:
+        noteWaitlistChange(delete_context.session)
+
+
+@event.listens_for(Session, 'after_rollback')
+def waitlistRolledBack(session):
+    """An index built inside the transaction may hold entries that are
+    gone now, with ids that will be given out again"""
+    if session.info.pop('waitlist_changed', False):
+        GENERATION[0] += 1
+
+
+@event.listens_for(Session, 'after_commit')
+def waitlistCommitted(session):
+    session.info.pop('waitlist_changed', None)
+
+
+def withdrawMatches(connection, puppy_ids):
+    """Delete the pending matches for puppies that have been adopted, so
+    no adopter is told about a puppy that is no longer available, without
+    committing. Returns the number withdrawn."""
+    table = waitlist_matches_table
+    withdrawn = 0
+    for batch in batches(puppy_ids):
+        withdrawn += connection.execute(
+            table.delete().where(table.c.puppy_id.in_(batch)).
+            where(~table.c.notified)).rowcount
+    return withdrawn
+
+
+def addToWaitlist(db_session, adopter_id, gender=None, min_age_days=None,
+                  max_age_days=None, min_weight=None, max_weight=None,
+                  shelter_id=None, city=None):
+    """Register an adopter's standing criteria, without committing. Weights
+    are in pounds, ages in days; leave a criterion out to accept anything.
+    Returns the WaitlistEntry."""
+    if shelter_id is not None and city:
+        raise ValueError("Wait on a shelter or a city, not both")
+    for low, high in [(min_age_days, max_age_days),
+                      (min_weight, max_weight)]:
+        if low is not None and high is not None and low > high:
+            raise ValueError("Empty range: %s to %s" % (low, high))
+
+    entry = WaitlistEntry(
+        adopter_id=adopter_id, gender=gender,
+        min_age_days=min_age_days, max_age_days=max_age_days,
+        min_weight_grams=poundsToGrams(min_weight),
+        max_weight_grams=poundsToGrams(max_weight),
+        shelter_id=shelter_id, city=city)
+    db_session.add(entry)
+    db_session.flush()
+    return entry
+
+
+def removeFromWaitlist(db_session, entry_id):
+    """Drop a waitlist entry and its pending notifications, without
+    committing. To change criteria, remove the entry and add a new one.
+    Returns False if there was no such entry."""
+    return db_session.query(WaitlistEntry).\
+        filter(WaitlistEntry.id == entry_id).\
+        delete(synchronize_session=False) > 0
+
+
+def takeNotifications(db_session, limit=1000):
+    """Up to limit pending matches, oldest first, marked as notified without
+    committing; commit once they have been delivered. Returns
+    {adopter id: [(entry id, puppy id), ...]} in order of first match."""
+    table = waitlist_matches_table
+    rows = db_session.execute(
+        select([table.c.id, table.c.entry_id, table.c.puppy_id,
+                WaitlistEntry.adopter_id]).
+        where(table.c.entry_id == WaitlistEntry.id).
+        where(~table.c.notified).
+        order_by(table.c.id).limit(limit).with_for_update()).fetchall()
+
+    for batch in batches([row.id for row in rows]):
+        db_session.execute(
+            table.update().where(table.c.id.in_(batch)).
+            values(notified=True))
+
+    notifications = collections.OrderedDict()
+    for row in rows:
+        notifications.setdefault(row.adopter_id, []).append(
+            (row.entry_id, row.puppy_id))
+    return notifications
@@ -0,0 +1,203 @@
+import Queue
+import threading
+import time
+
+from sqlalchemy.orm import sessionmaker
+
+import database_queries
+from database_queries import placePuppies, placePuppy, recordAdoption
+
+
+class Future(object):
+    """Result of a request submitted to a WriterService"""
+
+    def __init__(self):
+        self._done = threading.Event()
+        self._result = None
+        self._error = None
+
+    def set_result(self, result):
+        self._result = result
+        self._done.set()
+
+    def set_exception(self, error):
+        self._error = error
+        self._done.set()
+
+    def done(self):
+        return self._done.is_set()
+
+    def result(self, timeout=None):
+        """Wait for the request's transaction to commit and return its
+        result, or raise the error that failed it"""
+        if not self._done.wait(timeout):
+            raise RuntimeError("write request still pending")
+        if self._error is not None:
+            raise self._error
+        return self._result
+
+
+def checkInRequest(db_session, *args):
+    """placePuppy for the writer: the new puppy's id, or False if full"""
+    new_puppy = placePuppy(db_session, *args)
+    return False if new_puppy is None else new_puppy.id
+
+
+def adoptRequest(db_session, puppy_id, adopters_list):
+    """recordAdoption for the writer: False if already adopted"""
+    puppy, adopted = recordAdoption(db_session, puppy_id, adopters_list)
+    return adopted
+
+
+class WriterService(object):
+    """One thread owns the write connection. Callers submit check-ins and
+    adoptions and get Futures back; the writer drains whatever is queued
+    (up to max_batch, waiting at most max_delay seconds for more) and runs
+    it as one transaction, so one commit and fsync serves the whole batch.
+
+    Consecutive check-ins in a batch are placed together by placePuppies.
+    If that fails, or for any other request, each request runs in its own
+    SAVEPOINT, so one that fails is rolled back alone and gets its exception
+    while the rest of the batch commits."""
+
+    _STOP = object()
+
+    def __init__(self, engine=None, max_batch=128, max_delay=0.002):
+        self.engine = engine or database_queries.engine
+        self.max_batch = max_batch
+        self.max_delay = max_delay
+        self.requests = Queue.Queue()
+        self.batches = 0
+        self.committed = 0
+        self.thread = threading.Thread(target=self._run)
+        self.thread.daemon = True
+
+    def start(self):
+        self.thread.start()
+        return self
+
+    def stop(self):
+        """Finish queued requests, then stop the writer thread"""
+        self.requests.put(self._STOP)
+        self.thread.join()
+
+    def submit(self, request, *args):
+        """Queue request(db_session, *args) and return its Future"""
+        future = Future()
+        self.requests.put((future, request, args))
+        return future
+
+    def checkIn(self, puppy_name, puppy_gender, puppy_dob, puppy_weight,
+                shelter_id):
+        return self.submit(
+            checkInRequest, puppy_name, puppy_gender, puppy_dob,
+            puppy_weight, shelter_id)
+
+    def adopt(self, puppy_id, adopters_list):
+        return self.submit(adoptRequest, puppy_id, adopters_list)
+
+    def _nextBatch(self):
+        """Block for one request, then gather more until the batch is full
+        or max_delay has passed. Returns (batch, stopping)."""
+        first = self.requests.get()
+        if first is self._STOP:
+            return [], True
+
+        batch = [first]
+        deadline = time.time() + self.max_delay
+
+        while len(batch) < self.max_batch:
+            try:
+                # Take anything already queued without waiting
+                item = self.requests.get_nowait()
+            except Queue.Empty:
+                remaining = deadline - time.time()
+                if remaining <= 0:
+                    break
+                try:
+                    item = self.requests.get(timeout=remaining)
+                except Queue.Empty:
+                    break
+
+            if item is self._STOP:
+                return batch, True
+            batch.append(item)
+
+        return batch, False
+
+    def _run(self):
+        session = sessionmaker(bind=self.engine)()
+        stopping = False
+
+        while not stopping:
+            batch, stopping = self._nextBatch()
+            if batch:
+                self._commitBatch(session, batch)
+
+        session.close()
+
+    def _runEach(self, session, requests):
+        """Run requests one at a time, each in its own savepoint"""
+        outcomes = []
+
+        for future, request, args in requests:
+            savepoint = session.begin_nested()
+            try:
+                result = request(session, *args)
+                savepoint.commit()
+                outcomes.append((future, result, None))
+            except Exception as e:
+                savepoint.rollback()
+                outcomes.append((future, None, e))
+
+        return outcomes
+
+    def _runCheckIns(self, session, requests):
+        """Place a run of check-ins with one placePuppies call, falling back
+        to one at a time if any of them fails"""
+        savepoint = session.begin_nested()
+        try:
+            results = placePuppies(session, [args for f, r, args in requests])
+            savepoint.commit()
+        except Exception:
+            savepoint.rollback()
+            return self._runEach(session, requests)
+
+        return [(future, result, None)
+                for (future, request, args), result in zip(requests, results)]
+
+    def _commitBatch(self, session, batch):
+        outcomes = []
+        start = 0
+
+        # Split the batch into runs of check-ins and runs of anything else,
+        # keeping arrival order
+        while start < len(batch):
+            is_check_in = batch[start][1] is checkInRequest
+            end = start
+            while end < len(batch) and \
+                    (batch[end][1] is checkInRequest) == is_check_in:
+                end += 1
+
+            if is_check_in:
+                outcomes.extend(self._runCheckIns(session, batch[start:end]))
+            else:
+                outcomes.extend(self._runEach(session, batch[start:end]))
+            start = end
+
+        try:
+            session.commit()
+        except Exception as e:
+            session.rollback()
+            for future, result, error in outcomes:
+                future.set_exception(e)
+            return
+
+        self.batches += 1
+        self.committed += len(batch)
+
+        for future, result, error in outcomes:
+            if error is None:
+                future.set_result(result)
+            else:
+                future.set_exception(error)